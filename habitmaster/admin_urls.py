@@ -0,0 +1,9 @@
+"""
+The admin site's URLs.  The root urlconf includes this by name, so that the admin and
+every app's admin module are only imported when an admin page is first requested.
+"""
+
+from django.contrib import admin
+admin.autodiscover()
+
+urlpatterns = admin.site.get_urls()
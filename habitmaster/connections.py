@@ -0,0 +1,55 @@
+"""
+Persistent database connections: keeps each connection open across requests for up to
+DATABASE_CONN_MAX_AGE seconds, instead of opening a new one for every request.  Turned on
+by enablePersistentConnections (see wsgi.py) when that setting is more than 0.
+"""
+
+import time
+
+from django.conf import settings
+from django.core import signals
+from django.db import connections, close_connection, transaction, DatabaseError
+from django.db.backends.signals import connection_created
+
+
+def _connectionOpened(sender, connection, **kwargs):
+    connection.opened_at = time.time()
+
+
+def recycleConnection(connection, maxAge, now=None):
+    """
+    Ends whatever transaction the given connection (a DatabaseWrapper) is in, and closes 
+    it if it is older than maxAge seconds or no longer works.  Returns whether it was 
+    closed.
+    """
+    if connection.connection is None:
+        return False
+    if now is None:
+        now = time.time()
+    try:
+        # so the next request does not inherit this one's transaction or snapshot
+        connection._rollback()
+    except DatabaseError:
+        connection.close()
+        return True
+    if now - getattr(connection, 'opened_at', 0) >= maxAge:
+        connection.close()
+        return True
+    return False
+
+
+def recycleConnections(**kwargs):
+    """ Signal handler for the end of a request, in place of close_connection. """
+    for alias in connections:
+        # as in close_connection, for a request that failed within a transaction
+        transaction.abort(alias)
+        recycleConnection(connections[alias], settings.DATABASE_CONN_MAX_AGE)
+
+
+def enablePersistentConnections():
+    """ Keeps connections between requests if the DATABASE_CONN_MAX_AGE setting allows. """
+    if settings.DATABASE_CONN_MAX_AGE <= 0:
+        return
+    connection_created.connect(_connectionOpened)
+    signals.request_finished.disconnect(close_connection)
+    signals.request_finished.connect(recycleConnections)
@@ -1,7 +1,9 @@
 from django.contrib import admin
-from models import *
+from habitmaster.habits.models import DaysOfWeekSchedule, IntervalSchedule, GoalSchedule, Habit
+from habitmaster.habits.models import Activity
 
 admin.site.register(Habit)
 admin.site.register(Activity)
 admin.site.register(DaysOfWeekSchedule)
 admin.site.register(IntervalSchedule)
+admin.site.register(GoalSchedule)
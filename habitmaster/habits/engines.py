@@ -0,0 +1,407 @@
+"""
+The streak engines: the different ways this app works out a habit's streaks, registered
+here so that they can be checked against each other.  The reference engine is the
+definition: Habit.getStreaks, getStarLevel, and nextRequiredDay replaying the activities
+through the schedule's getStreaks.  The others (stored and repaired summaries, archives,
+and the report queries) are faster ways to the same answers, and any new one should be
+registered here too.
+
+checkEngines runs every registered engine on random cases (a schedule, a history of
+activity dates, and a today) and compares each with the reference engine.  A case that
+gives a different answer is shrunk to a smallest one that still does.  It also times each
+engine, so it doubles as a throughput comparison.  See manage.py streakcheck.
+
+The engines other than the reference one save the case to the database, so only run this
+on a test database.
+"""
+
+import datetime
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.db import connections
+from habitmaster.habits.models import DaysOfWeekSchedule, IntervalSchedule, GoalSchedule
+from habitmaster.habits.models import Habit, Activity
+from habitmaster.habits.models import HabitSummary, Streak
+from habitmaster.habits.reports import currentIntervalStreaks, supportsWindowFunctions
+
+# engines by name, in the order registered
+ENGINES = {}
+_order = []
+
+
+def register(engine):
+    """ Adds the given engine (see Engine) to the registry.  Returns it. """
+    if engine.name not in ENGINES:
+        _order.append(engine.name)
+    ENGINES[engine.name] = engine
+    return engine
+
+
+def unregister(name):
+    """ Removes the named engine from the registry. """
+    del ENGINES[name]
+    _order.remove(name)
+
+
+def engineNames():
+    """ Returns the names of the registered engines, in the order registered. """
+    return list(_order)
+
+
+class Case(object):
+    """
+    One input for the engines: a schedule, given as ('days', '1010100'), ('interval', 3),
+    or ('goal', (times, period)), the dates of a habit's (non-missed) activities, as day
+    offsets from start in order, and today, as an offset too (on or after the last
+    activity).
+    """
+
+    def __init__(self, schedule, offsets, today, start):
+        self.schedule = schedule
+        self.offsets = list(offsets)
+        self.today = today
+        self.start = start
+
+    def __repr__(self):
+        return 'Case(%r, %r, today=%d, start=%s)' % (self.schedule, self.offsets, self.today,
+                                                     self.start.isoformat())
+
+    def __eq__(self, other):
+        return repr(self) == repr(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def getDate(self, offset):
+        return self.start + datetime.timedelta(days=offset)
+
+    def getDates(self):
+        return [self.getDate(offset) for offset in self.offsets]
+
+    def getToday(self):
+        return self.getDate(self.today)
+
+    def makeSchedule(self):
+        """ Returns an unsaved Schedule for this case. """
+        if self.schedule[0] == 'days':
+            return DaysOfWeekSchedule(days=self.schedule[1])
+        if self.schedule[0] == 'goal':
+            return GoalSchedule(times=self.schedule[1][0], period=self.schedule[1][1])
+        return IntervalSchedule(interval=self.schedule[1])
+
+    def size(self):
+        """ How big this case is, for shrinking: smaller is simpler. """
+        ones = self.schedule[1].count('1') if self.schedule[0] == 'days' else 0
+        interval = self.schedule[1] if self.schedule[0] == 'interval' else 0
+        times = self.schedule[1][0] if self.schedule[0] == 'goal' else 0
+        return (len(self.offsets), self.today + sum(self.offsets), ones + interval + times)
+
+
+def observe(habit, today):
+    """
+    Returns what the engines are compared on, from anything with the Habit (or
+    HabitSummary) methods for the current streak, as of today.
+    """
+    return {
+        'current_times': habit.getCurrentStreakTimes(today),
+        'current_days': habit.getCurrentStreakDays(today),
+        'star': habit.getStarLevel(today),
+        'next_day': habit.nextRequiredDay(today),
+    }
+
+
+def spansOf(streaks):
+    """ Returns (start, end, times) for each non-empty streak in the given list. """
+    return [(streak[0].date, streak[-1].date, len(streak)) for streak in streaks if streak]
+
+
+class Engine(object):
+    """
+    A way of working out streaks.  Subclasses set name and override run, which returns
+    a dict of observations for a case: some or all of those of observe, and 'spans' for
+    the non-empty streaks (see spansOf) if the engine has them.  Only the observations
+    both engines have are compared.
+    """
+    name = None
+
+    def supports(self, case):
+        """ Returns whether this engine can work out the given case. """
+        return True
+
+    def run(self, case):
+        raise NotImplementedError
+
+
+class ReferenceEngine(Engine):
+    """ Habit's own methods, replaying every activity, with nothing in the database. """
+    name = 'reference'
+
+    def run(self, case):
+        activities = [Activity(date=date) for date in case.getDates()]
+        habit = Habit(schedule=case.makeSchedule(), active=True)
+        habit.getActivityList = lambda since=None, until=None: activities
+        result = observe(habit, case.getToday())
+        result['spans'] = spansOf(habit.getStreaks(case.getToday()))
+        return result
+
+
+class DatabaseEngine(Engine):
+    """ An engine that works from the case saved to the database as a habit. """
+
+    def run(self, case):
+        user = User.objects.get_or_create(username='streakcheck')[0]
+        schedule = case.makeSchedule()
+        schedule.save()
+        habit = Habit.objects.create(user=user, task=repr(case), schedule=schedule,
+                                     active=True)
+        try:
+            return self.runHabit(case, habit)
+        finally:
+            habit.delete()
+            schedule.delete()
+
+    def runHabit(self, case, habit):
+        """ Returns the observations for the case, saved as the given habit. """
+        raise NotImplementedError
+
+    @staticmethod
+    def storedSpans(habit):
+        return [(span.start, span.end, span.times)
+                for span in Streak.objects.filter(habit=habit).order_by('start', 'id')]
+
+
+class StoredEngine(DatabaseEngine):
+    """ The HabitSummary and Streaks stored by refreshSummary. """
+    name = 'stored'
+
+    def runHabit(self, case, habit):
+        Activity.objects.bulk_create([Activity(habit=habit, date=date)
+                                      for date in case.getDates()])
+        summary = habit.refreshSummary()
+        result = observe(summary, case.getToday())
+        result['spans'] = self.storedSpans(habit)
+        return result
+
+
+class RepairedEngine(DatabaseEngine):
+    """
+    The HabitSummary and Streaks as kept up to date by repairSummary, as the activities
+    are saved one at a time in a shuffled order, then one is deleted and added back.
+    """
+    name = 'repaired'
+
+    def runHabit(self, case, habit):
+        dates = case.getDates()
+        rand = random.Random(repr(case))
+        rand.shuffle(dates)
+        activities = [Activity.objects.create(habit=habit, date=date) for date in dates]
+        if activities:
+            act = rand.choice(activities)
+            act.delete()
+            Activity.objects.create(habit=habit, date=act.date)
+        summary = HabitSummary.objects.get(habit=habit)
+        result = observe(summary, case.getToday())
+        result['spans'] = self.storedSpans(habit)
+        return result
+
+
+class ArchivedEngine(DatabaseEngine):
+    """ Habit's methods after archiving the activities before the middle one. """
+    name = 'archived'
+
+    def runHabit(self, case, habit):
+        dates = case.getDates()
+        Activity.objects.bulk_create([Activity(habit=habit, date=date) for date in dates])
+        if dates:
+            habit.archiveBefore(dates[len(dates) // 2] + datetime.timedelta(days=1))
+        habit = Habit.objects.get(id=habit.id)
+        result = observe(habit, case.getToday())
+        result['spans'] = spansOf(habit.getStreaks(case.getToday()))
+        return result
+
+
+class ReportEngine(DatabaseEngine):
+    """ The current streaks of reports.currentIntervalStreaks, for interval schedules. """
+
+    def __init__(self, name, useSql):
+        self.name = name
+        self.useSql = useSql
+
+    def supports(self, case):
+        if self.useSql and not supportsWindowFunctions(connections['default']):
+            return False
+        return case.schedule[0] == 'interval'
+
+    def runHabit(self, case, habit):
+        Activity.objects.bulk_create([Activity(habit=habit, date=date)
+                                      for date in case.getDates()])
+        summary = currentIntervalStreaks([habit.id], useSql=self.useSql).get(habit.id)
+        if summary is None:
+            summary = HabitSummary(habit=habit)
+            summary.summarize([])
+        summary.habit = habit
+        return observe(summary, case.getToday())
+
+
+register(ReferenceEngine())
+register(StoredEngine())
+register(RepairedEngine())
+register(ArchivedEngine())
+register(ReportEngine('sql', useSql=True))
+register(ReportEngine('walk', useSql=False))
+
+
+def randomCase(rand, maxActivities=40):
+    """ Returns a random Case, mostly of streaks with some breaks, duplicates, and extras. """
+    roll = rand.random()
+    if roll < 0.4:
+        days = ''
+        while '1' not in days:
+            days = ''.join(rand.choice('01') for i in range(7))
+        schedule = ('days', days)
+    elif roll < 0.8:
+        schedule = ('interval', rand.choice((1, 1, 2, 2, 3, 4, 5, 6, 7)))
+    else:
+        period = rand.choice((7, 7, 30))
+        schedule = ('goal', (rand.randint(1, period // 2), period))
+    start = datetime.date(2013, 1, 7) + datetime.timedelta(days=rand.randrange(7))
+    model = Case(schedule, [], 0, start).makeSchedule()
+
+    offsets = []
+    offset = rand.randrange(3)
+    for i in range(rand.randint(0, maxActivities)):
+        offsets.append(offset)
+        roll = rand.random()
+        if roll < 0.1:
+            continue  # another on the same day
+        elif roll < 0.25:
+            offset += rand.randint(1, 3)  # maybe early, maybe late
+        elif roll < 0.35:
+            offset += rand.randint(5, 20)  # lapsed
+        elif schedule[0] == 'goal':
+            # anywhere up to twice the average gap, mostly keeping to the goal
+            offset += rand.randint(0, 2 * schedule[1][1] // schedule[1][0])
+        else:
+            # on the next required day
+            streak = [Activity(date=start + datetime.timedelta(days=offsets[0]))]
+            streak.append(Activity(date=start + datetime.timedelta(days=offset)))
+            required = model.nextRequiredDay(streak, streak[-1].date)
+            offset = (required - start).days
+    today = (offsets[-1] if offsets else 0) + rand.choice((0, 0, 1, 2, 3, 5, 8, 15, 30))
+    return Case(schedule, offsets, today, start)
+
+
+def compare(reference, other):
+    """ Returns the names of the observations that differ between two results. """
+    return sorted(name for name in reference
+                  if name in other and reference[name] != other[name])
+
+
+def _fails(engine, case, reference=None):
+    if not engine.supports(case):
+        return False
+    reference = reference or ENGINES['reference']
+    return bool(compare(reference.run(case), engine.run(case)))
+
+
+def shrinkCandidates(case):
+    """ Yields simpler variations of the given case, simplest changes first. """
+    (kind, value) = case.schedule
+    # fewer activities
+    for i in range(len(case.offsets)):
+        yield Case(case.schedule, case.offsets[:i] + case.offsets[i + 1:], case.today, 
+                   case.start)
+    # starting sooner, with less between activities, or an earlier today
+    if case.offsets and case.offsets[0] > 0:
+        shift = case.offsets[0]
+        yield Case(case.schedule, [offset - shift for offset in case.offsets],
+                   case.today - shift, case.start + datetime.timedelta(days=shift))
+    for i in range(1, len(case.offsets)):
+        if case.offsets[i] > case.offsets[i - 1]:
+            offsets = case.offsets[:i] + [offset - 1 for offset in case.offsets[i:]]
+            yield Case(case.schedule, offsets, case.today - 1, case.start)
+    if case.today > (case.offsets[-1] if case.offsets else 0):
+        yield Case(case.schedule, case.offsets, case.today - 1, case.start)
+    # a simpler schedule
+    if kind == 'interval' and value > 1:
+        yield Case(('interval', value - 1), case.offsets, case.today, case.start)
+    if kind == 'goal' and value[0] > 1:
+        yield Case(('goal', (value[0] - 1, value[1])), case.offsets, case.today, case.start)
+    if kind == 'days':
+        for i in range(7):
+            if value[i] == '1' and value.count('1') > 1:
+                days = value[:i] + '0' + value[i + 1:]
+                yield Case(('days', days), case.offsets, case.today, case.start)
+
+
+def shrink(engine, case, reference=None):
+    """
+    Returns a smallest variation of the given case on which the engine still differs
+    from the reference engine, trying simpler cases for as long as one still fails.
+    """
+    improved = True
+    while improved:
+        improved = False
+        for candidate in shrinkCandidates(case):
+            if candidate.size() < case.size() and _fails(engine, candidate, reference):
+                case = candidate
+                improved = True
+                break
+    return case
+
+
+class Mismatch(object):
+    """ A case on which an engine differs from the reference engine, as shrunk. """
+
+    def __init__(self, engine, original, case):
+        self.engine = engine
+        self.original = original
+        self.case = case
+        self.expected = ENGINES['reference'].run(case)
+        self.actual = engine.run(case)
+        self.differences = compare(self.expected, self.actual)
+
+    def __unicode__(self):
+        lines = ["%s differs on %r" % (self.engine.name, self.case)]
+        for name in self.differences:
+            lines.append("  %s: expected %r, got %r" %
+                         (name, self.expected[name], self.actual[name]))
+        return '\n'.join(lines)
+
+
+def checkEngines(cases=200, seed=None, names=None, maxActivities=40):
+    """
+    Runs the named engines (by default, all registered) on the given number of random
+    cases, comparing each with the reference engine.  Returns (mismatches, timings):
+    a list of Mismatch, at most one per engine, and a dict mapping each engine's name to
+    (cases run, activities in them, seconds taken).
+    """
+    rand = random.Random(seed)
+    reference = ENGINES['reference']
+    engines = [ENGINES[name] for name in (names or engineNames())]
+    timings = dict((engine.name, [0, 0, 0.0]) for engine in engines + [reference])
+    failing = {}
+
+    def timed(engine, case):
+        started = time.time()
+        result = engine.run(case)
+        timing = timings[engine.name]
+        timing[0] += 1
+        timing[1] += len(case.offsets)
+        timing[2] += time.time() - started
+        return result
+
+    for i in range(cases):
+        case = randomCase(rand, maxActivities)
+        expected = timed(reference, case)
+        for engine in engines:
+            if engine is reference or engine.name in failing or not engine.supports(case):
+                continue
+            if compare(expected, timed(engine, case)):
+                failing[engine.name] = case
+
+    mismatches = [Mismatch(ENGINES[name], case, shrink(ENGINES[name], case))
+                  for (name, case) in sorted(failing.items())]
+    return (mismatches, dict((name, tuple(timing)) for (name, timing) in timings.items()))
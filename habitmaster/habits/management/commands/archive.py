@@ -0,0 +1,47 @@
+"""
+Moves old activities out of the Activity table into each habit's archive, so that the
+table only holds recent history.  Streaks, summaries, and histories stay the same; see 
+Habit.archiveBefore.
+
+    manage.py archive --days 365
+    manage.py archive --before 2013-01-01
+"""
+
+from optparse import make_option
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from habitmaster.habits.models import Habit
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=365,
+            help='Archive activities older than this many days. [default: %default]'),
+        make_option('--before', default=None,
+            help='Archive activities before this day (YYYY-MM-DD) instead.'),
+    )
+    help = 'Archives the activities of every habit from before a cutoff date.'
+
+    def handle(self, *args, **options):
+        try:
+            if options['before']:
+                cutoff = datetime.datetime.strptime(options['before'], '%Y-%m-%d').date()
+            else:
+                cutoff = datetime.date.today() - datetime.timedelta(days=options['days'])
+        except ValueError:
+            raise CommandError("--before must be given as YYYY-MM-DD.")
+        if options['days'] < 0:
+            raise CommandError("--days cannot be negative.")
+
+        start = time.time()
+        habits = Habit.objects.filter(activity__date__lt=cutoff).distinct().order_by('id')
+        (habitCount, activityCount) = (0, 0)
+        for habit in habits.iterator():
+            archived = habit.archiveBefore(cutoff)
+            if archived:
+                habitCount += 1
+                activityCount += archived
+        self.stdout.write("Archived %d activities of %d habits from before %s in %.1fs." %
+                          (activityCount, habitCount, cutoff.isoformat(), time.time() - start))
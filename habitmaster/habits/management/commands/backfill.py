@@ -0,0 +1,58 @@
+"""
+Brings tables written by an older version up to date.  syncdb only creates missing 
+tables, so this adds the columns added to existing tables since (the mask of each 
+DaysOfWeekSchedule and the archived_until of each Habit) and then fills in those that 
+need it.  Run it once after upgrading, before serving requests; it is safe to run more 
+than once.
+
+    manage.py backfill
+"""
+
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from habitmaster.habits.models import DaysOfWeekSchedule, Habit
+
+# (model, field name) of each column added to a table that existed before it
+ADDED_COLUMNS = [
+    (DaysOfWeekSchedule, 'mask'),
+    (Habit, 'archived_until'),
+]
+
+
+def addColumn(model, name):
+    """ 
+    Adds the column of the given field of model, with any index, to the model's table if
+    it is not there yet.  Existing rows get the field's default.  Returns whether the 
+    column was added.
+    """
+    field = model._meta.get_field(name)
+    table = model._meta.db_table
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    # (rather than introspection, whose PRAGMA makes sqlite commit the transaction)
+    cursor.execute('SELECT * FROM %s WHERE 1 = 0' % qn(table))
+    if field.column in [column[0] for column in cursor.description]:
+        return False
+    definition = field.db_type(connection)
+    if field.null:
+        definition += ' NULL'
+    else:
+        definition += ' NOT NULL DEFAULT %d' % field.get_default()
+    cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (qn(table), qn(field.column), 
+                                                        definition))
+    for statement in connection.creation.sql_indexes_for_field(model, field, no_style()):
+        cursor.execute(statement)
+    transaction.commit_unless_managed()
+    return True
+
+
+class Command(BaseCommand):
+    help = 'Adds and fills in columns added since existing tables were created.'
+
+    def handle(self, *args, **options):
+        for (model, name) in ADDED_COLUMNS:
+            if addColumn(model, name):
+                self.stdout.write("Added column %s.%s." % (model._meta.db_table, name))
+        count = DaysOfWeekSchedule.backfillMasks()
+        self.stdout.write("Set the mask of %d days-of-week schedules." % count)
@@ -0,0 +1,68 @@
+"""
+Creates many habits for a user at once, from a JSON file (or standard input) listing
+them, or from templates named on the command line.  Prints the ids of the new habits.
+See HabitManager.createMany for what each habit is given as.
+
+    manage.py createhabits alice habits.json
+    manage.py createhabits alice --template "weekday workout" --template "every 3 days:Call home"
+    manage.py createhabits --list-templates
+"""
+
+from optparse import make_option
+import json
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from habitmaster.habits.models import Habit, HABIT_TEMPLATES
+
+
+class Command(BaseCommand):
+    args = '<username> [<file.json>|-]'
+    option_list = BaseCommand.option_list + (
+        make_option('--template', action='append', default=[],
+            help='Create a habit from this template, as NAME or NAME:TASK.  Repeatable.'),
+        make_option('--list-templates', action='store_true', default=False,
+            help='List the available templates and exit.'),
+    )
+    help = 'Creates habits for a user in bulk, from a JSON list of habits or templates.'
+
+    def handle(self, *args, **options):
+        if options['list_templates']:
+            for name in sorted(HABIT_TEMPLATES):
+                self.stdout.write("%s: %s" % (name, json.dumps(HABIT_TEMPLATES[name], 
+                                                               sort_keys=True)))
+            return
+        if not args or len(args) > 2:
+            raise CommandError("Usage: manage.py createhabits %s" % self.args)
+        try:
+            user = User.objects.get(username=args[0])
+        except User.DoesNotExist:
+            raise CommandError("No user named '%s'." % args[0])
+
+        specs = []
+        if len(args) > 1:
+            try:
+                if args[1] == '-':
+                    specs = json.load(sys.stdin)
+                else:
+                    with open(args[1]) as source:
+                        specs = json.load(source)
+            except (IOError, ValueError) as e:
+                raise CommandError("Could not read habits: %s" % e)
+            if isinstance(specs, dict):
+                specs = specs.get('habits')
+            if not isinstance(specs, list):
+                raise CommandError("Expected a JSON list of habits.")
+        for template in options['template']:
+            (name, _, task) = template.partition(':')
+            specs.append({'template': name, 'task': task or None})
+        if not specs:
+            raise CommandError("No habits given.")
+
+        try:
+            ids = Habit.objects.createMany(user, specs)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write("Created %d habits for %s: %s" % 
+                          (len(ids), user.username, ' '.join(str(i) for i in ids)))
@@ -0,0 +1,117 @@
+"""
+Writes the daily "do this today" digest for every user: the active habits whose next 
+required day is today and that have not been done yet today.
+
+The due habits are looked up through the due-date index (Habit.objects.dueOn), and their
+streaks come from the stored habit summaries, which are computed first for any habits
+that do not have one yet.  Users are handled a batch at a time,
+spread over several worker processes.  Digests go to one text file per user, or by email
+through the configured email backend.  Examples:
+
+    manage.py digest --outdir /tmp/digests
+    manage.py digest --email --workers 8 --date 2013-06-01
+"""
+
+from optparse import make_option
+import datetime
+import itertools
+import multiprocessing
+import os
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.template.loader import render_to_string
+from habitmaster.habits.models import Habit, loadSummaries
+
+SUBJECT = "HabitMaster: what to do today"
+
+
+def digestBatch(args):
+    """
+    Writes the digests of the users with ids in the given (inclusive) range.  Runs in a 
+    worker process, so takes a single tuple of arguments.  Returns (users with something
+    due, digests sent).
+    """
+    (firstId, lastId, today, outdir, email) = args
+    # dueOn counts a habit without a stored summary as due, so store the missing ones first
+    loadSummaries(Habit.objects.filter(active=True, user__id__range=(firstId, lastId), 
+                                       summary__isnull=True))
+    habits = Habit.objects.dueOn(today).filter(active=True, 
+                                               user__id__range=(firstId, lastId))
+    habits = loadSummaries(habits.select_related('user').order_by('user', 'id'))
+    users = 0
+    messages = []
+    for (user, userHabits) in itertools.groupby(habits, lambda habit: habit.user):
+        users += 1
+        due = [(habit, habit.summary.getCurrentStreakTimes(today)) for habit in userHabits]
+        text = render_to_string('habits/digest.txt', 
+                                {'user': user, 'habits': due, 'today': today})
+        if email:
+            if user.email:
+                messages.append(EmailMessage(SUBJECT, text, settings.DEFAULT_FROM_EMAIL,
+                                             [user.email]))
+        else:
+            with open(os.path.join(outdir, user.username + '.txt'), 'w') as out:
+                out.write(text.encode('utf-8'))
+            messages.append(text)
+    if email and messages:
+        get_connection().send_messages(messages)
+    return (users, len(messages))
+
+
+def _closeConnection():
+    # each worker must open its own database connection rather than share the parent's
+    connection.close()
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--date', default=None,
+            help='The day to write the digest for, as YYYY-MM-DD. [default: today]'),
+        make_option('--outdir', default=None,
+            help='Directory to write one <username>.txt digest per user into.'),
+        make_option('--email', action='store_true', default=False,
+            help='Email each digest through the configured email backend instead.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of users handled together. [default: %default]'),
+        make_option('--workers', type='int', default=multiprocessing.cpu_count(),
+            help='Number of worker processes. [default: %default]'),
+    )
+    help = ('Writes or emails each user a digest of the habits they need to do today.')
+
+    def handle(self, *args, **options):
+        if bool(options['outdir']) == options['email']:
+            raise CommandError("Give exactly one of --outdir or --email.")
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError("--batch-size and --workers must be positive.")
+        try:
+            today = datetime.date.today()
+            if options['date']:
+                today = datetime.datetime.strptime(options['date'], '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError("--date must be given as YYYY-MM-DD.")
+        if options['outdir'] and not os.path.isdir(options['outdir']):
+            os.makedirs(options['outdir'])
+
+        start = time.time()
+        userIds = Habit.objects.filter(active=True).order_by('user')
+        userIds = list(userIds.values_list('user', flat=True).distinct())
+        batches = [(ids[0], ids[-1], today, options['outdir'], options['email']) 
+                   for ids in (userIds[i:i + options['batch_size']] 
+                               for i in range(0, len(userIds), options['batch_size']))]
+        if options['workers'] == 1 or len(batches) < 2:
+            results = [digestBatch(batch) for batch in batches]
+        else:
+            _closeConnection()
+            pool = multiprocessing.Pool(options['workers'], initializer=_closeConnection)
+            try:
+                results = pool.map(digestBatch, batches, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        self.stdout.write("Wrote %d digests for %d users with habits due in %.1fs." % 
+                          (sum(sent for (users, sent) in results), 
+                           sum(users for (users, sent) in results), time.time() - start))
@@ -0,0 +1,273 @@
+"""
+Load generator: seeds a database with synthetic users, habits, and activity history,
+then replays concurrent user sessions through the real URL routes and reports latency,
+throughput, and error rates per route.
+
+By default, everything runs against a throwaway test database, so no outside services
+are needed and the configured database is left untouched.  Example:
+
+    manage.py loadtest --users 2000 --sessions 500 --concurrency 8 --think 0.2
+"""
+
+from optparse import make_option
+import datetime
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from Queue import Queue, Empty
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection, connections, transaction
+from django.test.client import Client
+from habitmaster.habits.models import DaysOfWeekSchedule, IntervalSchedule, Habit, Activity
+from habitmaster.habits.models import loadSummaries
+
+# every synthetic user shares this password, so it only needs to be hashed once
+PASSWORD = 'loadtest'
+
+# the routes exercised, in the order they are reported
+ROUTES = ('login', 'index', 'habit', 'activity_create', 'habits_create')
+
+
+def percentile(values, pct):
+    """
+    Returns the given percentile (0 to 100) of a sorted list of values, using the
+    nearest-rank method.  Returns None for an empty list.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class RouteStats(object):
+    """ Thread-safe collection of request timings, grouped by route name. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = dict((route, []) for route in ROUTES)
+        self.errors = dict((route, 0) for route in ROUTES)
+
+    def record(self, route, seconds, ok):
+        with self.lock:
+            self.times[route].append(seconds)
+            if not ok:
+                self.errors[route] += 1
+
+    def total(self):
+        return sum(len(times) for times in self.times.values())
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=1000,
+            help='Number of synthetic users to seed. [default: %default]'),
+        make_option('--habits', type='int', default=5,
+            help='Habits per synthetic user. [default: %default]'),
+        make_option('--days', type='int', default=90,
+            help='Days of activity history per habit. [default: %default]'),
+        make_option('--sessions', type='int', default=200,
+            help='Number of user sessions to replay. [default: %default]'),
+        make_option('--concurrency', type='int', default=8,
+            help='Number of sessions run at once. [default: %default]'),
+        make_option('--think', type='float', default=0.5,
+            help='Mean think time in seconds between requests of a session. '
+                 '[default: %default]'),
+        make_option('--seed', type='int', default=None,
+            help='Random seed, for repeatable runs.'),
+        make_option('--current-db', action='store_true', dest='current_db', default=False,
+            help='Seed and run against the configured database rather than a '
+                 'throwaway test database.'),
+    )
+    help = ('Seeds synthetic users and habits, replays concurrent sessions through the '
+            'site\'s URL routes, and reports per-route latency percentiles, throughput, '
+            'and error rates.')
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['sessions'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--users, --sessions, and --concurrency must all be positive.")
+        self.random = random.Random(options['seed'])
+
+        # queries are otherwise logged for every request when DEBUG is on
+        debug = settings.DEBUG
+        allowedHosts = settings.ALLOWED_HOSTS
+        settings.DEBUG = False
+        settings.ALLOWED_HOSTS = list(allowedHosts) + ['testserver']
+        oldName = None
+        dbFile = None
+        mirrors = {}
+        try:
+            if not options['current_db']:
+                if connection.vendor == 'sqlite':
+                    # an in-memory test db would not be shared between worker threads
+                    (fd, dbFile) = tempfile.mkstemp(suffix='.db')
+                    os.close(fd)
+                    connection.settings_dict['TEST_NAME'] = dbFile
+                oldName = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+                mirrors = self.mirrorReplicas()
+
+            start = time.time()
+            usernames = self.seed(options['users'], options['habits'], options['days'])
+            self.stdout.write("Seeded %d users with %d habits each in %.1fs." %
+                              (len(usernames), options['habits'], time.time() - start))
+
+            stats = RouteStats()
+            start = time.time()
+            self.replay(usernames, stats, options['sessions'], options['concurrency'],
+                        options['think'])
+            self.report(stats, time.time() - start)
+        finally:
+            settings.DEBUG = debug
+            settings.ALLOWED_HOSTS = allowedHosts
+            if oldName is not None:
+                connection.creation.destroy_test_db(oldName, verbosity=0)
+            for (alias, name) in mirrors.items():
+                connections[alias].close()
+                connections[alias].settings_dict['NAME'] = name
+            if dbFile and os.path.exists(dbFile):
+                os.remove(dbFile)
+
+    def mirrorReplicas(self):
+        """
+        Points the database replicas at the throwaway test database, as the test runner
+        does.  Returns the original database names of the replicas.
+        """
+        names = {}
+        for alias in settings.DATABASE_REPLICAS:
+            names[alias] = connections[alias].settings_dict['NAME']
+            connections[alias].close()
+            connections[alias].settings_dict['NAME'] = connection.settings_dict['NAME']
+        return names
+
+    @transaction.commit_on_success
+    def seed(self, userCount, habitCount, days):
+        """
+        Creates the synthetic users, habits, and activities, and the habits' stored
+        summaries (which bulk_create skips), so that the first requests of each user do
+        not pay for working them out.  Returns the list of usernames.
+        """
+        prefix = 'load%d_' % int(time.time())
+        password = make_password(PASSWORD)
+        usernames = [prefix + str(i) for i in range(userCount)]
+        User.objects.bulk_create([User(username=name, password=password)
+                                  for name in usernames])
+        users = list(User.objects.filter(username__startswith=prefix))
+
+        # a small pool of schedules, as most users pick one of a few common ones
+        schedules = [DaysOfWeekSchedule.objects.create(days=days_)
+                     for days_ in ('1111111', '1111100', '1010100', '0000011')]
+        schedules += [IntervalSchedule.objects.create(interval=i) for i in (1, 2, 3, 7)]
+
+        habits = []
+        for user in users:
+            for i in range(habitCount):
+                habits.append(Habit(user=user, task='Synthetic habit ' + str(i),
+                                    schedule=self.random.choice(schedules), active=True))
+        Habit.objects.bulk_create(habits)
+
+        # each habit gets its own adherence rate, so streaks vary in length
+        today = datetime.date.today()
+        activities = []
+        for habit in Habit.objects.filter(user__in=users).values_list('id', flat=True):
+            adherence = self.random.uniform(0.3, 1.0)
+            for offset in range(days, 0, -1):
+                if self.random.random() < adherence:
+                    activities.append(Activity(habit_id=habit,
+                                               date=today - datetime.timedelta(offset)))
+            if len(activities) > 5000:
+                Activity.objects.bulk_create(activities)
+                activities = []
+        Activity.objects.bulk_create(activities)
+
+        habits = Habit.objects.filter(user__in=users).order_by('id')
+        for i in range(0, len(users) * habitCount, 500):
+            loadSummaries(habits[i:i + 500])
+        return usernames
+
+    def replay(self, usernames, stats, sessionCount, concurrency, think):
+        """
+        Runs the given number of sessions, drawn from the given users, concurrency at a time.
+        """
+        queue = Queue()
+        for i in range(sessionCount):
+            queue.put(self.random.choice(usernames))
+
+        def worker(rand, threaded=True):
+            while True:
+                try:
+                    username = queue.get_nowait()
+                except Empty:
+                    break
+                self.session(username, stats, think, rand)
+            if threaded:
+                connection.close()
+
+        if concurrency == 1:
+            # run inline, so that the session sees any uncommitted data of the caller
+            worker(random.Random(self.random.random()), threaded=False)
+            return
+        threads = [threading.Thread(target=worker, args=(random.Random(self.random.random()),))
+                   for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def session(self, username, stats, think, rand):
+        """
+        Replays one realistic visit: log in, look over the habits, check on a couple of
+        them, record what was done today, and occasionally start a new habit.
+        """
+        client = Client()
+
+        def request(route, method, path, data=None, succeeded=None):
+            if think > 0:
+                time.sleep(rand.expovariate(1.0 / think))
+            start = time.time()
+            try:
+                response = getattr(client, method)(path, data or {})
+                ok = (succeeded or (lambda response: response.status_code < 400))(response)
+            except Exception:
+                response = None
+                ok = False
+            stats.record(route, time.time() - start, ok)
+            return response
+
+        # a failed login shows the form again, with a 200
+        request('login', 'post', reverse('login'),
+                {'username': username, 'password': PASSWORD},
+                lambda response: response.status_code == 302 and 
+                                 settings.SESSION_COOKIE_NAME in client.cookies)
+        request('index', 'get', reverse('index'))
+        habits = list(Habit.objects.filter(user__username=username).values_list('id', flat=True))
+        for habit in rand.sample(habits, min(len(habits), 2)):
+            request('habit', 'get', reverse('habit', kwargs={'habit_id': habit}))
+        if habits:
+            request('activity_create', 'post', reverse('activity_create'),
+                    {'habit': rand.choice(habits)})
+        if rand.random() < 0.1:
+            request('habits_create', 'post', reverse('habits_create'),
+                    {'task': 'New habit', 'schedule': 'fixed', 'interval': rand.randint(1, 7)})
+        request('index', 'get', reverse('index'))
+
+    def report(self, stats, elapsed):
+        self.stdout.write("%d requests in %.1fs: %.1f requests/s" %
+                          (stats.total(), elapsed, stats.total() / elapsed))
+        self.stdout.write("%-16s %7s %7s %7s %9s %9s %9s %9s" %
+            ('route', 'count', 'errors', 'err %', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+        for route in ROUTES:
+            times = sorted(stats.times[route])
+            if not times:
+                continue
+            errors = stats.errors[route]
+            self.stdout.write("%-16s %7d %7d %7.1f %9.1f %9.1f %9.1f %9.1f" %
+                (route, len(times), errors, 100.0 * errors / len(times),
+                 percentile(times, 50) * 1000, percentile(times, 95) * 1000,
+                 percentile(times, 99) * 1000, len(times) / elapsed))
@@ -0,0 +1,32 @@
+"""
+Deletes the idempotency keys (see IdempotencyKey) that clients sent with requests to
+record activities, once they are too old for any retry to still be coming.
+
+    manage.py purgekeys
+    manage.py purgekeys --days 1
+"""
+
+from optparse import make_option
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from habitmaster.habits.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=None,
+            help='Delete keys older than this many days. [default: IDEMPOTENCY_KEY_DAYS]'),
+    )
+    help = 'Deletes idempotency keys older than the retention window.'
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = settings.IDEMPOTENCY_KEY_DAYS
+        if days < 0:
+            raise CommandError("--days cannot be negative.")
+        count = IdempotencyKey.objects.purge(timezone.now() - datetime.timedelta(days=days))
+        self.stdout.write("Deleted %d idempotency keys older than %d days." % (count, days))
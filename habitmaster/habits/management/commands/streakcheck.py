@@ -0,0 +1,70 @@
+"""
+Checks every registered streak engine against the reference engine on random cases,
+printing the smallest case found for each engine that disagrees, and compares how fast
+the engines are.  See habitmaster.habits.engines.
+
+Runs against a throwaway test database, since the engines save their cases.  Example:
+
+    manage.py streakcheck --cases 500 --seed 1
+    manage.py streakcheck --engines stored,repaired
+"""
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from habitmaster.habits.engines import ENGINES, checkEngines, engineNames
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--cases', type='int', default=200,
+            help='Number of random cases to run. [default: %default]'),
+        make_option('--seed', type='int', default=None,
+            help='Random seed, for repeatable runs.'),
+        make_option('--engines', default=None,
+            help='Comma-separated names of the engines to check. [default: all of %s]' %
+                 ', '.join(engineNames())),
+        make_option('--max-activities', type='int', dest='max_activities', default=40,
+            help='Most activities in a case. [default: %default]'),
+    )
+    help = ('Compares the streak engines with the reference engine on random cases, and '
+            'reports any differences and each engine\'s throughput.')
+
+    def handle(self, *args, **options):
+        names = None
+        if options['engines']:
+            names = [name.strip() for name in options['engines'].split(',')]
+            unknown = [name for name in names if name not in ENGINES]
+            if unknown:
+                raise CommandError("Unknown engines: %s" % ', '.join(unknown))
+        if options['cases'] < 1 or options['max_activities'] < 0:
+            raise CommandError("--cases must be positive and --max-activities not negative.")
+
+        # queries are otherwise logged when DEBUG is on
+        debug = settings.DEBUG
+        settings.DEBUG = False
+        oldName = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            (mismatches, timings) = checkEngines(options['cases'], options['seed'], names,
+                                                 options['max_activities'])
+        finally:
+            connection.creation.destroy_test_db(oldName, verbosity=0)
+            settings.DEBUG = debug
+
+        self.stdout.write("%-10s %6s %10s %9s %12s" % 
+                          ('engine', 'cases', 'activities', 'cases/s', 'activities/s'))
+        for name in engineNames():
+            if name not in timings:
+                continue
+            (cases, activities, seconds) = timings[name]
+            seconds = max(seconds, 1e-9)
+            self.stdout.write("%-10s %6d %10d %9.1f %12.1f" % 
+                              (name, cases, activities, cases / seconds, activities / seconds))
+        for mismatch in mismatches:
+            self.stdout.write(unicode(mismatch))
+        if mismatches:
+            raise CommandError("%d engines differ from the reference engine." % 
+                               len(mismatches))
+        self.stdout.write("All engines agree with the reference engine.")
@@ -1,7 +1,15 @@
-from django.db import models
+from django.db import DatabaseError, connections, models, transaction
+from django.db.models import Min, Q
 from django.contrib.auth.models import User
 from django.core.validators import RegexValidator, MaxValueValidator, MinValueValidator
+from habitmaster import metrics
+from habitmaster.routers import primary
+import base64
+import bisect
+import collections
 import datetime
+import json
+import time
 
 # useful streak-processing functions
     
@@ -21,6 +29,85 @@ def daysInStreak(streak, until=None):
         return (streak[-1].date - streak[0].date).days + 1
 
 
+def starLevelIndex(recentDays, pastDays):
+    """
+    Returns the index into Habit.STAR_LEVELS earned by an active habit, given the number
+    of days in its most recent streak (until today) and in the streak before that.
+    """
+    if recentDays > 28:
+        return 3  # gold
+    elif recentDays > 14:
+        if pastDays > 28:
+            return 3  # returned to gold from silver
+        else:
+            return 2  # just silver
+    else:
+        if pastDays > 28:
+            return 2  # silver because of recent gold lapse
+        else:
+            return 1  # bronze
+
+
+def repairStreaks(schedule, spans, changed, loadActivities):
+    """
+    Works out which stored streaks change when the activities on the given dates change,
+    recomputing only the streak containing the earliest changed date and those after it
+    up to the first stored streak that still starts where it did.
+    
+    spans is the list of stored Streaks before the change, in order.  loadActivities is
+    called as loadActivities(since, until) and must return the current (sorted, non-missed)
+    activities between those dates, inclusive; either may be None for no limit.
+    
+    Returns a tuple (first, last, fresh), meaning that spans[first:last] should be replaced
+    by the list of unsaved Streaks in fresh.
+    
+    This relies on the start of every streak being a fresh start for the schedule: nothing
+    before it affects the streaks that follow.
+    """
+    earliest = min(changed)
+    latest = max(changed)
+    
+    # start from the streak before the earliest change, backing up past any streaks that 
+    # share a date, since those cannot be loaded separately
+    first = 0
+    while first < len(spans) and spans[first].start < earliest:
+        first += 1
+    first = max(first - 1, 0)
+    while first > 0 and spans[first - 1].end >= spans[first].start:
+        first -= 1
+    since = spans[first].start if first < len(spans) and spans[first].start < earliest else None
+    if since is None:
+        first = 0
+
+    # then find a later streak that still starts a streak once replayed to its first day
+    last = first
+    while last < len(spans) and (spans[last].start <= latest or 
+                                 last > 0 and spans[last - 1].end >= spans[last].start):
+        last += 1
+    while last < len(spans):
+        until = spans[last].start
+        activities = loadActivities(since, until)
+        streaks = schedule.getStreaks(activities, until)
+        # with several activities on that day, more than one streak can start there, and
+        # all of them are stored from spans[last] on
+        kept = len(streaks)
+        while kept > 0 and streaks[kept - 1] and streaks[kept - 1][0].date == until:
+            kept -= 1
+        if kept < len(streaks) and (kept == 0 or streaks[kept - 1][-1].date < until):
+            return (first, last, [Streak.fromActivities(streak) for streak in streaks[:kept]])
+        last += 1
+        while last < len(spans) and spans[last - 1].end >= spans[last].start:
+            last += 1
+
+    # no later streak survived, so replay everything to the end
+    activities = loadActivities(since, None)
+    fresh = []
+    if activities:
+        streaks = schedule.getStreaks(activities, activities[-1].date)
+        fresh = [Streak.fromActivities(streak) for streak in streaks]
+    return (first, len(spans), fresh)
+
+
 class Schedule(models.Model):
     
     """
@@ -68,6 +155,42 @@ class Schedule(models.Model):
         """
         inst = self.cast()
         return inst.nextRequiredDay(streak, today) if inst else None
+
+    def streakDeadline(self, lastDate):
+        """
+        Given the date of the last activity of a streak, returns the last day on which
+        that streak is still the current streak.  After this day, getStreaks would append
+        an empty current streak instead.
+        
+        ABSTRACT: Must be overridden. Currently returns None.
+        """
+        inst = self.cast()
+        return inst.streakDeadline(lastDate) if inst else None
+
+    def streakDueDate(self, startDate, lastDate):
+        """
+        Given the dates of the first and last activities of an ongoing streak, returns
+        the next required day of that streak, if it can be known without knowing today.
+        (This is what HabitSummary stores so that due habits can be looked up by date.)
+        
+        ABSTRACT: Must be overridden. Currently returns None.
+        """
+        inst = self.cast()
+        return inst.streakDueDate(startDate, lastDate) if inst else None
+
+    def summarizeStreak(self, startDate, lastDate, loadRecent):
+        """
+        Given the dates of the first and last activities of a habit's current streak (as of
+        its last activity), returns the (deadline, due date) that HabitSummary stores for
+        it: see streakDeadline and streakDueDate.  Schedules that need more of the streak
+        than its ends can call loadRecent(n) for the dates of its last n activities.
+        """
+        if type(self) is Schedule:
+            inst = self.cast()
+            if not inst:
+                return (None, None)
+            return inst.summarizeStreak(startDate, lastDate, loadRecent)
+        return (self.streakDeadline(lastDate), self.streakDueDate(startDate, lastDate))
     
     def cast(self):
         """
@@ -77,6 +200,7 @@ class Schedule(models.Model):
         Its code will need to be updated if you extend Schedule in a new subclass.
         """
         # XXX: Just listed the subtypes explicitly rather than using scalable reflection
+        metrics.increment('schedule.cast')
         inst = None
         if not inst:
             try:
@@ -88,6 +212,11 @@ class Schedule(models.Model):
                 inst = DaysOfWeekSchedule.objects.get(schedule_ptr_id=self.id)
             except DaysOfWeekSchedule.DoesNotExist:
                 pass
+        if not inst:
+            try:
+                inst = GoalSchedule.objects.get(schedule_ptr_id=self.id)
+            except GoalSchedule.DoesNotExist:
+                pass
         return inst
         
         
@@ -100,6 +229,40 @@ class DaysOfWeekSchedule(Schedule):
     
     days = models.CharField(max_length=7, 
             validators=[RegexValidator(r'[01]{7}', "Value must be seven 0s or 1s")])
+    # days as a bitmask, with bit i set if weekday i (Monday is 0) is required; kept in
+    # step with days on save, and 0 in rows saved before it was added (see backfillMasks)
+    mask = models.IntegerField(default=0, db_index=True)
+
+    def save(self, *args, **kwargs):
+        self.mask = self.asMask(self.days)
+        super(DaysOfWeekSchedule, self).save(*args, **kwargs)
+
+    @staticmethod
+    def asMask(days):
+        """ Returns the bitmask for the given days string. """
+        return sum(1 << i for (i, day) in enumerate(days) if day == '1')
+
+    @staticmethod
+    def asDays(mask):
+        """ Returns the days string for the given bitmask. """
+        return ''.join('1' if mask & (1 << i) else '0' for i in range(7))
+
+    @staticmethod
+    def masksWith(weekday):
+        """ Returns every possible mask that includes the given weekday (Monday is 0). """
+        return [mask for mask in range(1 << 7) if mask & (1 << weekday)]
+
+    @classmethod
+    def backfillMasks(cls):
+        """
+        Sets the mask of every schedule saved without one (before the column was added),
+        one UPDATE for each distinct days.  Returns how many schedules were updated.
+        """
+        count = 0
+        missing = cls.objects.filter(mask=0)
+        for days in missing.values_list('days', flat=True).distinct():
+            count += missing.filter(days=days).update(mask=cls.asMask(days))
+        return count
 
     def asNames(self):
         """ 
@@ -146,6 +309,8 @@ class DaysOfWeekSchedule(Schedule):
         return DateIter(self.days, date)
     
     def getStreaks(self, activities, today=None):
+        metrics.increment('streaks.calls')
+        metrics.observe('streaks.activities_scanned', len(activities))
         if not activities:
             return [[]]  # on current empty streak
         if not today:
@@ -153,6 +318,7 @@ class DaysOfWeekSchedule(Schedule):
         
         streaks = []
         streak = []
+        started = time.time()
         reqDays = self.iterFromDate(activities[0].date)
         i = 0 
         for req in reqDays:  # infinite loop
@@ -182,6 +348,8 @@ class DaysOfWeekSchedule(Schedule):
                 streak.append(activities[i])
                 i += 1                  
                 
+        metrics.observe('schedule.iterate_seconds', time.time() - started, 
+                        metrics.SECONDS_BUCKETS)
         return streaks
             
     def nextRequiredDay(self, streak, today=None):
@@ -200,6 +368,14 @@ class DaysOfWeekSchedule(Schedule):
                 return reqDays.next()
             else:
                 return todo 
+
+    def streakDeadline(self, lastDate):
+        # the streak lapses once the first required day after its last activity passes
+        return self.iterFromDate(lastDate + datetime.timedelta(days=1)).next()
+
+    def streakDueDate(self, startDate, lastDate):
+        # required days are fixed by the schedule and found through mask instead
+        return None
            
         
 class IntervalSchedule(Schedule):
@@ -216,6 +392,8 @@ class IntervalSchedule(Schedule):
 
         
     def getStreaks(self, activities, today=None):
+        metrics.increment('streaks.calls')
+        metrics.observe('streaks.activities_scanned', len(activities))
         if not activities:
             return [[]]  # on current empty streak
         if not today:
@@ -269,8 +447,330 @@ class IntervalSchedule(Schedule):
         extraDays = span.days % self.interval
         tilReq = self.interval - extraDays
         return streak[-1].date + datetime.timedelta(days=tilReq)
+
+    def streakDeadline(self, lastDate):
+        return lastDate + datetime.timedelta(days=self.interval)
+
+    def streakDueDate(self, startDate, lastDate):
+        return self.nextRequiredDay([Activity(date=startDate), Activity(date=lastDate)],
+                                    today=lastDate)
         
         
+def goalDeadline(startDate, recent, times, period):
+    """
+    Returns the last day on which a goal streak (see GoalSchedule) that started on the
+    given date is still ongoing without another activity, given the dates of (up to) its
+    last `times` activities, in order: the day that the window after the activity `times`
+    back from the last runs out, or for a streak of fewer activities, the window from its
+    first day.
+    """
+    if len(recent) < times:
+        return startDate + datetime.timedelta(days=period - 1)
+    return recent[-times] + datetime.timedelta(days=period)
+
+
+class RollingWindow(object):
+    """
+    A goal streak (see GoalSchedule) being built up one activity at a time, in order.  Only
+    the dates of the streak's last few activities are kept in view, sliding along as each
+    activity is added, so that each one takes constant time.  Can be resumed from an
+    existing streak to add more activities to it.
+    """
+
+    def __init__(self, times, period, streak=()):
+        self.times = times
+        self.period = period
+        self.streak = list(streak)
+        # the dates of (up to) the last `times` activities of the streak
+        self.recent = collections.deque([act.date for act in self.streak[-times:]], times)
+
+    def deadline(self):
+        """ The goalDeadline of the streak so far, or None if it is empty. """
+        if not self.streak:
+            return None
+        return goalDeadline(self.streak[0].date, self.recent, self.times, self.period)
+
+    def add(self, act):
+        """
+        Adds the next activity.  If that is past the deadline, it starts a new streak, and
+        the finished streak is returned; otherwise returns None.
+        """
+        finished = None
+        if self.streak and act.date > self.deadline():
+            finished = self.streak
+            self.streak = []
+            self.recent.clear()
+        self.streak.append(act)
+        self.recent.append(act.date)
+        return finished
+
+
+class GoalSchedule(Schedule):
+    """
+    The habit must be exercised at least a number of times a week or a month, on any
+    days: every window of that many days (7, or 30 for a month) within a streak must have
+    that many activities.  A window starts the day after any activity of the streak, or
+    on its first day, and the streak lapses when one ends without enough.
+
+    Streaks are worked out with a RollingWindow, in time linear in the activities.
+    """
+    PERIODS = ((7, 'week'), (30, 'month'))
+
+    times = models.IntegerField(validators=[MinValueValidator(1), MaxValueValidator(30)])
+    period = models.IntegerField(choices=PERIODS, default=7)
+
+    def __unicode__(self):
+        if self.times == 1:
+            count = 'Once'
+        elif self.times == 2:
+            count = 'Twice'
+        else:
+            count = str(self.times) + ' times'
+        return count + ' a ' + dict(self.PERIODS).get(self.period, '%d days' % self.period)
+
+    def getStreaks(self, activities, today=None):
+        metrics.increment('streaks.calls')
+        metrics.observe('streaks.activities_scanned', len(activities))
+        if not today:
+            today = datetime.date.today()
+        streaks = []
+        window = RollingWindow(self.times, self.period)
+        for act in activities:
+            finished = window.add(act)
+            if finished:
+                streaks.append(finished)
+        streaks.append(window.streak)  # last streak (may be empty)
+        if window.streak and today > window.deadline():
+            streaks.append([])  # lapsed, so now on an empty current streak
+        return streaks
+
+    def nextRequiredDay(self, streak, today=None):
+        """ The last day for another activity that keeps the streak going. """
+        if not today:
+            today = datetime.date.today()
+        if not streak:
+            return today
+        return RollingWindow(self.times, self.period, streak).deadline()
+
+    def streakDeadline(self, lastDate):
+        """ 
+        Only the latest the deadline could be, given just the last date: see 
+        summarizeStreak for the actual one. 
+        """
+        return lastDate + datetime.timedelta(days=self.period)
+
+    def streakDueDate(self, startDate, lastDate):
+        # needs more than the ends of the streak; see summarizeStreak
+        return None
+
+    def summarizeStreak(self, startDate, lastDate, loadRecent):
+        recent = loadRecent(self.times) if self.times > 1 else [lastDate]
+        deadline = goalDeadline(startDate, recent, self.times, self.period)
+        # the next activity is due by the deadline itself
+        return (deadline, deadline)
+
+
+# Ready-made habits for HabitManager.createMany, by name.  Each gives a schedule, as days
+# (for a DaysOfWeekSchedule), an interval (for an IntervalSchedule), or times per week or
+# month (for a GoalSchedule), and maybe a task.
+HABIT_TEMPLATES = {
+    'daily': {'interval': 1},
+    'every 2 days': {'interval': 2},
+    'every 3 days': {'interval': 3},
+    'weekly': {'interval': 7},
+    'weekdays': {'days': '1111100'},
+    'weekends': {'days': '0000011'},
+    'mon-wed-fri': {'days': '1010100'},
+    'weekday workout': {'task': 'Work out', 'days': '1111100'},
+    'daily reading': {'task': 'Read', 'interval': 1},
+    'twice a week': {'times': 2, 'per': 'week'},
+    '3 times a week': {'times': 3, 'per': 'week'},
+    'weekly workout goal': {'task': 'Work out', 'times': 3, 'per': 'week'},
+    'monthly': {'times': 1, 'per': 'month'},
+}
+
+
+class HabitManager(models.Manager):
+
+    def createMany(self, user, specs):
+        """
+        Creates habits for the given user, one for each of the given specs: dicts with a
+        'task' and either 'days' (seven 0s and 1s, Monday first), 'interval' (1 to 7), or
+        'times' 'per' 'week' or 'month', or the name of a 'template' from HABIT_TEMPLATES
+        to take any of those from.
+        Returns the ids of the new habits, in the same order.
+
+        Habits with the same schedule share one Schedule, reusing an existing one if
+        there is any, and the habits (with their empty summaries) are inserted in bulk,
+        all in one transaction.  Raises ValueError, creating nothing, if any spec is
+        invalid.
+        """
+        schedules = []
+        for (i, spec) in enumerate(specs):
+            try:
+                schedules.append(self._parseSpec(spec))
+            except ValueError as e:
+                raise ValueError("Habit %d: %s" % (i + 1, e))
+        if not schedules:
+            return []
+
+        with transaction.commit_on_success(using=self.db):
+            # keep the user's other habits from being created at the same time, so the
+            # new ones are the user's habits with the highest ids
+            User.objects.using(self.db).filter(id=user.id).update(
+                last_login=models.F('last_login'))
+            byKey = self._sharedSchedules(set(key for (task, key) in schedules))
+            previous = self.filter(user=user).aggregate(models.Max('id'))['id__max'] or 0
+            # XXX: For now... design suggests that we should start with pending
+            self.bulk_create([Habit(user=user, task=task, schedule_id=byKey[key], 
+                                    active=True) for (task, key) in schedules])
+            ids = self._readBack(user, previous, [(task, byKey[key]) 
+                                                  for (task, key) in schedules])
+            summaries = [HabitSummary(habit_id=habitId) for habitId in ids]
+            for summary in summaries:
+                summary.summarize([])
+            HabitSummary.objects.using(self.db).bulk_create(summaries)
+            ChangeLog.objects.db_manager(self.db).record(
+                user.id, [(ChangeLog.HABIT, habitId) for habitId in ids])
+        return ids
+
+    def _readBack(self, user, previous, created):
+        """
+        Returns the ids of the habits just bulk-created for the user (with ids above
+        previous), given as a list of (task, schedule id) in order.  A habit saved some
+        other way at the same time (not under the user's lock) can have an id in the same
+        range, so each is matched by task and schedule, in id order.  Raises DatabaseError
+        (rolling back) if they cannot all be told apart.
+        """
+        rows = self.filter(user=user, id__gt=previous, summary__isnull=True).order_by('id')
+        rows = list(rows.values_list('id', 'task', 'schedule_id'))
+        ids = []
+        for (task, scheduleId) in created:
+            while rows and rows[0][1:] != (task, scheduleId):
+                rows.pop(0)
+            if not rows:
+                break
+            ids.append(rows.pop(0)[0])
+        if len(ids) != len(created):
+            raise DatabaseError("Could not find the %d habits just created." % len(created))
+        return ids
+
+    @staticmethod
+    def _parseSpec(spec):
+        """ 
+        Returns (task, scheduleKey) for a spec given to createMany, where scheduleKey is
+        ('days', days), ('interval', interval), or ('goal', (times, period)). 
+        """
+        if spec.get('template'):
+            if spec['template'] not in HABIT_TEMPLATES:
+                raise ValueError("Unknown template '%s'." % spec['template'])
+            template = dict(HABIT_TEMPLATES[spec['template']])
+            if any(spec.get(name) is not None for name in ('days', 'interval', 'times')):
+                # a schedule given with the template replaces the template's
+                for name in ('days', 'interval', 'times', 'per'):
+                    template.pop(name, None)
+            template.update((name, value) for (name, value) in spec.items() 
+                            if value is not None)
+            spec = template
+        task = (spec.get('task') or '').strip()
+        if not task:
+            raise ValueError("No task was given.")
+        if len(task) > Habit._meta.get_field('task').max_length:
+            raise ValueError("The task is too long.")
+        if spec.get('days') is not None:
+            days = str(spec['days'])
+            if len(days) != 7 or set(days) - set('01') or '1' not in days:
+                raise ValueError("Days must be seven 0s or 1s, with at least one 1.")
+            return (task, ('days', days))
+        if spec.get('interval') is not None:
+            try:
+                interval = int(spec['interval'])
+            except (TypeError, ValueError):
+                interval = 0
+            if not 1 <= interval <= 7:
+                raise ValueError("The interval must be from 1 to 7 days.")
+            return (task, ('interval', interval))
+        if spec.get('times') is not None:
+            periods = dict((name, days) for (days, name) in GoalSchedule.PERIODS)
+            if spec.get('per') not in periods:
+                raise ValueError("Times must be given per week or per month.")
+            period = periods[spec['per']]
+            try:
+                times = int(spec['times'])
+            except (TypeError, ValueError):
+                times = 0
+            if not 1 <= times <= period:
+                raise ValueError("Times per %s must be from 1 to %d." % (spec['per'], period))
+            return (task, ('goal', (times, period)))
+        raise ValueError("No schedule (days, interval, or times) was given.")
+
+    def _sharedSchedules(self, keys):
+        """ 
+        Returns a dict mapping each of the given schedule keys (see _parseSpec) to the id
+        of a Schedule for it, creating those that do not exist yet.
+        """
+        # one row per distinct schedule: the lowest id of each, however many duplicates
+        byKey = {}
+        days = [value for (kind, value) in keys if kind == 'days']
+        rows = (DaysOfWeekSchedule.objects.using(self.db).filter(days__in=days)
+                .order_by().values_list('days').annotate(Min('schedule_ptr')))
+        byKey.update((('days', value), id) for (value, id) in rows)
+        intervals = [value for (kind, value) in keys if kind == 'interval']
+        rows = (IntervalSchedule.objects.using(self.db).filter(interval__in=intervals)
+                .order_by().values_list('interval').annotate(Min('schedule_ptr')))
+        byKey.update((('interval', value), id) for (value, id) in rows)
+        goals = [value for (kind, value) in keys if kind == 'goal']
+        rows = (GoalSchedule.objects.using(self.db)
+                .filter(times__in=[times for (times, period) in goals], 
+                        period__in=[period for (times, period) in goals])
+                .order_by().values_list('times', 'period').annotate(Min('schedule_ptr')))
+        byKey.update((('goal', (times, period)), id) for (times, period, id) in rows
+                     if (times, period) in goals)
+        # (multi-table models like these cannot be bulk-created)
+        for key in sorted(keys - set(byKey)):
+            if key[0] == 'days':
+                schedule = DaysOfWeekSchedule(days=key[1])
+            elif key[0] == 'interval':
+                schedule = IntervalSchedule(interval=key[1])
+            else:
+                schedule = GoalSchedule(times=key[1][0], period=key[1][1])
+            schedule.save(using=self.db)
+            byKey[key] = schedule.id
+        return byKey
+
+    def lock(self, habitId):
+        """
+        Locks the given habit's row (in SQLite, the whole database) until the current
+        transaction ends, so that changes to its activities, streaks, and summary are
+        made one at a time.  This is an UPDATE, since SQLite ignores SELECT ... FOR UPDATE.
+        Returns the habit's archived_until, as read once it is locked.
+        """
+        self.filter(id=habitId).update(archived_until=models.F('archived_until'))
+        return self.filter(id=habitId).values_list('archived_until', flat=True)[0]
+
+    def dueOn(self, date):
+        """
+        Returns the habits whose next required day is the given date (today or later), and
+        that are not yet done that day: what Habit.nextRequiredDay would say, but in one
+        query using the DaysOfWeekSchedule masks and the HabitSummary due dates.  Habits
+        with no stored summary yet are taken to be due.
+        """
+        notDone = (Q(summary__last_date__lt=date) | Q(summary__last_date__gt=date) |
+                   Q(summary__last_date__isnull=True))
+        masks = DaysOfWeekSchedule.masksWith(date.weekday())
+        daysOfWeek = Q(schedule__daysofweekschedule__mask__in=masks)
+        # (until DaysOfWeekSchedule.backfillMasks has run, older rows have no mask)
+        daysOfWeek |= Q(schedule__daysofweekschedule__mask=0, 
+                        schedule__daysofweekschedule__days__in=[
+                            DaysOfWeekSchedule.asDays(mask) for mask in masks])
+        # any other streak is due by its stored due date (which for a GoalSchedule can be
+        # the day of the last activity), and one that has lapsed starts again any day
+        other = (Q(summary__due_date=date) | Q(summary__deadline__lt=date) |
+                 Q(summary__last_date__isnull=True))
+        other &= Q(schedule__daysofweekschedule__isnull=True)
+        return self.filter((daysOfWeek | other) & notDone)
+
+
 class Habit(models.Model):
     """ 
     The habit to establish, which consists of a task repeated on the given schedule. 
@@ -284,13 +784,36 @@ class Habit(models.Model):
     schedule = models.ForeignKey(Schedule)
     created = models.DateField(auto_now_add=True)
     active = models.BooleanField(default=False)
+    # activities before this day have been moved to the HabitArchive
+    archived_until = models.DateField(null=True)
+
+    objects = HabitManager()
     
     def __unicode__(self):
         return self.task
+
+    def __init__(self, *args, **kwargs):
+        super(Habit, self).__init__(*args, **kwargs)
+        self._loaded_schedule_id = self.schedule_id if self.pk else None
+
+    def save(self, *args, **kwargs):
+        super(Habit, self).save(*args, **kwargs)
+        # a new schedule means entirely different streaks
+        if self.schedule_id != self._loaded_schedule_id:
+            self.refreshSummary()
+            self._loaded_schedule_id = self.schedule_id
+        ChangeLog.objects.record(self.user_id, [(ChangeLog.HABIT, self.id)])
+
+    def delete(self, *args, **kwargs):
+        habitId = self.id
+        super(Habit, self).delete(*args, **kwargs)
+        ChangeLog.objects.record(self.user_id, [(ChangeLog.HABIT, habitId)])
         
     def activeToday(self, today=None, missed=False):
         """ Returns whether an activity occurred today. """
         activities = self.getActivities(missed)
+        if not activities and self.archived_until:
+            activities = self.getArchivedActivities(missed)
         if not activities:
             return False
         if not today:
@@ -300,10 +823,57 @@ class Habit(models.Model):
          
 
     def getActivities(self, missed=False):
+        """ 
+        Returns the (not yet archived) activities of this habit, in order.  See also 
+        getArchivedActivities and getActivityList.
+        """
         activities = Activity.objects.filter(habit=self)
         if not missed:
             activities = activities.exclude(status=Activity.MISSED)
         return activities.order_by('date')
+
+    def getArchivedActivities(self, missed=False):
+        """ Returns the ArchivedActivities of this habit, in order. """
+        activities = ArchivedActivity.objects.filter(habit=self)
+        if not missed:
+            activities = activities.exclude(status=Activity.MISSED)
+        return activities.order_by('date', 'id')
+
+    def getActivityList(self, since=None, until=None):
+        """
+        Returns a list of all of the (non-missed) activities of this habit, in order, and 
+        optionally only those between the given dates, inclusive.  Archived activities are 
+        included as unsaved stand-ins with only a date, from the HabitArchive.
+        """
+        activities = self.getActivities()
+        if since:
+            activities = activities.filter(date__gte=since)
+        if until:
+            activities = activities.filter(date__lte=until)
+        activities = list(activities)
+        if self.archived_until and (not since or since < self.archived_until):
+            activities = self.getArchive().getActivities(since, until) + activities
+        if not since and not until:
+            metrics.observe('habit.history_size', len(activities))
+        return activities
+
+    def getArchive(self):
+        """ Returns the HabitArchive of this habit, or None if nothing is archived. """
+        if not self.archived_until:
+            return None
+        if getattr(self, '_archive', None) is None:
+            self._archive = HabitArchive.objects.get(habit=self)
+        return self._archive
+
+    def _computeStreaks(self, today):
+        # the archived streaks are complete, and the last one begins a fresh start for the 
+        # schedule, so only the streaks from there on need to be worked out
+        archive = self.getArchive()
+        if not archive or archive.schedule_id != self.schedule_id:
+            return self.schedule.getStreaks(self.getActivityList(), today)
+        archived = archive.getStreaks()
+        return archived[:-1] + self.schedule.getStreaks(archived[-1] + 
+                                                        list(self.getActivities()), today)
     
     def getCurrentStreakDays(self, today=None):
         """ Returns the number of days in the most recent streak, from first activity until today. """
@@ -331,7 +901,7 @@ class Habit(models.Model):
         
         if not self.active:
             return Habit.STAR_LEVELS[0]
-        streaks = self.schedule.getStreaks(self.getActivities(), today);
+        streaks = self._computeStreaks(today)
         if not streaks:
             return Habit.STAR_LEVELS[1]
         
@@ -340,19 +910,7 @@ class Habit(models.Model):
         pastDays = 0
         if len(streaks) > 1:
             pastDays = daysInStreak(streaks[-2], until=None)
-
-        if recentDays > 28:
-            return Habit.STAR_LEVELS[3]  # gold
-        elif recentDays > 14:
-            if pastDays > 28:
-                return Habit.STAR_LEVELS[3]  # returned to gold from silver
-            else:
-                return Habit.STAR_LEVELS[2]  # just silver
-        else:
-            if pastDays > 28:
-                return Habit.STAR_LEVELS[2]  # silver because of recent gold lapse
-            else:
-                return Habit.STAR_LEVELS[1]  # bronze
+        return Habit.STAR_LEVELS[starLevelIndex(recentDays, pastDays)]
     
     def getStartDate(self):
         """ 
@@ -367,18 +925,20 @@ class Habit(models.Model):
     def getStreaks(self, today=None):
         # streak computation is the most intensive thing we do, so lets just do it once
         if not hasattr(self, 'streaks') or today != self.streaks_date:
-            sched = self.schedule.cast()
-            self.streaks = sched.getStreaks(self.getActivities(), today)
+            self.streaks = self._computeStreaks(today)
             self.streaks_date = today
         return self.streaks
                          
     def getTotalTimes(self):
         """ Returns the number of completed activities for this habit. """
-        return self.getActivities().count()
+        archive = self.getArchive()
+        return self.getActivities().count() + (archive.total_times if archive else 0)
         
     def getTotalDays(self, today=None):
         if not today:
             today = datetime.date.today()
+        if self.archived_until:
+            return (today - self.getArchive().first_date).days
         activities = self.getActivities()
         if not activities:
             return 0
@@ -388,7 +948,421 @@ class Habit(models.Model):
         streak = self.getStreaks(today)[-1]
         return self.schedule.nextRequiredDay(streak, today)
 
+    def getSummary(self):
+        """
+        Returns the stored HabitSummary of this habit, computing it first if this habit
+        does not have one yet.
+        """
+        try:
+            summary = self.summary
+        except HabitSummary.DoesNotExist:
+            metrics.increment('streaks.memo.miss')
+            # a replica may just not have the summary yet
+            with primary():
+                try:
+                    self.summary = HabitSummary.objects.get(habit=self)
+                    return self.summary
+                except HabitSummary.DoesNotExist:
+                    return self.refreshSummary()
+        metrics.increment('streaks.memo.hit')
+        return summary
+
+    def refreshSummary(self, activities=None):
+        """
+        Recomputes and saves the stored Streaks and HabitSummary of this habit from its 
+        full activity history.  Returns the summary.  Can be given the (non-missed, 
+        sorted) activities of this habit, if they were already loaded (from the primary
+        database: everything here is read from there, even in a readOnly view).
+        """
+        with primary():
+            Streak.objects.filter(habit=self).delete()
+            if activities is None:
+                activities = self.getActivityList()
+            spans = []
+            if activities:
+                # as of the last activity, the last streak is always the current one
+                streaks = self.schedule.getStreaks(activities, activities[-1].date)
+                spans = [Streak.fromActivities(streak, habit=self) for streak in streaks]
+                Streak.objects.bulk_create(spans)
+            return self._saveSummary(spans)
+
+    def repairSummary(self, changed):
+        """
+        Updates the stored Streaks and HabitSummary of this habit after the activities on
+        the given dates were added, removed, or changed, recomputing only the streaks 
+        around those dates.  Returns the summary.
+        """
+        with primary():
+            spans = list(Streak.objects.filter(habit=self).order_by('start', 'id'))
+            if not spans:
+                # never stored (or no activities before), so nothing to repair from
+                return self.refreshSummary()
+
+            (first, last, fresh) = repairStreaks(self.schedule.cast(), spans, changed, 
+                                                 self.getActivityList)
+            Streak.objects.filter(id__in=[span.id for span in spans[first:last]]).delete()
+            for span in fresh:
+                span.habit = self
+            Streak.objects.bulk_create(fresh)
+            return self._saveSummary(spans[:first] + fresh + spans[last:])
+
+    def _saveSummary(self, spans):
+        try:
+            summary = HabitSummary.objects.get(habit=self)
+        except HabitSummary.DoesNotExist:
+            summary = HabitSummary(habit=self)
+        summary.summarize(spans)
+        summary.deadline = summary.due_date = None
+        if summary.last_date:
+            def loadRecent(count):
+                # the current streak is the last current_times activities
+                count = min(count, summary.current_times)
+                dates = self.getActivities().order_by('-date').values_list('date', flat=True)
+                return sorted(dates[:count])
+            (summary.deadline, summary.due_date) = self.schedule.summarizeStreak(
+                summary.current_start, summary.last_date, loadRecent)
+        summary.save()
+        self.summary = summary
+        return summary
+
+    def archiveBefore(self, cutoff):
+        """
+        Moves this habit's activities from before the given date out of the Activity table:
+        into ArchivedActivity, for the history, and into the HabitArchive, for streaks.
+        Only whole streaks are archived, and only those that are over (followed by another
+        streak) and have no two activities on the same day, so the archived activities may
+        stop short of the cutoff.  Streaks and summaries are unchanged by this.
+        
+        Archived activities can no longer be changed.  Returns how many were archived.
+        """
+        with transaction.commit_on_success():
+            # read and move the activities with no others added or changed meanwhile
+            self.archived_until = Habit.objects.lock(self.id)
+            self._archive = None
+            activities = self.getActivityList()
+            if not activities:
+                return 0
+            schedule = self.schedule.cast()
+            streaks = schedule.getStreaks(activities, activities[-1].date)
+            count = 0
+            while count < len(streaks) - 1:
+                dates = [act.date for act in streaks[count]]
+                if (dates[-1] >= cutoff or len(set(dates)) != len(dates) or 
+                        streaks[count + 1][0].date <= dates[-1]):
+                    break
+                count += 1
+            until = streaks[count][0].date
+            if not count or self.archived_until and until <= self.archived_until:
+                return 0
+
+            moving = Activity.objects.filter(habit=self, date__lt=until)
+            archive = self.getArchive() or HabitArchive(habit=self)
+            if (sum(len(streak) for streak in streaks[:count]) != archive.total_times + 
+                    moving.exclude(status=Activity.MISSED).count()):
+                # some activity before until is in none of the streaks, so cannot be archived
+                return 0
+            moving = list(moving.order_by('date', 'id'))
+            ArchivedActivity.objects.bulk_create([ArchivedActivity(habit=self, date=act.date,
+                status=act.status, note=act.note) for act in moving])
+            Activity.objects.filter(id__in=[act.id for act in moving]).delete()
+            archive.setStreaks(schedule, streaks[:count])
+            archive.save()
+            Habit.objects.filter(id=self.id).update(archived_until=until)
+        self.archived_until = until
+        self._archive = archive
+        return len(moving)
+
+
+class Streak(models.Model):
+    """
+    One streak of a habit, as computed by its schedule's getStreaks (as of the habit's
+    most recent activity).  These are stored so that a change to one activity only needs
+    the streaks around it recomputed, rather than the whole history.
+    """
+    habit = models.ForeignKey(Habit)
+    start = models.DateField()
+    # date of the last activity in the streak
+    end = models.DateField()
+    times = models.IntegerField()
+
+    def __unicode__(self):
+        return self.start.isoformat() + " to " + self.end.isoformat()
+
+    def getDays(self):
+        """ The same as daysInStreak for the activities of this streak. """
+        return (self.end - self.start).days + 1
+
+    @staticmethod
+    def fromActivities(streak, habit=None):
+        """ Returns an unsaved Streak for the given non-empty list of activities. """
+        span = Streak(start=streak[0].date, end=streak[-1].date, times=len(streak))
+        if habit:
+            span.habit = habit
+        return span
+
+
+class HabitArchive(models.Model):
+    """
+    The archived streaks of a habit: those whose activities have been moved out of the 
+    Activity table by Habit.archiveBefore.  Days with an activity are kept as a bitmap,
+    and each streak as the range of days it covers, which is all that working out streaks
+    needs.  (The archived activities themselves are kept in ArchivedActivity, for the 
+    history.)
+    """
+    habit = models.OneToOneField(Habit, related_name='archive')
+    # the schedule that the streaks were worked out with
+    schedule = models.ForeignKey(Schedule)
+    # the day of the first bit of the bitmap
+    first_date = models.DateField()
+    # base64 of the bitmap, with bit i (least significant first) for first_date + i days
+    bitmap = models.TextField()
+    # JSON list of the [first, last] day numbers (as for bitmap) of each streak
+    streaks = models.TextField()
+    total_times = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return "Archive: " + self.habit.task
+
+    def setStreaks(self, schedule, streaks):
+        """ Sets this archive to the given (non-empty) list of streaks of activities. """
+        self.schedule = schedule
+        self.first_date = streaks[0][0].date
+        days = [(act.date - self.first_date).days for streak in streaks for act in streak]
+        bits = bytearray((days[-1] // 8) + 1)
+        for day in days:
+            bits[day // 8] |= 1 << (day % 8)
+        self.bitmap = base64.b64encode(bytes(bits)).decode('ascii')
+        self.streaks = json.dumps([[(streak[0].date - self.first_date).days, 
+                                    (streak[-1].date - self.first_date).days] 
+                                   for streak in streaks])
+        self.total_times = len(days)
+
+    def getDays(self):
+        """ Returns the day numbers, in order, of the days with an archived activity. """
+        bits = bytearray(base64.b64decode(self.bitmap))
+        return [i * 8 + bit for (i, byte) in enumerate(bits) for bit in range(8) 
+                if byte & (1 << bit)]
+
+    def getStreaks(self):
+        """ Returns the archived streaks, as lists of unsaved Activities with only a date. """
+        days = self.getDays()
+        streaks = []
+        for (first, last) in json.loads(self.streaks):
+            # (days is sorted, so each streak's days are found by bisection)
+            streaks.append([Activity(habit_id=self.habit_id, 
+                                     date=self.first_date + datetime.timedelta(day))
+                            for day in days[bisect.bisect_left(days, first):
+                                            bisect.bisect_right(days, last)]])
+        return streaks
+
+    def getActivities(self, since=None, until=None):
+        """ 
+        Returns the archived activities between the given dates (inclusive, and either may
+        be None for no limit), as unsaved Activities with only a date.
+        """
+        activities = []
+        for day in self.getDays():
+            date = self.first_date + datetime.timedelta(day)
+            if (not since or date >= since) and (not until or date <= until):
+                activities.append(Activity(habit_id=self.habit_id, date=date))
+        return activities
+
+    def getLastStreakDays(self):
+        """ The same as daysInStreak for the last archived streak. """
+        (first, last) = json.loads(self.streaks)[-1]
+        return last - first + 1
+
+
+class HabitSummary(models.Model):
+    """
+    A stored digest of a habit's streaks, so that the status and current streak of a
+    habit can be shown without replaying its whole activity history.  The streaks are 
+    summarized as of the most recent activity; what that means for any later day is
+    worked out from the stored dates.
+    
+    Methods mirror those of Habit with the same names, and should give the same results
+    for any today on or after the last activity.
+    """
+    habit = models.OneToOneField(Habit, related_name='summary')
+    first_date = models.DateField(null=True)
+    last_date = models.DateField(null=True)
+    # the last day on which the current streak is still ongoing
+    deadline = models.DateField(null=True, db_index=True)
+    # the next required day of the current streak, for schedules where that is fixed
+    due_date = models.DateField(null=True, db_index=True)
+    current_start = models.DateField(null=True)
+    current_times = models.IntegerField(default=0)
+    # days covered by the streak before the current one
+    previous_days = models.IntegerField(default=0)
+    longest_times = models.IntegerField(default=0)
+    longest_days = models.IntegerField(default=0)
+    longest_is_current = models.BooleanField(default=False)
+    total_times = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return "Summary: " + self.habit.task
+
+    def summarize(self, spans):
+        """
+        Sets the fields of this summary from the given list of all the stored Streaks of
+        the habit, in order.  (Does not set deadline, which depends on the schedule.)
+        """
+        if not spans:
+            # no activities at all
+            self.first_date = self.last_date = self.current_start = None
+            self.current_times = self.previous_days = self.total_times = 0
+            self.longest_times = self.longest_days = 0
+            self.longest_is_current = False
+            return
+        current = spans[-1]
+        self.first_date = spans[0].start
+        self.last_date = current.end
+        self.current_start = current.start
+        self.current_times = current.times
+        self.previous_days = spans[-2].getDays() if len(spans) > 1 else 0
+        longest = max(spans, key=lambda span: span.times)
+        self.longest_times = longest.times
+        self.longest_days = longest.getDays()
+        self.longest_is_current = longest is current
+        self.total_times = sum(span.times for span in spans)
+
+    def isLapsed(self, today=None):
+        """ Returns whether the current streak is empty as of today. """
+        if not today:
+            today = datetime.date.today()
+        return self.last_date is None or today > self.deadline
+
+    def activeToday(self, today=None):
+        if not today:
+            today = datetime.date.today()
+        return self.last_date == today
+
+    def getCurrentStreakEnds(self, today=None):
+        """
+        Returns the first and last activities of the current streak, which is enough of
+        the streak for Schedule.nextRequiredDay.  These are unsaved stand-ins with only a 
+        date.  Returns an empty list if the current streak is empty.
+        """
+        if self.isLapsed(today):
+            return []
+        return [Activity(date=self.current_start), Activity(date=self.last_date)]
+
+    def getCurrentStreakDays(self, today=None):
+        if not today:
+            today = datetime.date.today()
+        if self.isLapsed(today):
+            return 0
+        return (today - self.current_start).days + 1
+
+    def getCurrentStreakTimes(self, today=None):
+        return 0 if self.isLapsed(today) else self.current_times
+
+    def getStarLevel(self, today=None):
+        if not self.habit.active:
+            return Habit.STAR_LEVELS[0]
+        if self.isLapsed(today):
+            # the current streak is now the past one
+            recentDays = 0
+            pastDays = 0
+            if self.last_date:
+                pastDays = (self.last_date - self.current_start).days + 1
+        else:
+            recentDays = self.getCurrentStreakDays(today)
+            pastDays = self.previous_days
+        return Habit.STAR_LEVELS[starLevelIndex(recentDays, pastDays)]
+
+    def getLongestStreakTimes(self):
+        return self.longest_times
+
+    def getLongestStreakDays(self, today=None):
+        """ Like getCurrentStreakDays, counts until today if the longest is still ongoing. """
+        if self.longest_is_current and not self.isLapsed(today):
+            return self.getCurrentStreakDays(today)
+        return self.longest_days
+
+    def getStartDate(self):
+        return self.first_date
+
+    def getTotalTimes(self):
+        return self.total_times
+
+    def getTotalDays(self, today=None):
+        if not today:
+            today = datetime.date.today()
+        if not self.first_date:
+            return 0
+        return (today - self.first_date).days
+
+    def nextRequiredDay(self, today=None):
+        if not today:
+            today = datetime.date.today()
+        if self.due_date and not self.isLapsed(today):
+            return self.due_date
+        return self.habit.schedule.nextRequiredDay(self.getCurrentStreakEnds(today), today)
+
   
+class ActivityManager(models.Manager):
+
+    def recordOnce(self, habit, date, status=None, note='', key=None):
+        """
+        Records an activity for the habit on the given date, unless the habit already has
+        one that day.  Returns (activity, created).  This is safe against concurrent
+        requests: the habit's row is locked, the activity is inserted by one conditional
+        INSERT, and the habit's streaks and summary are updated, all in one transaction.
+
+        If a key is given (an idempotency key from the client), the outcome is stored
+        under it, and any retry with the same key returns that outcome instead of
+        recording again.  Raises ValueError if the key was used for a different habit or
+        date, or if the date has been archived.
+        """
+        if status is None:
+            status = Activity.COMPLETED
+        with transaction.commit_on_success(using=self.db):
+            # (as of the lock, in case the habit has just been archived)
+            habit.archived_until = Habit.objects.db_manager(self.db).lock(habit.id)
+            if habit.archived_until and date < habit.archived_until:
+                raise ValueError("Activities before %s are archived and cannot be changed." %
+                                 habit.archived_until.isoformat())
+            if key:
+                stored = list(IdempotencyKey.objects.using(self.db).filter(
+                    user=habit.user_id, key=key).select_related('activity'))
+                if stored:
+                    return stored[0].getResult(habit, date)
+
+            activityId = self._insertIfAbsent(habit, date, status, note)
+            created = activityId is not None
+            if created:
+                act = Activity(id=activityId, habit=habit, date=date, status=status, 
+                               note=note)
+                habit.repairSummary([date])
+                ChangeLog.objects.db_manager(self.db).record(habit.user_id, 
+                    [(ChangeLog.ACTIVITY, act.id), (ChangeLog.HABIT, habit.id)])
+            else:
+                act = self.using(self.db).filter(habit=habit, date=date).order_by('id')[0]
+                act.habit = habit
+            if key:
+                IdempotencyKey.objects.using(self.db).create(user_id=habit.user_id, key=key,
+                    habit=habit, date=date, activity=act, created=created)
+        return (act, created)
+
+    def _insertIfAbsent(self, habit, date, status, note):
+        """ Returns the id of the inserted activity, or None if there was one already. """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        table = qn(Activity._meta.db_table)
+        sql = ("INSERT INTO {table} ({habit}, {date}, {status}, {note}) "
+               "SELECT %s, %s, %s, %s WHERE NOT EXISTS "
+               "(SELECT 1 FROM {table} WHERE {habit} = %s AND {date} = %s)").format(
+               table=table, habit=qn('habit_id'), date=qn('date'), status=qn('status'),
+               note=qn('note'))
+        day = connection.ops.value_to_db_date(date)
+        cursor = connection.cursor()
+        cursor.execute(sql, [habit.id, day, status, note, habit.id, day])
+        if not cursor.rowcount:
+            return None
+        return connection.ops.last_insert_id(cursor, Activity._meta.db_table, 'id')
+
+
 # The name of this class was something of challenge.  Names considered:
 # * Doing, DidIt, Done, Effort, Action, Push
 # * Event, Activity, Task, 
@@ -398,6 +1372,9 @@ class Habit(models.Model):
 #
 class Activity(models.Model):
     """ An application of a habit on a particular day. """
+    # see ArchivedActivity
+    archived = False
+
     MISSED = 0
     COMPLETED = 10
     HALF = 5
@@ -414,11 +1391,237 @@ class Activity(models.Model):
     date = models.DateField()
     status = models.IntegerField(choices=STATUS_LEVELS, default=COMPLETED)
     note = models.TextField(blank=True)
+
+    objects = ActivityManager()
     
     def getDate(self):
         """Returns an ISO-formatted date."""
         return self.date.isoformat()
+
+    def __init__(self, *args, **kwargs):
+        super(Activity, self).__init__(*args, **kwargs)
+        self._loaded_date = self.date if self.pk else None
+
+    def save(self, *args, **kwargs):
+        """
+        Saves this activity and updates its habit's streaks, summary, and change log, with
+        the habit's row locked, in the caller's transaction if there is one, else in one
+        of its own.
+        """
+        if not transaction.is_managed():
+            with transaction.commit_on_success():
+                return self.save(*args, **kwargs)
+        # (as of the lock, in case the habit has just been archived)
+        until = self.habit.archived_until = Habit.objects.lock(self.habit_id)
+        if until and (self.date < until or self._loaded_date and self._loaded_date < until):
+            raise ValueError("Activities before %s are archived and cannot be changed." % 
+                             until.isoformat())
+        super(Activity, self).save(*args, **kwargs)
+        changed = [self.date]
+        if self._loaded_date:
+            changed.append(self._loaded_date)
+        self.habit.repairSummary(changed)
+        self._loaded_date = self.date
+        ChangeLog.objects.record(self.habit.user_id, 
+            [(ChangeLog.ACTIVITY, self.id), (ChangeLog.HABIT, self.habit_id)])
+
+    def delete(self, *args, **kwargs):
+        """ Deletes this activity, updating its habit as save does. """
+        if not transaction.is_managed():
+            with transaction.commit_on_success():
+                return self.delete(*args, **kwargs)
+        Habit.objects.lock(self.habit_id)
+        activityId = self.id
+        super(Activity, self).delete(*args, **kwargs)
+        self.habit.repairSummary([self._loaded_date or self.date])
+        ChangeLog.objects.record(self.habit.user_id, 
+            [(ChangeLog.ACTIVITY, activityId), (ChangeLog.HABIT, self.habit_id)])
     
     def __unicode__(self):
         return self.getDate() + ": " + self.habit.task
-    
\ No newline at end of file
+
+
+class ArchivedActivity(models.Model):
+    """
+    An activity moved out of the Activity table by Habit.archiveBefore, kept for the 
+    history of the habit.  These no longer change, and streaks are worked out from the 
+    HabitArchive instead.
+    """
+    archived = True
+
+    habit = models.ForeignKey(Habit)
+    date = models.DateField(db_index=True)
+    status = models.IntegerField(choices=Activity.STATUS_LEVELS, default=Activity.COMPLETED)
+    note = models.TextField(blank=True)
+
+    def getDate(self):
+        return self.date.isoformat()
+
+    def __unicode__(self):
+        return self.getDate() + ": " + self.habit.task
+
+
+
+class IdempotencyKeyManager(models.Manager):
+
+    def purge(self, before):
+        """ 
+        Deletes the keys stored before the given datetime, after which retries with them
+        are taken as new requests.  Returns how many were deleted.
+        """
+        keys = self.filter(when__lt=before)
+        count = keys.count()
+        keys.delete()
+        return count
+
+
+class IdempotencyKey(models.Model):
+    """
+    A key sent by a client with a request to record an activity, and what came of it, so
+    that retrying the request (say, after a timeout) does not record it again.  See
+    ActivityManager.recordOnce.  Keys are only kept for IDEMPOTENCY_KEY_DAYS (see 
+    manage.py purgekeys).
+    """
+    user = models.ForeignKey(User)
+    key = models.CharField(max_length=64)
+    habit = models.ForeignKey(Habit)
+    date = models.DateField()
+    activity = models.ForeignKey(Activity, null=True, on_delete=models.SET_NULL)
+    # whether the request recorded the activity, or found one already there
+    created = models.BooleanField(default=False)
+    when = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = IdempotencyKeyManager()
+
+    class Meta:
+        unique_together = ('user', 'key')
+
+    def __unicode__(self):
+        return self.key
+
+    def getResult(self, habit, date):
+        """ 
+        Returns the (activity, created) stored for a retry of the request with this key,
+        which must be for the given habit and date.
+        """
+        if self.habit_id != habit.id or self.date != date:
+            raise ValueError("That request key was already used for another activity.")
+        return (self.activity, self.created)
+
+
+class ChangeLogManager(models.Manager):
+
+    def record(self, userId, changes):
+        """
+        Appends the given changes, a list of (kind, id) of the habits and activities that
+        were created, changed, or deleted, to the given user's change log.  The user's row
+        is locked while they are numbered on from the user's last change, in the caller's
+        transaction if there is one, else in one of their own.
+        """
+        if not transaction.is_managed(using=self.db):
+            with transaction.commit_on_success(using=self.db):
+                return self.record(userId, changes)
+        User.objects.using(self.db).filter(id=userId).update(
+            last_login=models.F('last_login'))
+        last = self.getCursor(userId)
+        self.bulk_create([ChangeLog(user_id=userId, seq=last + i + 1, kind=kind, 
+                                    object_id=objectId) 
+                          for (i, (kind, objectId)) in enumerate(changes)])
+
+    def getCursor(self, userId):
+        """ Returns the number of the given user's last change, or 0 if there is none. """
+        return self.filter(user=userId).aggregate(models.Max('seq'))['seq__max'] or 0
+
+    def changesSince(self, userId, since, limit):
+        """
+        Returns (cursor, habitIds, activityIds, more) for up to limit of the given user's
+        changes after number since: the number of the last of them, the sets of ids of
+        the habits and activities they were for, and whether there are more after them.
+        """
+        entries = list(self.filter(user=userId, seq__gt=since).order_by('seq')
+                       .values_list('seq', 'kind', 'object_id')[:limit + 1])
+        more = len(entries) > limit
+        entries = entries[:limit]
+        cursor = entries[-1][0] if entries else since
+        ids = dict((kind, set()) for (kind, name) in ChangeLog.KINDS)
+        for (seq, kind, objectId) in entries:
+            ids[kind].add(objectId)
+        return (cursor, ids[ChangeLog.HABIT], ids[ChangeLog.ACTIVITY], more)
+
+
+class ChangeLog(models.Model):
+    """
+    One change to a user's habits or activities, numbered in order for each user, so that
+    clients can catch up on just what changed since they last synced (see 
+    habitmaster.habits.views.sync).  Only which habit or activity changed is kept: its
+    current state, or that it is gone, is read when syncing.  A change to an activity is
+    also a change to its habit, whose summary changes with it.
+
+    Archiving activities is not a change, since they stay in the habit's history.
+    """
+    HABIT = 'h'
+    ACTIVITY = 'a'
+    KINDS = ((HABIT, 'Habit'), (ACTIVITY, 'Activity'))
+
+    user = models.ForeignKey(User)
+    seq = models.IntegerField()
+    kind = models.CharField(max_length=1, choices=KINDS)
+    object_id = models.IntegerField()
+    when = models.DateTimeField(auto_now_add=True)
+
+    objects = ChangeLogManager()
+
+    class Meta:
+        unique_together = ('user', 'seq')
+
+    def __unicode__(self):
+        return '%d: %s %d' % (self.seq, self.get_kind_display(), self.object_id)
+
+
+def loadSummaries(habits):
+    """
+    Prepares the given habits for showing their summaries without further queries: sets
+    each habit's schedule to the specific Schedule subclass and attaches its HabitSummary.
+    This takes a few queries for all of the habits together, plus one batched load of 
+    activities for any habits that do not have a stored summary yet.  Returns the habits.
+    """
+    habits = list(habits)
+    scheduleIds = set(habit.schedule_id for habit in habits)
+    schedules = IntervalSchedule.objects.in_bulk(scheduleIds)
+    schedules.update(DaysOfWeekSchedule.objects.in_bulk(scheduleIds))
+    schedules.update(GoalSchedule.objects.in_bulk(scheduleIds))
+    summaries = HabitSummary.objects.filter(habit__in=[habit.id for habit in habits])
+    summaries = dict((summary.habit_id, summary) for summary in summaries)
+
+    missing = {}
+    for habit in habits:
+        if habit.schedule_id in schedules:
+            habit.schedule = schedules[habit.schedule_id]
+        if habit.id in summaries:
+            habit.summary = summaries[habit.id]
+        else:
+            missing[habit.id] = []
+    metrics.increment('streaks.memo.hit', len(summaries))
+    metrics.increment('streaks.memo.miss', len(missing))
+    if missing:
+        # summaries are computed from (and saved to) the primary database, which may 
+        # have some that a replica does not yet
+        with primary():
+            for summary in HabitSummary.objects.filter(habit__in=missing.keys()):
+                del missing[summary.habit_id]
+                summaries[summary.habit_id] = summary
+            archived = dict(Habit.objects.filter(id__in=missing.keys())
+                            .values_list('id', 'archived_until'))
+            activities = Activity.objects.filter(habit__in=missing.keys())
+            activities = activities.exclude(status=Activity.MISSED).order_by('habit', 'date')
+            for act in activities:
+                missing[act.habit_id].append(act)
+            for habit in habits:
+                if habit.id in summaries:
+                    habit.summary = summaries[habit.id]
+                elif habit.id in archived:
+                    metrics.observe('habit.history_size', len(missing[habit.id]))
+                    habit.archived_until = archived.get(habit.id)
+                    # (archived activities are not in the Activity table)
+                    habit.refreshSummary(None if habit.archived_until else missing[habit.id])
+    return habits
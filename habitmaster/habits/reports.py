@@ -0,0 +1,185 @@
+"""
+Computations over many habits at once, for the dashboard and other reports.  These work
+on whole sets of habits in one query, rather than habit by habit.
+"""
+
+import datetime
+from django.db import connections
+from habitmaster.habits.models import IntervalSchedule, Habit, HabitSummary, HabitArchive
+from habitmaster.habits.models import Activity
+
+EPOCH = datetime.date(1970, 1, 1)
+
+# the SQL for each backend to turn a date column into a day number counted from EPOCH
+DAY_NUMBER = {
+    'postgresql': "(%s - DATE '1970-01-01')",
+    'sqlite': "CAST(julianday(%s) - 2440587.5 AS INTEGER)",
+}
+
+# The current streak of each IntervalSchedule habit, in one query.  Window functions split
+# each habit's history into islands wherever the gap between consecutive activities is
+# longer than the interval, which always breaks a streak.  A streak can also break within
+# an island (when an early activity is followed by one past the required day), so the last
+# two islands are then walked in order to find exactly where the last two streaks start.
+#
+# (The outer SELECT is because Python's sqlite3 module commits any open transaction before
+# a statement that does not start with SELECT, INSERT, UPDATE, or DELETE.)
+CURRENT_STREAKS_SQL = """
+SELECT * FROM (
+WITH RECURSIVE
+numbered AS (
+    SELECT a.{habit_id} AS habit, s.{interval} AS step, {day} AS dayno,
+           ROW_NUMBER() OVER (PARTITION BY a.{habit_id} ORDER BY a.{date}, a.{id}) AS n
+    FROM {activity} a
+    JOIN {habit} h ON h.{id} = a.{habit_id}
+    JOIN {intervalschedule} s ON s.{schedule_ptr_id} = h.{schedule_id}
+    WHERE a.{status} <> %s {where}
+),
+gaps AS (
+    SELECT habit, step, dayno, n,
+           CASE WHEN dayno - LAG(dayno) OVER (PARTITION BY habit ORDER BY n) <= step
+                THEN 0 ELSE 1 END AS gap
+    FROM numbered
+),
+islands AS (
+    SELECT habit, step, dayno, n,
+           SUM(gap) OVER (PARTITION BY habit ORDER BY n) AS island
+    FROM gaps
+),
+lastislands AS (
+    SELECT habit, step, dayno, n, island,
+           MAX(island) OVER (PARTITION BY habit) AS lastisland
+    FROM islands
+),
+tail AS (
+    SELECT habit, step, dayno,
+           ROW_NUMBER() OVER (PARTITION BY habit ORDER BY n) AS n,
+           COUNT(*) OVER (PARTITION BY habit) AS total
+    FROM lastislands
+    WHERE island >= lastisland - 1
+),
+walk (habit, n, dayno, step, total, firstday, firstn, due, prevfirst, prevlast) AS (
+    SELECT habit, n, dayno, step, total, dayno, n, dayno + step,
+           CAST(NULL AS INTEGER), CAST(NULL AS INTEGER)
+    FROM tail WHERE n = 1
+  UNION ALL
+    SELECT t.habit, t.n, t.dayno, t.step, t.total,
+           CASE WHEN t.dayno > w.due THEN t.dayno ELSE w.firstday END,
+           CASE WHEN t.dayno > w.due THEN t.n ELSE w.firstn END,
+           CASE WHEN t.dayno > w.due THEN t.dayno + t.step
+                WHEN t.dayno = w.due THEN w.due + t.step
+                ELSE w.due END,
+           CASE WHEN t.dayno > w.due THEN w.firstday ELSE w.prevfirst END,
+           CASE WHEN t.dayno > w.due THEN w.dayno ELSE w.prevlast END
+    FROM walk w JOIN tail t ON t.habit = w.habit AND t.n = w.n + 1
+)
+SELECT habit, firstday, dayno, n - firstn + 1, prevfirst, prevlast, step
+FROM walk WHERE n = total
+) streaks
+"""
+
+
+def supportsWindowFunctions(connection):
+    """ Returns whether CURRENT_STREAKS_SQL can run on the given database connection. """
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 25, 0)
+    return False
+
+
+def currentIntervalStreaks(habitIds=None, using='default', useSql=None):
+    """
+    Returns a dict mapping the id of every IntervalSchedule habit with any activities (or
+    just those with the given ids) to a HabitSummary for it.  The summaries are unsaved
+    and only fill in what is needed for the current streak and star level: first and
+    last date of the current streak, its times, the days of the streak before it, and the
+    deadline.  (So getCurrentStreakTimes, getCurrentStreakDays, and getStarLevel work.)
+
+    These are computed in the database when it supports window functions, else by
+    walking every activity in Python.  useSql can force one or the other.
+    """
+    connection = connections[using]
+    if useSql is None:
+        useSql = supportsWindowFunctions(connection)
+    if habitIds is not None:
+        habitIds = list(habitIds)
+        if not habitIds:
+            return {}
+    rows = _streaksBySql(connection, habitIds) if useSql else _streaksByWalk(using, habitIds)
+
+    summaries = {}
+    firsts = []
+    for (habit, first, last, times, prevFirst, prevLast, step) in rows:
+        summary = HabitSummary(habit_id=habit, current_start=first, last_date=last,
+                               current_times=times)
+        summary.deadline = last + datetime.timedelta(days=step)
+        if prevFirst is not None:
+            summary.previous_days = (prevLast - prevFirst).days + 1
+        else:
+            firsts.append(habit)
+        summaries[habit] = summary
+
+    # the streak before the first one in the Activity table may have been archived
+    if firsts:
+        for archive in HabitArchive.objects.using(using).filter(habit__in=firsts):
+            summaries[archive.habit_id].previous_days = archive.getLastStreakDays()
+    return summaries
+
+
+def _streaksBySql(connection, habitIds):
+    qn = connection.ops.quote_name
+    names = dict((name, qn(name)) for name in ('habit_id', 'interval', 'date', 'id',
+                 'schedule_ptr_id', 'schedule_id', 'status'))
+    names['activity'] = qn(Activity._meta.db_table)
+    names['habit'] = qn(Habit._meta.db_table)
+    names['intervalschedule'] = qn(IntervalSchedule._meta.db_table)
+    names['day'] = DAY_NUMBER[connection.vendor] % ('a.' + qn('date'))
+    params = [Activity.MISSED]
+    names['where'] = ''
+    if habitIds is not None:
+        names['where'] = 'AND a.%s IN (%s)' % (qn('habit_id'), 
+                                               ', '.join(['%s'] * len(habitIds)))
+        params += habitIds
+
+    cursor = connection.cursor()
+    cursor.execute(CURRENT_STREAKS_SQL.format(**names), params)
+    for (habit, first, last, times, prevFirst, prevLast, step) in cursor.fetchall():
+        yield (habit, _toDate(first), _toDate(last), times, _toDate(prevFirst),
+               _toDate(prevLast), step)
+
+
+def _toDate(dayNumber):
+    if dayNumber is None:
+        return None
+    return EPOCH + datetime.timedelta(days=dayNumber)
+
+
+def _streaksByWalk(using, habitIds):
+    """ The same as _streaksBySql, but walking all the activities in Python. """
+    activities = Activity.objects.using(using).exclude(status=Activity.MISSED)
+    activities = activities.filter(habit__schedule__intervalschedule__isnull=False)
+    if habitIds is not None:
+        activities = activities.filter(habit__in=habitIds)
+    activities = activities.order_by('habit', 'date', 'id').values_list(
+        'habit', 'date', 'habit__schedule__intervalschedule__interval')
+
+    state = None
+    for (habit, date, interval) in activities.iterator():
+        if state and state[0] != habit:
+            yield state[:-1]
+            state = None
+        step = datetime.timedelta(days=interval)
+        if not state:
+            state = [habit, date, date, 1, None, None, interval, date + step]
+        elif date > state[-1]:
+            # lapsed, so this starts a new streak
+            state = [habit, date, date, 1, state[1], state[2], interval, date + step]
+        else:
+            if date == state[-1]:
+                state[-1] += step
+            state[2] = date
+            state[3] += 1
+    if state:
+        yield state[:-1]
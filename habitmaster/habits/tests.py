@@ -2,10 +2,16 @@
 Tests habit-related classes.  Use "manage.py test" to run.
 """
 import datetime
+import os
 from django.contrib.auth.models import User
-from django.test import TestCase
-from habitmaster.habits.models import DaysOfWeekSchedule, IntervalSchedule, Habit, Activity
+from django.core.urlresolvers import reverse
+from django.test import TestCase, TransactionTestCase
+from habitmaster.habits.models import DaysOfWeekSchedule, IntervalSchedule, GoalSchedule
+from habitmaster.habits.models import Habit, Activity
+from habitmaster.habits.models import HabitSummary, Streak, ArchivedActivity, IdempotencyKey
+from habitmaster.habits.models import ChangeLog
 from habitmaster.habits.models import daysInStreak
+from habitmaster.testing import environ, loadSettings
 from django.core.validators import ValidationError    
 
 class DaysOfWeekScheduleTest(TestCase):
@@ -61,6 +67,69 @@ class IntervalScheduleTest(TestCase):
         self.assertEqual(self.every3.__unicode__(), 'Once every 3 days')
                 
         
+class GoalScheduleTest(TestCase):
+
+    def setUp(self):
+        self.thrice = GoalSchedule.objects.create(times=3, period=7)
+        user = User.objects.create_user('tester')
+        self.habit = Habit.objects.create(user=user, task='Run', schedule=self.thrice)
+        # Mon, Wed, Fri for two weeks, then a lapse
+        for day in (6, 8, 10, 13, 15, 17, 29):
+            Activity.objects.create(habit=self.habit, date=datetime.date(2013, 5, day))
+
+    def test_badSetUp(self):
+        with self.assertRaises(ValidationError):
+            GoalSchedule(times=0, period=7).clean_fields()
+        with self.assertRaises(ValidationError):
+            GoalSchedule(times=3, period=10).clean_fields()
+
+    def test_unicode(self):
+        self.assertEqual(self.thrice.__unicode__(), '3 times a week')
+        self.assertEqual(GoalSchedule(times=2, period=30).__unicode__(), 'Twice a month')
+
+    def test_getStreaks(self):
+        streaks = self.habit.getStreaks(today=datetime.date(2013, 5, 29))
+        self.assertEqual([6, 1], [len(streak) for streak in streaks])
+        self.assertEqual(datetime.date(2013, 5, 17), streaks[0][-1].date)
+        # (after the 17th, the week from the 14th needs a third activity by the 20th)
+        activities = list(self.habit.getActivities())[:-1]
+        streaks = self.thrice.getStreaks(activities, today=datetime.date(2013, 5, 20))
+        self.assertEqual(datetime.date(2013, 5, 20), self.thrice.nextRequiredDay(
+            streaks[-1], datetime.date(2013, 5, 20)))
+        streaks = self.thrice.getStreaks(activities, today=datetime.date(2013, 5, 21))
+        self.assertEqual([], streaks[-1])
+
+    def test_nextRequiredDay(self):
+        # a new streak needs its other two within the week it started
+        self.assertEqual(datetime.date(2013, 6, 4), 
+                         self.habit.nextRequiredDay(datetime.date(2013, 5, 30)))
+        self.assertEqual(datetime.date(2013, 6, 5), 
+                         self.habit.nextRequiredDay(datetime.date(2013, 6, 5)))
+        habit = Habit.objects.create(user=self.habit.user, task='Swim', schedule=self.thrice)
+        self.assertEqual(datetime.date(2013, 6, 5), 
+                         habit.nextRequiredDay(datetime.date(2013, 6, 5)))
+
+    def test_summary(self):
+        today = datetime.date(2013, 5, 29)
+        summary = self.habit.getSummary()
+        self.assertEqual(datetime.date(2013, 6, 4), summary.deadline)
+        self.assertEqual(self.habit.nextRequiredDay(today), summary.nextRequiredDay(today))
+        # keeping the first streak going by the 20th still leaves it lapsed by the 29th
+        Activity.objects.recordOnce(self.habit, datetime.date(2013, 5, 20))
+        habit = Habit.objects.get(id=self.habit.id)
+        summary = habit.getSummary()
+        self.assertEqual(habit.nextRequiredDay(today), summary.nextRequiredDay(today))
+        self.assertEqual([7, 1], [len(streak) for streak in habit.getStreaks(today)])
+        self.assertEqual(15, summary.previous_days)
+
+    def test_linear(self):
+        schedule = GoalSchedule(times=20, period=30)
+        start = datetime.date(2013, 1, 1)
+        activities = [Activity(date=start + datetime.timedelta(days=i)) for i in range(2000)]
+        streaks = schedule.getStreaks(activities, activities[-1].date)
+        self.assertEqual([activities], streaks)
+        
+        
 class HabitTest(TestCase):
     """ Includes a lof schedule testing too, since share the same test structure. """
     
@@ -178,4 +247,1079 @@ class HabitTest(TestCase):
         self.assertEqual("Once every 2 days", self.every2.__unicode__())
         self.assertEqual("Mo/We/Fr", self.habitDays.schedule.__unicode__())
         
-        
\ No newline at end of file
+        
+class HabitSummaryTest(TestCase):
+    """ The stored summary should always agree with the full streak computation. """
+
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='secret')
+        self.habitDays = Habit.objects.create(user=self.user, task='Work it', active=True,
+            schedule=DaysOfWeekSchedule.objects.create(days='1010100'))
+        self.habitInterval = Habit.objects.create(user=self.user, task='Test it', active=True,
+            schedule=IntervalSchedule.objects.create(interval=3))
+        start = datetime.date(2013, 4, 1)
+        for offset in (0, 2, 4, 7, 9, 11, 14, 16, 18, 21, 23, 25, 26, 28, 30, 32, 35, 44, 46):
+            for habit in (self.habitDays, self.habitInterval):
+                Activity.objects.create(habit=habit, date=start + datetime.timedelta(offset))
+    
+    def assertAgrees(self, habit, today):
+        summary = Habit.objects.get(id=habit.id).getSummary()
+        habit = Habit.objects.get(id=habit.id)
+        self.assertEqual(habit.getStarLevel(today), summary.getStarLevel(today))
+        self.assertEqual(habit.getCurrentStreakTimes(today), summary.getCurrentStreakTimes(today))
+        self.assertEqual(habit.getCurrentStreakDays(today), summary.getCurrentStreakDays(today))
+        self.assertEqual(habit.nextRequiredDay(today), summary.nextRequiredDay(today))
+        self.assertEqual(habit.activeToday(today), summary.activeToday(today))
+        self.assertEqual(habit.getTotalTimes(), summary.getTotalTimes())
+        self.assertEqual(habit.getTotalDays(today), summary.getTotalDays(today))
+        self.assertEqual(habit.getStartDate(), summary.getStartDate())
+        streaks = habit.getStreaks(today)
+        longest = max(streaks, key=len)
+        self.assertEqual(len(longest), summary.getLongestStreakTimes())
+        self.assertEqual(daysInStreak(longest, until=today if longest == streaks[-1] else None),
+                         summary.getLongestStreakDays(today))
+
+    def test_agreesWithStreaks(self):
+        for offset in range(0, 10):
+            today = datetime.date(2013, 5, 17) + datetime.timedelta(offset)
+            self.assertAgrees(self.habitDays, today)
+            self.assertAgrees(self.habitInterval, today)
+
+    def test_emptyHabit(self):
+        habit = Habit.objects.create(user=self.user, task='Nothing yet', 
+                                     schedule=IntervalSchedule.objects.create(interval=1))
+        self.assertAgrees(habit, datetime.date(2013, 5, 20))
+        habit.active = True
+        habit.save()
+        self.assertAgrees(habit, datetime.date(2013, 5, 20))
+
+    def test_keptCurrent(self):
+        Activity.objects.filter(habit=self.habitDays, date__gt=datetime.date(2013, 5, 1)).delete()
+        self.habitDays.refreshSummary()
+        self.assertAgrees(self.habitDays, datetime.date(2013, 5, 2))
+        act = Activity.objects.create(habit=self.habitDays, date=datetime.date(2013, 5, 3))
+        self.assertAgrees(self.habitDays, datetime.date(2013, 5, 3))
+        act.delete()
+        self.assertAgrees(self.habitDays, datetime.date(2013, 5, 3))
+
+    def test_detail(self):
+        self.client.login(username='tester', password='secret')
+        response = self.client.get(reverse('habit', kwargs={'habit_id': self.habitDays.id}))
+        self.assertContains(response, reverse('habit_history', 
+                                              kwargs={'habit_id': self.habitDays.id}))
+        response = self.client.get(reverse('habit_history', 
+                                           kwargs={'habit_id': self.habitDays.id}))
+        self.assertContains(response, '2013-05-17', count=1)
+        self.assertTrue(response.streaming)
+
+    def test_index(self):
+        self.client.login(username='tester', password='secret')
+        HabitSummary.objects.filter(habit=self.habitInterval).delete()
+        for path in (reverse('index'), reverse('index') + '?stream=1'):
+            response = self.client.get(path)
+            self.assertEqual('stream' in path, response.streaming)
+            content = ''.join(response)
+            self.assertEqual(1, content.count('Work it'))
+            self.assertEqual(1, content.count('Test it'))
+            self.assertIn('New Habit', content)
+        self.assertTrue(HabitSummary.objects.filter(habit=self.habitInterval).exists())
+
+
+class StreakRepairTest(TestCase):
+    """ Stored streaks, repaired locally after each change, should match a full recompute. """
+
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='secret')
+        self.start = datetime.date(2013, 4, 1)
+
+    def assertRepaired(self, habit):
+        stored = [(s.start, s.end, s.times) 
+                  for s in Streak.objects.filter(habit=habit).order_by('start', 'id')]
+        summary = HabitSummary.objects.get(habit=habit)
+        fields = [f.name for f in HabitSummary._meta.fields if f.name not in ('id', 'habit')]
+        repaired = [getattr(summary, f) for f in fields]
+        habit.refreshSummary()
+        self.assertEqual([(s.start, s.end, s.times) 
+                          for s in Streak.objects.filter(habit=habit).order_by('start', 'id')],
+                         stored)
+        summary = HabitSummary.objects.get(habit=habit)
+        self.assertEqual([getattr(summary, f) for f in fields], repaired)
+
+    def randomEdits(self, schedule, seed):
+        import random
+        rand = random.Random(seed)
+        habit = Habit.objects.create(user=self.user, task='Random', schedule=schedule)
+        for i in range(60):
+            date = self.start + datetime.timedelta(rand.randint(0, 40))
+            acts = list(Activity.objects.filter(habit=habit))
+            choice = rand.random()
+            if not acts or choice < 0.5:
+                if not Activity.objects.filter(habit=habit, date=date):
+                    Activity.objects.create(habit=habit, date=date)
+            elif choice < 0.65:
+                rand.choice(acts).delete()
+            elif choice < 0.85:
+                act = rand.choice(acts)
+                act.status = rand.choice(dict(Activity.STATUS_LEVELS).keys())
+                act.save()
+            else:
+                act = rand.choice(acts)
+                if not Activity.objects.filter(habit=habit, date=date):
+                    act.date = date
+                    act.save()
+            self.assertRepaired(habit)
+
+    def test_interval(self):
+        for interval in (1, 2, 3):
+            self.randomEdits(IntervalSchedule.objects.create(interval=interval), interval)
+
+    def test_daysOfWeek(self):
+        for (seed, days) in enumerate(('1111100', '1010100', '0000011')):
+            self.randomEdits(DaysOfWeekSchedule.objects.create(days=days), seed)
+
+    def test_duplicateDates(self):
+        habit = Habit.objects.create(user=self.user, task='Twice', 
+                                     schedule=DaysOfWeekSchedule.objects.create(days='1010100'))
+        for offset in (0, 1, 1, 2, 4, 4, 7, 8, 9, 9):
+            Activity.objects.create(habit=habit, date=self.start + datetime.timedelta(offset))
+            self.assertRepaired(habit)
+        for act in Activity.objects.filter(habit=habit).order_by('-date'):
+            act.delete()
+            self.assertRepaired(habit)
+
+    def test_earlierBeforeDuplicates(self):
+        # found by manage.py streakcheck: two streaks start on the day of the first stored
+        # streak, and an activity is added before it
+        habit = Habit.objects.create(user=self.user, task='Twice', 
+                                     schedule=DaysOfWeekSchedule.objects.create(days='0101100'))
+        for offset in (14, 14, 16, 0):
+            Activity.objects.create(habit=habit, date=self.start + datetime.timedelta(offset))
+            self.assertRepaired(habit)
+
+    def test_views(self):
+        habit = Habit.objects.create(user=self.user, task='Backdated', 
+                                     schedule=IntervalSchedule.objects.create(interval=1))
+        self.client.login(username='tester', password='secret')
+        yesterday = datetime.date.today() - datetime.timedelta(1)
+        response = self.client.post(reverse('activity_create'), 
+            {'habit': habit.id, 'date': yesterday.isoformat(), 'status': Activity.HALF, 
+             'next': 'habit'})
+        self.assertRedirects(response, reverse('habit', kwargs={'habit_id': habit.id}))
+        act = Activity.objects.get(habit=habit)
+        self.assertEqual((yesterday, Activity.HALF), (act.date, act.status))
+        self.assertEqual(1, Habit.objects.get(id=habit.id).getSummary().getCurrentStreakTimes())
+        
+        response = self.client.post(reverse('activity_edit', kwargs={'activity_id': act.id}),
+            {'date': yesterday.isoformat(), 'status': Activity.MISSED})
+        self.assertRedirects(response, reverse('index'))
+        self.assertEqual(Activity.MISSED, Activity.objects.get(id=act.id).status)
+        self.assertEqual(0, Habit.objects.get(id=habit.id).getSummary().getCurrentStreakTimes())
+
+        # fields left out of an edit keep their values
+        Activity.objects.filter(id=act.id).update(note='Rained')
+        response = self.client.post(reverse('activity_edit', kwargs={'activity_id': act.id}),
+            {'status': Activity.COMPLETED})
+        self.assertRedirects(response, reverse('index'))
+        act = Activity.objects.get(id=act.id)
+        self.assertEqual((yesterday, Activity.COMPLETED, 'Rained'), 
+                         (act.date, act.status, act.note))
+        
+        tomorrow = datetime.date.today() + datetime.timedelta(1)
+        response = self.client.post(reverse('activity_create'), 
+                                    {'habit': habit.id, 'date': tomorrow.isoformat()})
+        self.assertContains(response, 'has not happened yet')
+        
+        response = self.client.post(reverse('activity_delete', kwargs={'activity_id': act.id}))
+        self.assertEqual(0, Activity.objects.filter(habit=habit).count())
+
+
+class ReportsTest(TestCase):
+    """ Both ways of computing interval streaks in bulk should agree with getStreaks. """
+
+    def setUp(self):
+        import random
+        rand = random.Random(4)
+        self.user = User.objects.create_user('tester', password='secret')
+        self.start = datetime.date(2013, 4, 1)
+        self.habits = []
+        for interval in (1, 2, 3, 4, 7):
+            for i in range(4):
+                habit = Habit.objects.create(user=self.user, task='Every ' + str(interval), 
+                    active=True, schedule=IntervalSchedule.objects.create(interval=interval))
+                rate = rand.uniform(0.2, 0.9)
+                for offset in range(60):
+                    if rand.random() < rate:
+                        Activity.objects.create(habit=habit, status=rand.choice((0, 5, 10, 15)),
+                                                date=self.start + datetime.timedelta(offset))
+                self.habits.append(habit)
+        # early activities and then missing the required day, all within the interval
+        habit = Habit.objects.create(user=self.user, task='Early', active=True,
+                                     schedule=IntervalSchedule.objects.create(interval=3))
+        for offset in (0, 1, 4, 5, 7, 8, 9, 12, 13, 14, 16):
+            Activity.objects.create(habit=habit, date=self.start + datetime.timedelta(offset))
+        self.habits.append(habit)
+        self.habits.append(Habit.objects.create(user=self.user, task='Nothing', 
+            schedule=IntervalSchedule.objects.create(interval=2)))
+        Habit.objects.create(user=self.user, task='Days', 
+                             schedule=DaysOfWeekSchedule.objects.create(days='1010100'))
+
+    def assertAgrees(self, summaries):
+        self.assertEqual(len(self.habits) - 1, len(summaries))
+        for habit in self.habits:
+            if habit.id not in summaries:
+                self.assertFalse(habit.getActivities())
+                continue
+            summary = summaries[habit.id]
+            summary.habit = habit
+            for offset in range(58, 70):
+                today = self.start + datetime.timedelta(offset)
+                if today < summary.last_date:
+                    continue
+                self.assertEqual(habit.getCurrentStreakTimes(today), 
+                                 summary.getCurrentStreakTimes(today))
+                self.assertEqual(habit.getCurrentStreakDays(today), 
+                                 summary.getCurrentStreakDays(today))
+                self.assertEqual(habit.getStarLevel(today), summary.getStarLevel(today))
+
+    def test_sql(self):
+        from django.db import connection
+        from habitmaster.habits.reports import currentIntervalStreaks, supportsWindowFunctions
+        if not supportsWindowFunctions(connection):
+            return
+        self.assertAgrees(currentIntervalStreaks(useSql=True))
+        ids = [self.habits[0].id, self.habits[-1].id]
+        self.assertEqual([ids[0]], currentIntervalStreaks(ids, useSql=True).keys())
+
+    def test_walk(self):
+        from habitmaster.habits.reports import currentIntervalStreaks
+        self.assertAgrees(currentIntervalStreaks(useSql=False))
+
+    def test_dashboard(self):
+        self.client.login(username='tester', password='secret')
+        self.assertEqual(302, self.client.get(reverse('dashboard')).status_code)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('dashboard'))
+        self.assertContains(response, 'Early')
+        self.assertContains(response, 'Mo/We/Fr')
+
+
+class LoadTestCommandTest(TestCase):
+
+    def test_percentile(self):
+        from habitmaster.habits.management.commands.loadtest import percentile
+        self.assertEqual(None, percentile([], 50))
+        self.assertEqual(2, percentile([1, 2, 3, 4], 50))
+        self.assertEqual(4, percentile([1, 2, 3, 4], 99))
+        self.assertEqual(1, percentile([1, 2, 3, 4], 0))
+
+    def test_run(self):
+        from django.core.management import call_command
+        from StringIO import StringIO
+        out = StringIO()
+        call_command('loadtest', users=3, habits=2, days=10, sessions=3, concurrency=1,
+                     think=0, seed=1, current_db=True, stdout=out)
+        report = out.getvalue()
+        for route in ('login', 'index', 'habit', 'activity_create'):
+            self.assertIn('\n' + route + ' ', report)
+        self.assertEqual(3, User.objects.filter(username__startswith='load').count())
+        self.assertFalse(Habit.objects.filter(summary__isnull=True).exists())
+        self.assertEqual(6, HabitSummary.objects.exclude(last_date=None).count())
+        login = [line for line in report.splitlines() if line.startswith('login ')][0]
+        self.assertEqual('0', login.split()[2])
+
+    def test_failedLogin(self):
+        import random
+        from habitmaster.habits.management.commands.loadtest import Command, RouteStats
+        stats = RouteStats()
+        Command().session('nobody', stats, 0, random.Random(1))
+        self.assertEqual(1, stats.errors['login'])
+
+
+class DigestCommandTest(TestCase):
+
+    def setUp(self):
+        self.today = datetime.date(2013, 5, 20)  # a Monday
+        self.user = User.objects.create_user('tester', 'tester@example.com', 'secret')
+        other = User.objects.create_user('other', 'other@example.com', 'secret')
+        mwf = DaysOfWeekSchedule.objects.create(days='1010100')
+        every2 = IntervalSchedule.objects.create(interval=2)
+        self.due = Habit.objects.create(user=self.user, task='Due Monday', schedule=mwf, 
+                                        active=True)
+        done = Habit.objects.create(user=self.user, task='Done already', schedule=mwf,
+                                    active=True)
+        Activity.objects.create(habit=done, date=self.today)
+        unsummarized = Habit.objects.create(user=self.user, task='Done, no summary', 
+                                            schedule=mwf, active=True)
+        Activity.objects.create(habit=unsummarized, date=self.today)
+        HabitSummary.objects.filter(habit=unsummarized).delete()
+        Streak.objects.filter(habit=unsummarized).delete()
+        early = Habit.objects.create(user=self.user, task='Due Tuesday', schedule=every2,
+                                     active=True)
+        Activity.objects.create(habit=early, date=self.today - datetime.timedelta(1))
+        Habit.objects.create(user=self.user, task='Inactive', schedule=mwf)
+        Habit.objects.create(user=other, task='Other lapsed', schedule=every2, active=True)
+        import tempfile
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.outdir)
+
+    def digest(self, **options):
+        from django.core.management import call_command
+        from StringIO import StringIO
+        call_command('digest', date=str(self.today), workers=1, batch_size=1, 
+                     stdout=StringIO(), **options)
+
+    def test_files(self):
+        self.digest(outdir=self.outdir)
+        self.assertEqual(['other.txt', 'tester.txt'], sorted(os.listdir(self.outdir)))
+        text = open(os.path.join(self.outdir, 'tester.txt')).read()
+        self.assertIn('Due Monday', text)
+        for task in ('Done already', 'Done, no summary', 'Due Tuesday', 'Inactive'):
+            self.assertNotIn(task, text)
+        self.assertIn('Other lapsed', open(os.path.join(self.outdir, 'other.txt')).read())
+
+    def test_email(self):
+        from django.core import mail
+        self.digest(email=True)
+        self.assertEqual(2, len(mail.outbox))
+        self.assertEqual(['tester@example.com'], mail.outbox[0].to)
+        self.assertIn('Due Monday', mail.outbox[0].body)
+
+
+class DueIndexTest(TestCase):
+    """ Habit.objects.dueOn should agree with nextRequiredDay and activeToday. """
+
+    def test_agreesWithSchedules(self):
+        import random
+        rand = random.Random(3)
+        user = User.objects.create_user('tester')
+        schedules = [DaysOfWeekSchedule.objects.create(days=days) 
+                     for days in ('1010100', '1111100', '0000011', '1111111')]
+        schedules += [IntervalSchedule.objects.create(interval=i) for i in (1, 2, 3, 7)]
+        schedules += [GoalSchedule.objects.create(times=times, period=period)
+                      for (times, period) in ((1, 7), (3, 7), (5, 30))]
+        habits = [Habit.objects.create(user=user, task=str(schedule), schedule=schedule)
+                  for schedule in schedules for i in range(2)]
+        start = datetime.date(2013, 4, 1)
+        for offset in range(45):
+            today = start + datetime.timedelta(offset)
+            # both before and after the day's activities are recorded
+            self.assertAgrees(habits, today)
+            for habit in habits:
+                if rand.random() < 0.6:
+                    Activity.objects.create(habit=habit, date=today)
+            self.assertAgrees(habits, today)
+
+    def assertAgrees(self, habits, today):
+        expected = set(habit.id for habit in habits if not habit.activeToday(today) and
+                       habit.nextRequiredDay(today) == today)
+        self.assertEqual(expected, set(Habit.objects.dueOn(today).values_list('id', flat=True)))
+
+    def test_masks(self):
+        schedule = DaysOfWeekSchedule.objects.create(days='1010100')
+        self.assertEqual(0b10101, schedule.mask)
+        self.assertIn(schedule.mask, DaysOfWeekSchedule.masksWith(4))
+        self.assertNotIn(schedule.mask, DaysOfWeekSchedule.masksWith(5))
+        self.assertEqual(64, len(DaysOfWeekSchedule.masksWith(6)))
+        self.assertEqual('1010100', DaysOfWeekSchedule.asDays(schedule.mask))
+
+    def test_missingMask(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        user = User.objects.create_user('tester')
+        schedule = DaysOfWeekSchedule.objects.create(days='1010100')
+        habit = Habit.objects.create(user=user, task='Old', schedule=schedule)
+        # as saved before the mask was added
+        DaysOfWeekSchedule.objects.filter(id=schedule.id).update(mask=0)
+        (wednesday, thursday) = (datetime.date(2013, 5, 8), datetime.date(2013, 5, 9))
+        self.assertEqual([habit.id], list(Habit.objects.dueOn(wednesday)
+                                          .values_list('id', flat=True)))
+        self.assertFalse(Habit.objects.dueOn(thursday).exists())
+        out = StringIO()
+        call_command('backfill', stdout=out)
+        self.assertIn('1 days-of-week', out.getvalue())
+        self.assertNotIn('Added column', out.getvalue())  # syncdb made it already
+        self.assertEqual(0b10101, DaysOfWeekSchedule.objects.get(id=schedule.id).mask)
+        self.assertTrue(Habit.objects.dueOn(wednesday).exists())
+        self.assertEqual(0, DaysOfWeekSchedule.backfillMasks())
+
+
+class ReplicaRoutingTest(TestCase):
+
+    def setUp(self):
+        from django.db import connections
+        from django.test.client import RequestFactory
+        from habitmaster.routers import ReadReplicaRouter, ReplicaMiddleware
+        self.factory = RequestFactory()
+        self.router = ReadReplicaRouter()
+        self.middleware = ReplicaMiddleware()
+        # a replica alias for another database, which is never actually connected to
+        connections.databases['otherdb'] = dict(connections.databases['default'],
+                                                 NAME='replica.db')
+        connections.databases['mirror'] = dict(connections.databases['default'])
+
+    def tearDown(self):
+        from django.db import connections
+        for alias in ('otherdb', 'mirror'):
+            del connections.databases[alias]
+            if hasattr(connections._connections, alias):
+                delattr(connections._connections, alias)
+
+    def route(self, request, view):
+        from django.http import HttpResponse
+        self.middleware.process_request(request)
+        self.middleware.process_view(request, view, (), {})
+        db = self.router.db_for_read(Habit)
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertEqual('default', self.router.db_for_read(Habit))
+        return (db, response)
+
+    def test_routing(self):
+        from django.test.utils import override_settings
+        from habitmaster.habits import views
+        from habitmaster.routers import STICKY_COOKIE
+        with override_settings(DATABASE_REPLICAS=['otherdb']):
+            self.assertEqual('otherdb', self.route(self.factory.get('/'), views.index)[0])
+            self.assertEqual('otherdb', self.route(self.factory.get('/'), views.detail)[0])
+            self.assertEqual('default', self.route(self.factory.get('/'), views.create)[0])
+
+            (db, response) = self.route(self.factory.post('/'), views.activity_create)
+            self.assertEqual('default', db)
+            self.assertIn(STICKY_COOKIE, response.cookies)
+            request = self.factory.get('/')
+            request.COOKIES[STICKY_COOKIE] = '1'
+            self.assertEqual('default', self.route(request, views.index)[0])
+        with override_settings(DATABASE_REPLICAS=['mirror']):
+            self.assertEqual('default', self.route(self.factory.get('/'), views.index)[0])
+        with override_settings(DATABASE_REPLICAS=[]):
+            (db, response) = self.route(self.factory.post('/'), views.activity_create)
+            self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+    def test_laggingReplica(self):
+        import sqlite3
+        import tempfile
+        from django.db import connections
+        from django.test.utils import override_settings
+        User.objects.create_user('tester', password='secret')
+        self.client.login(username='tester', password='secret')
+        user = User.objects.get(username='tester')
+        schedule = IntervalSchedule.objects.create(interval=1)
+        (stored, missing) = [Habit.objects.create(user=user, task=task, schedule=schedule)
+                             for task in ('Stored', 'Missing')]
+        start = datetime.date.today() - datetime.timedelta(days=5)
+        for habit in (stored, missing):
+            for day in range(2):
+                Activity.objects.create(habit=habit, date=start + datetime.timedelta(day))
+        HabitSummary.objects.all().delete()
+        Streak.objects.all().delete()
+
+        # a replica as of now, which then falls behind the primary
+        (handle, path) = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        replica = sqlite3.connect(path)
+        # (not iterdump, whose PRAGMAs would commit the test's transaction)
+        cursor = connections['default'].cursor()
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' "
+                       "AND name NOT LIKE 'sqlite_%%'")
+        for (table, sql) in cursor.fetchall():
+            replica.execute(sql)
+            cursor.execute('SELECT * FROM "%s"' % table)
+            for row in cursor.fetchall():
+                replica.execute('INSERT INTO "%s" VALUES (%s)' % (table, 
+                                ', '.join('?' * len(row))), row)
+        replica.commit()
+        replica.close()
+        connections.databases['lagging'] = dict(connections.databases['default'], NAME=path)
+        self.addCleanup(connections.databases.pop, 'lagging')
+        self.addCleanup(lambda: hasattr(connections._connections, 'lagging') and
+                        (connections['lagging'].close(), 
+                         delattr(connections._connections, 'lagging')))
+        stored.refreshSummary()
+        Activity.objects.create(habit=missing, date=start + datetime.timedelta(2))
+        HabitSummary.objects.filter(habit=missing).delete()
+        Streak.objects.filter(habit=missing).delete()
+
+        with override_settings(DATABASE_REPLICAS=['lagging']):
+            for url in (reverse('index'), reverse('habit', kwargs={'habit_id': stored.id})):
+                self.assertEqual(200, self.client.get(url).status_code)
+        # the summaries are those of the primary, with no duplicates
+        self.assertEqual(1, HabitSummary.objects.filter(habit=stored).count())
+        self.assertEqual(3, HabitSummary.objects.get(habit=missing).current_times)
+
+    def test_recycleConnection(self):
+        from django.db import DatabaseError
+        from habitmaster.connections import recycleConnection
+
+        class FakeConnection(object):
+            def __init__(self, broken=False):
+                self.connection = object()
+                self.opened_at = 100
+                self.broken = broken
+            def _rollback(self):
+                if self.broken:
+                    raise DatabaseError("gone away")
+            def close(self):
+                self.connection = None
+
+        self.assertFalse(recycleConnection(FakeConnection(), 60, now=150))
+        self.assertTrue(recycleConnection(FakeConnection(), 60, now=160))
+        self.assertTrue(recycleConnection(FakeConnection(broken=True), 60, now=150))
+        closed = FakeConnection()
+        closed.connection = None
+        self.assertFalse(recycleConnection(closed, 60, now=150))
+
+
+class ColdStartTest(TestCase):
+
+    def profile(self, **env):
+        from habitmaster.management.commands.importprofile import profileColdStart
+        with environ(**env):
+            result = profileColdStart('habitmaster.wsgi', reverse('login'))
+        self.assertTrue(result['status'].startswith('200'), result['status'])
+        self.assertIn('habitmaster.habits.views', result['modules'])
+        # the admin is only loaded when first used
+        self.assertFalse('habitmaster.admin_urls' in result['modules'])
+        self.assertFalse('habitmaster.habits.admin' in result['modules'])
+        return result['modules']
+
+    def test_imports(self):
+        modules = self.profile(SITE_PROFILE='production', ADMIN_ENABLED='0')
+        for name in ('django.contrib.admin', 'django.contrib.sites', 
+                     'django.contrib.messages.middleware'):
+            self.assertFalse(name in modules, name)
+        modules = self.profile(SITE_PROFILE='production', ADMIN_ENABLED='1')
+        self.assertIn('django.contrib.messages.middleware', modules)
+
+    def test_budget(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from django.utils.six import StringIO
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('importprofile', budget=0, stdout=out)
+        self.assertIn('modules loaded', out.getvalue())
+
+    def test_admin(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        response = self.client.get(reverse('admin:habits_habit_changelist'))
+        self.assertEqual(200, response.status_code)
+
+    def test_productionAdmin(self):
+        from django.test.utils import override_settings
+        production = loadSettings(SITE_PROFILE='production')
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        with override_settings(INSTALLED_APPS=production['INSTALLED_APPS'],
+                               MIDDLEWARE_CLASSES=production['MIDDLEWARE_CLASSES']):
+            response = self.client.post(reverse('admin:habits_intervalschedule_add'),
+                                        {'interval': 4})
+        self.assertEqual(302, response.status_code)
+        self.assertTrue(IntervalSchedule.objects.filter(interval=4).exists())
+
+
+class ArchiveTest(TestCase):
+    """ An archived habit should behave exactly like the same habit unarchived. """
+
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='secret')
+        self.start = datetime.date(2013, 4, 1)
+        self.cutoff = self.start + datetime.timedelta(30)
+
+    def makeTwins(self, schedule, seed):
+        """ Returns two habits with the same random history. """
+        import random
+        rand = random.Random(seed)
+        twins = [Habit.objects.create(user=self.user, task='Twin', schedule=schedule, 
+                                      active=True) for i in range(2)]
+        for offset in range(50):
+            if rand.random() < 0.7:
+                status = rand.choice([Activity.COMPLETED, Activity.HALF, Activity.MISSED])
+                note = rand.choice(['', 'felt good'])
+                for habit in twins:
+                    Activity.objects.create(habit=habit, status=status, note=note,
+                                            date=self.start + datetime.timedelta(offset))
+        return twins
+
+    def assertSame(self, archived, plain):
+        for offset in (52, 55, 60):
+            today = self.start + datetime.timedelta(offset)
+            results = []
+            for habit in (archived, plain):
+                habit = Habit.objects.get(id=habit.id)
+                streaks = habit.getStreaks(today)
+                results.append(([[act.date for act in streak] for streak in streaks],
+                    max(len(streak) for streak in streaks), habit.getStarLevel(today), 
+                    habit.getCurrentStreakTimes(today), habit.getCurrentStreakDays(today),
+                    habit.getTotalTimes(), habit.getTotalDays(today), habit.getStartDate(),
+                    habit.nextRequiredDay(today), habit.activeToday(today)))
+            self.assertEqual(results[0], results[1])
+        fields = [f.name for f in HabitSummary._meta.fields if f.name not in ('id', 'habit')]
+        summaries = [HabitSummary.objects.get(habit=habit) for habit in (archived, plain)]
+        self.assertEqual(*[[getattr(summary, f) for f in fields] for summary in summaries])
+
+    def archive(self, habit):
+        moved = habit.archiveBefore(self.cutoff)
+        self.assertTrue(moved > 0)
+        self.assertEqual(moved, ArchivedActivity.objects.filter(habit=habit).count())
+        self.assertFalse(Activity.objects.filter(habit=habit, 
+                                                 date__lt=habit.archived_until).exists())
+        self.assertTrue(habit.getArchivedActivities().reverse()[0].date < self.cutoff)
+
+    def test_identical(self):
+        schedules = [IntervalSchedule.objects.create(interval=i) for i in (1, 2, 3)]
+        schedules += [DaysOfWeekSchedule.objects.create(days=days) 
+                      for days in ('1111100', '1010100')]
+        for (seed, schedule) in enumerate(schedules):
+            (archived, plain) = self.makeTwins(schedule, seed)
+            self.archive(archived)
+            self.assertSame(archived, plain)
+            # archiving again (or further) keeps everything archived so far
+            self.cutoff += datetime.timedelta(10)
+            archived.archiveBefore(self.cutoff)
+            self.assertSame(archived, plain)
+            # and later changes are worked out the same
+            for habit in (archived, plain):
+                Activity.objects.filter(habit=habit).order_by('-date')[0].delete()
+                Activity.objects.create(habit=habit, date=self.start + datetime.timedelta(52))
+            self.assertSame(archived, plain)
+            self.cutoff -= datetime.timedelta(10)
+
+    def test_reports(self):
+        from habitmaster.habits.reports import currentIntervalStreaks
+        (archived, plain) = self.makeTwins(IntervalSchedule.objects.create(interval=2), 1)
+        self.archive(archived)
+        for useSql in (True, False):
+            summaries = currentIntervalStreaks([archived.id, plain.id], useSql=useSql)
+            self.assertEqual(summaries[plain.id].previous_days, 
+                             summaries[archived.id].previous_days)
+            self.assertEqual(summaries[plain.id].current_times, 
+                             summaries[archived.id].current_times)
+
+    def test_archivedUnchangeable(self):
+        (archived, plain) = self.makeTwins(IntervalSchedule.objects.create(interval=1), 2)
+        # as loaded before it was archived
+        stale = [Habit.objects.get(id=archived.id) for i in range(2)]
+        self.archive(archived)
+        with self.assertRaises(ValueError):
+            Activity.objects.create(habit=archived, date=self.start)
+        with self.assertRaises(ValueError):
+            Activity.objects.create(habit=stale[0], date=self.start)
+        with self.assertRaises(ValueError):
+            Activity.objects.recordOnce(stale[1], self.start)
+        self.client.login(username='tester', password='secret')
+        response = self.client.post(reverse('activity_create'), 
+                                    {'habit': archived.id, 'date': self.start.isoformat()})
+        self.assertContains(response, 'archived')
+
+    def test_history(self):
+        (archived, plain) = self.makeTwins(DaysOfWeekSchedule.objects.create(days='1111100'), 3)
+        self.archive(archived)
+        self.client.login(username='tester', password='secret')
+        pages = []
+        for habit in (archived, plain):
+            response = self.client.get(reverse('habit_history', kwargs={'habit_id': habit.id}))
+            pages.append(''.join(response))
+        for offset in range(50):
+            date = (self.start + datetime.timedelta(offset)).isoformat()
+            self.assertEqual(pages[1].count(date), pages[0].count(date), date)
+        self.assertEqual(pages[0].count('felt good'), pages[1].count('felt good'))
+        self.assertEqual(pages[0].count('<li'), pages[1].count('<li'))
+
+    def test_command(self):
+        from django.core.management import call_command
+        from StringIO import StringIO
+        (archived, plain) = self.makeTwins(IntervalSchedule.objects.create(interval=3), 4)
+        out = StringIO()
+        call_command('archive', before=self.cutoff.isoformat(), stdout=out)
+        self.assertIn('of 2 habits', out.getvalue())
+        self.assertSame(Habit.objects.get(id=archived.id), Habit.objects.get(id=plain.id))
+
+
+class IdempotentWriteTest(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('tester', 'tester@example.com', 'secret')
+        self.habit = Habit.objects.create(user=self.user, task='Once a day', 
+                                          schedule=IntervalSchedule.objects.create(interval=1))
+        self.today = datetime.date.today()
+
+    def test_retry(self):
+        self.client.login(username='tester', password='secret')
+        data = {'habit': self.habit.id, 'key': 'abc123'}
+        for attempt in range(2):
+            response = self.client.post(reverse('activity_create'), data)
+            self.assertRedirects(response, reverse('index'))
+        self.assertEqual(1, Activity.objects.filter(habit=self.habit).count())
+        self.assertEqual(1, HabitSummary.objects.get(habit=self.habit).current_times)
+        # without a key, a second activity that day is refused
+        response = self.client.post(reverse('activity_create'), {'habit': self.habit.id})
+        self.assertContains(response, 'already exists')
+        yesterday = self.today - datetime.timedelta(1)
+        response = self.client.post(reverse('activity_create'), 
+                                    dict(data, date=yesterday.isoformat()))
+        self.assertContains(response, 'already used')
+        self.assertEqual(1, Activity.objects.filter(habit=self.habit).count())
+        response = self.client.post(reverse('activity_create'), {'habit': self.habit.id},
+                                    HTTP_IDEMPOTENCY_KEY='k' * 65)
+        self.assertContains(response, 'too long', status_code=400)
+
+    def test_atomicSave(self):
+        from django.db import DatabaseError
+        act = Activity.objects.create(habit=self.habit, date=self.today)
+        record = ChangeLog.objects.record
+        def fail(*args):
+            raise DatabaseError('disk full')
+        ChangeLog.objects.record = fail
+        try:
+            act.date = self.today - datetime.timedelta(1)
+            self.assertRaises(DatabaseError, act.save)
+            self.assertRaises(DatabaseError, act.delete)
+        finally:
+            ChangeLog.objects.record = record
+        # the activity, its streaks, and the summary are all as they were
+        self.assertEqual(self.today, Activity.objects.get(habit=self.habit).date)
+        self.assertEqual([(self.today, self.today)], 
+                         list(Streak.objects.filter(habit=self.habit)
+                              .values_list('start', 'end')))
+        self.assertEqual(self.today, HabitSummary.objects.get(habit=self.habit).last_date)
+
+    def test_purge(self):
+        from django.core.management import call_command
+        from django.utils import timezone
+        from django.utils.six import StringIO
+        for (i, days) in enumerate((0, 1, 3, 10)):
+            (act, created) = Activity.objects.recordOnce(
+                self.habit, self.today - datetime.timedelta(i), key='key%d' % i)
+            IdempotencyKey.objects.filter(key='key%d' % i).update(
+                when=timezone.now() - datetime.timedelta(days=days, hours=1))
+        out = StringIO()
+        with self.settings(IDEMPOTENCY_KEY_DAYS=2):
+            call_command('purgekeys', stdout=out)
+        self.assertIn('Deleted 2', out.getvalue())
+        self.assertEqual(['key0', 'key1'], sorted(IdempotencyKey.objects.values_list(
+            'key', flat=True)))
+        # the activities stay
+        self.assertEqual(4, Activity.objects.filter(habit=self.habit).count())
+
+    def test_concurrent(self):
+        import tempfile
+        import threading
+        from django.core.management import call_command
+        from django.db import connections
+        # Each writer needs a connection of its own, so an in-memory test database (which
+        # only this thread's connection can see) is swapped for a file while they run.
+        original = connections.databases['default']
+        if original['NAME'] == ':memory:':
+            (fd, path) = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            connections.databases['default'] = dict(original, NAME=path)
+        start = threading.Event()
+        results = []
+        errors = []
+
+        def inThread(function, *args):
+            def run():
+                try:
+                    function(*args)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    connections['default'].close()
+            thread = threading.Thread(target=run)
+            thread.start()
+            return thread
+
+        def setUp():
+            if connections['default'].settings_dict is not original:
+                call_command('syncdb', interactive=False, verbosity=0, 
+                             load_initial_data=False)
+                user = User.objects.create_user('tester', 'tester@example.com', 'secret')
+                Habit.objects.create(user=user, task='Once a day', 
+                                     schedule=IntervalSchedule.objects.create(interval=1))
+
+        def write(key):
+            start.wait()
+            habit = Habit.objects.get(task='Once a day')
+            (act, created) = Activity.objects.recordOnce(habit, self.today, key=key)
+            results.append((key, act.id, created))
+
+        def check():
+            habit = Habit.objects.get(task='Once a day')
+            acts = Activity.objects.filter(habit=habit)
+            self.assertEqual(1, acts.count())
+            self.assertEqual(set([acts[0].id]), set(actId for (key, actId, created) in results))
+            self.assertEqual(1, HabitSummary.objects.get(habit=habit).current_times)
+
+        try:
+            inThread(setUp).join()
+            threads = [inThread(write, 'key%d' % (i % 4)) for i in range(12)]
+            start.set()
+            for thread in threads:
+                thread.join()
+            self.assertEqual([], errors)
+            self.assertEqual(12, len(results))
+            # exactly one key recorded it, and every retry of that key says so too
+            createdBy = set(key for (key, actId, created) in results if created)
+            self.assertEqual(1, len(createdBy))
+            self.assertEqual(3, len([r for r in results if r[0] in createdBy]))
+            inThread(check).join()
+            self.assertEqual([], errors)
+        finally:
+            if connections.databases['default'] is not original:
+                connections.databases['default'] = original
+                os.remove(path)
+
+
+class BulkCreateTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('tester', 'tester@example.com', 'secret')
+        self.client.login(username='tester', password='secret')
+
+    def post(self, data):
+        import json
+        response = self.client.post(reverse('habits_create_many'), json.dumps(data),
+                                    content_type='application/json')
+        return (response.status_code, json.loads(response.content))
+
+    def test_createMany(self):
+        existing = IntervalSchedule.objects.create(interval=3)
+        IntervalSchedule.objects.create(interval=3)  # a duplicate; the first is used
+        (status, data) = self.post({'habits': [
+            {'template': 'weekday workout'},
+            {'template': 'every 3 days', 'task': 'Call home'},
+            {'task': 'Stretch', 'days': '1111100'},
+            {'template': 'weekdays', 'task': 'Floss', 'interval': 1},
+        ]})
+        self.assertEqual(201, status)
+        habits = [Habit.objects.get(id=habitId) for habitId in data['ids']]
+        self.assertEqual(['Work out', 'Call home', 'Stretch', 'Floss'], 
+                         [habit.task for habit in habits])
+        self.assertEqual(habits[0].schedule_id, habits[2].schedule_id)
+        self.assertEqual(existing.id, habits[1].schedule_id)
+        self.assertEqual('Every day', unicode(habits[3].schedule))
+        self.assertEqual(4, DaysOfWeekSchedule.objects.count() + 
+                         IntervalSchedule.objects.count())
+        for habit in habits:
+            self.assertTrue(habit.active)
+            self.assertEqual(0, habit.summary.current_times)
+        self.assertEqual(set(data['ids']), 
+                         set(Habit.objects.dueOn(datetime.date(2013, 4, 1))
+                             .values_list('id', flat=True)))
+
+    def test_goals(self):
+        weekly4 = GoalSchedule.objects.create(times=4, period=7)
+        ids = Habit.objects.createMany(self.user, [
+            {'template': 'weekly workout goal'}, {'task': 'Swim', 'times': '3', 'per': 'week'},
+            {'template': 'weekly workout goal', 'task': 'Bike', 'times': 4, 'per': 'month'}])
+        habits = [Habit.objects.get(id=habitId) for habitId in ids]
+        self.assertEqual(habits[0].schedule_id, habits[1].schedule_id)
+        self.assertEqual(['3 times a week', '3 times a week', '4 times a month'],
+                         [unicode(habit.schedule.cast()) for habit in habits])
+        self.assertNotEqual(weekly4.id, habits[2].schedule_id)
+        self.assertEqual(3, GoalSchedule.objects.count())
+
+    def test_readBack(self):
+        from django.db import DatabaseError
+        schedule = IntervalSchedule.objects.create(interval=1)
+        # another habit saved at the same time, in among the new ones
+        Habit.objects.bulk_create([Habit(user=self.user, task=task, schedule=schedule) 
+                                   for task in ('Walk', 'Nap', 'Walk', 'Read')])
+        ids = list(Habit.objects.order_by('id').values_list('id', flat=True))
+        self.assertEqual([ids[0], ids[3]], Habit.objects._readBack(
+            self.user, 0, [('Walk', schedule.id), ('Read', schedule.id)]))
+        self.assertEqual(ids[2:], Habit.objects._readBack(
+            self.user, ids[1], [('Walk', schedule.id), ('Read', schedule.id)]))
+        with self.assertRaises(DatabaseError):
+            Habit.objects._readBack(self.user, 0, [('Read', schedule.id), 
+                                                   ('Walk', schedule.id)])
+
+    def test_invalid(self):
+        for habits in ([{'template': 'every 3 days'}], [{'task': 'Nap', 'days': '0000000'}],
+                       [{'task': 'Nap', 'interval': 9}], [{'template': 'fortnightly'}],
+                       [{'task': 'Nap', 'times': 8, 'per': 'week'}],
+                       [{'task': 'Nap', 'times': 2, 'per': 'day'}],
+                       {'habits': 'Nap'}):
+            (status, data) = self.post([{'template': 'daily', 'task': 'Walk'}] + habits 
+                                       if isinstance(habits, list) else habits)
+            self.assertEqual(400, status)
+            self.assertIn('error', data)
+        self.assertFalse(Habit.objects.exists())
+
+    def test_command(self):
+        from django.core.management import call_command
+        from StringIO import StringIO
+        out = StringIO()
+        call_command('createhabits', 'tester', template=['weekday workout', 'daily:Read'], 
+                     stdout=out)
+        self.assertIn('Created 2 habits', out.getvalue())
+        self.assertEqual(['Read', 'Work out'], sorted(Habit.objects.filter(user=self.user)
+                                                      .values_list('task', flat=True)))
+
+    def test_createView(self):
+        for task in ('Jog', 'Swim'):
+            response = self.client.post(reverse('habits_create'), 
+                {'task': task, 'schedule': 'days', 'Mo': 'on', 'We': 'on'})
+            self.assertRedirects(response, reverse('index'))
+        response = self.client.post(reverse('habits_create'), 
+                                    {'task': 'Rest', 'schedule': 'fixed', 'interval': '12'})
+        self.assertContains(response, 'interval must be')
+        habits = Habit.objects.filter(user=self.user)
+        self.assertEqual(2, habits.count())
+        self.assertEqual(1, len(set(habit.schedule_id for habit in habits)))
+        self.assertEqual('Mo/We', unicode(habits[0].schedule))
+
+
+class SyncTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('tester', 'tester@example.com', 'secret')
+        self.client.login(username='tester', password='secret')
+        (self.walk, self.read) = Habit.objects.createMany(self.user, [
+            {'template': 'daily', 'task': 'Walk'}, {'template': 'daily reading'}])
+        other = User.objects.create_user('other')
+        Habit.objects.createMany(other, [{'template': 'daily', 'task': 'Hide'}])
+
+    def sync(self, since=None):
+        import json
+        response = self.client.get(reverse('sync'), {'since': since} if since else {})
+        return json.loads(response.content)
+
+    def test_full(self):
+        Activity.objects.create(habit_id=self.walk, date=datetime.date.today())
+        data = self.sync()
+        self.assertTrue(data['full'])
+        self.assertEqual(4, data['cursor'])
+        self.assertEqual(['Walk', 'Read'], [habit['task'] for habit in data['habits']])
+        self.assertEqual(1, data['habits'][0]['times'])
+        self.assertEqual([self.walk], [act['habit'] for act in data['activities']])
+        # a cursor from some other server is no good either
+        self.assertTrue(self.sync(99)['full'])
+
+    def test_changes(self):
+        cursor = self.sync()['cursor']
+        self.assertEqual({'full': False, 'more': False, 'cursor': cursor, 'habits': [], 
+                          'activities': [], 'deleted': {'habits': [], 'activities': []}}, 
+                         self.sync(cursor))
+        today = datetime.date.today()
+        (act, created) = Activity.objects.recordOnce(Habit.objects.get(id=self.read), today)
+        Activity.objects.create(habit_id=self.walk, date=today).delete()
+        data = self.sync(cursor)
+        self.assertEqual([self.walk, self.read], [habit['id'] for habit in data['habits']])
+        self.assertEqual([0, 1], [habit['times'] for habit in data['habits']])
+        self.assertEqual([act.id], [item['id'] for item in data['activities']])
+        self.assertEqual(1, len(data['deleted']['activities']))
+
+        # in pages
+        from habitmaster.habits import views
+        views.SYNC_PAGE_SIZE = 3
+        try:
+            first = self.sync(cursor)
+            second = self.sync(first['cursor'])
+        finally:
+            views.SYNC_PAGE_SIZE = 500
+        self.assertTrue(first['more'])
+        self.assertEqual([act.id], [item['id'] for item in first['activities']])
+        self.assertEqual(data['cursor'], second['cursor'])
+        self.assertFalse(second['more'])
+        self.assertEqual(1, len(second['deleted']['activities']))
+
+    def test_invalid(self):
+        for since in ('x', '-1'):
+            response = self.client.get(reverse('sync'), {'since': since})
+            self.assertEqual(400, response.status_code)
+
+    def test_numbering(self):
+        self.assertEqual([1, 2], list(ChangeLog.objects.filter(user=self.user)
+                                      .order_by('seq').values_list('seq', flat=True)))
+        self.assertEqual(1, ChangeLog.objects.exclude(user=self.user).count())
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        from habitmaster import metrics
+        metrics.reset()
+        self.user = User.objects.create_user('tester', 'tester@example.com', 'secret')
+        start = datetime.date.today() - datetime.timedelta(30)
+        for (task, schedule) in (('Run', DaysOfWeekSchedule.objects.create(days='1010100')),
+                                 ('Read', IntervalSchedule.objects.create(interval=2))):
+            habit = Habit.objects.create(user=self.user, task=task, schedule=schedule)
+            for offset in range(0, 30, 2):
+                Activity.objects.create(habit=habit, date=start + datetime.timedelta(offset))
+        self.client.login(username='tester', password='secret')
+
+    def test_endpoint(self):
+        import json
+        import logging
+        from habitmaster import metrics
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        (handlers, level) = (metrics.logger.handlers, metrics.logger.level)
+        metrics.logger.handlers = [handler]
+        metrics.logger.setLevel(logging.INFO)
+        try:
+            habit = Habit.objects.get(task='Run')
+            Streak.objects.filter(habit=habit).delete()
+            HabitSummary.objects.filter(habit=habit).delete()
+            self.client.get(reverse('index'))
+        finally:
+            metrics.logger.handlers = handlers
+            metrics.logger.setLevel(level)
+        line = json.loads(records[-1].getMessage())
+        self.assertEqual((reverse('index'), 200, self.user.id), 
+                         (line['path'], line['status'], line['user']))
+        self.assertEqual(15, line['counts']['streaks.activities_scanned'])
+        self.assertEqual(1, line['counts']['streaks.memo.miss'])
+
+        data = json.loads(self.client.get(reverse('metrics'), {'format': 'json'}).content)
+        self.assertEqual(0.5, data['ratios']['streaks.memo.hit_ratio'])
+        self.assertIn('schedule.iterate_seconds', data['histograms'])
+        self.assertEqual(1, data['histograms']['request.activities_scanned']['count'])
+        self.assertEqual(1, data['histograms']['habit.history_size']['buckets']['20'])
+        text = self.client.get(reverse('metrics')).content
+        self.assertIn('habitmaster_request_schedule_casts_bucket{le="+Inf"} 2', text)
+        self.assertIn('habitmaster_streaks_activities_scanned_count', text)
+
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.1.2.3')
+        self.assertEqual(403, response.status_code)
+
+
+class EngineHarnessTest(TestCase):
+
+    def test_agree(self):
+        from habitmaster.habits.engines import checkEngines, engineNames
+        (mismatches, timings) = checkEngines(cases=12, seed=3, maxActivities=15)
+        self.assertEqual([], [unicode(mismatch) for mismatch in mismatches])
+        self.assertEqual(12, timings['reference'][0])
+        self.assertEqual(set(engineNames()), set(timings))
+
+    def test_shrink(self):
+        from habitmaster.habits.engines import ReferenceEngine, Case, register, unregister
+        from habitmaster.habits.engines import checkEngines
+
+        class Deduplicating(ReferenceEngine):
+            # wrong whenever there are two activities on a day
+            name = 'deduplicating'
+
+            def run(self, case):
+                offsets = sorted(set(case.offsets))
+                return ReferenceEngine.run(self, Case(case.schedule, offsets, case.today, 
+                                                      case.start))
+
+        register(Deduplicating())
+        try:
+            (mismatches, timings) = checkEngines(cases=30, seed=1, names=['deduplicating'])
+        finally:
+            unregister('deduplicating')
+        self.assertEqual(1, len(mismatches))
+        case = mismatches[0].case
+        self.assertEqual(2, len(case.offsets))
+        self.assertEqual(case.offsets[0], case.offsets[1])
+        self.assertTrue(mismatches[0].differences)
@@ -2,23 +2,143 @@
 Habits, creation, index overview, and details of a single habit.
 """
 
+from django.conf import settings
 from django.shortcuts import render
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, StreamingHttpResponse
+from django.middleware.csrf import get_token
+from django.template import RequestContext
+from django.template.loader import get_template, render_to_string
 from django.core.urlresolvers import reverse
-from django.contrib.auth.decorators import login_required
-from django.db import DatabaseError
+from django.contrib.auth.decorators import login_required, user_passes_test
+from django.core.paginator import Paginator, InvalidPage
+from django.db import DatabaseError, router
+from habitmaster.routers import readOnly
 from habitmaster.habits.models import DaysOfWeekSchedule, IntervalSchedule, Habit, Activity
-from habitmaster.habits.models import daysInStreak
+from habitmaster.habits.models import GoalSchedule, HabitSummary, ChangeLog, IdempotencyKey
+from habitmaster.habits.models import loadSummaries
+from habitmaster.habits.reports import currentIntervalStreaks
 import datetime
+import itertools
+import json
+import uuid
 
+# how many rows of a streamed page are worked out and sent at a time
+STREAM_CHUNK_SIZE = 50
+
+# how many changes a sync sends at most, before the client must ask for more
+SYNC_PAGE_SIZE = 500
+
+
+def _chunks(iterable, size):
+    """ Yields lists of up to size items from the given iterable. """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _streamPage(request, template, context, rowTemplate, name, chunks):
+    """
+    Returns a streaming response of the given page template, with the rows for the items
+    in each of the given chunks rendered in place of its {{ stream_marker }}, one chunk
+    at a time.  Each row is rendered by rowTemplate with the item as the given name.
+    
+    The rest of the page is rendered up front, so the browser can start on it at once.
+    """
+    marker = uuid.uuid4().hex
+    context['stream_marker'] = marker
+    (head, tail) = render_to_string(template, context, 
+                                    context_instance=RequestContext(request)).split(marker)
+    # rows are rendered after the CSRF middleware is done with the response, so make sure
+    # it knows now that a token is used
+    get_token(request)
+    rowContext = RequestContext(request, context)
+    row = get_template(rowTemplate)
+
+    def generate():
+        yield head
+        for chunk in chunks:
+            html = []
+            for item in chunk:
+                rowContext.push()
+                rowContext[name] = item
+                html.append(row.render(rowContext))
+                rowContext.pop()
+            yield ''.join(html)
+        yield tail
+    return StreamingHttpResponse(generate())
+
+
+@readOnly
 @login_required
 def index(request):
-    """ Main habit overview page. """
-    context = {'user': request.user}
-    context['habits'] = Habit.objects.filter(user=request.user)
-    context['today'] = datetime.date.today()
+    """ 
+    Main habit overview page.  For users with many habits (or given ?stream), the page is
+    streamed, working out the habits a chunk at a time.
+    """
+    context = {'user': request.user, 'request_key': uuid.uuid4().hex}
+    today = context['today'] = datetime.date.today()
+    habits = Habit.objects.filter(user=request.user).order_by('id')
+    if 'stream' in request.GET or habits.count() > settings.INDEX_STREAM_THRESHOLD:
+        chunks = (_markDue(loadSummaries(chunk), today)
+                  for chunk in _chunks(habits.iterator(), STREAM_CHUNK_SIZE))
+        return _streamPage(request, 'habits/index.html', context, 'habits/habit_row.html', 
+                           'habit', chunks)
+    context['habits'] = _markDue(loadSummaries(habits), today)
     return render(request, 'habits/index.html', context)
+
+
+def _markDue(habits, today):
+    """ Sets habit.due on each of the given habits, using one query for all of them. """
+    due = Habit.objects.dueOn(today).filter(id__in=[habit.id for habit in habits])
+    due = set(due.values_list('id', flat=True))
+    for habit in habits:
+        habit.due = habit.id in due
+    return habits
+
     
+@readOnly
+@user_passes_test(lambda user: user.is_staff)
+def dashboard(request):
+    """
+    Overview of many users' habits, with current streaks and star levels, for admins and
+    coaches (staff users).  The streaks of all IntervalSchedule habits on a page are worked
+    out together in one query; other habits use their stored summaries.
+    """
+    habits = Habit.objects.select_related('user').order_by('user__username', 'id')
+    try:
+        page = Paginator(habits, 200).page(request.GET.get('page', 1))
+    except InvalidPage:
+        return render(request, 'habits/error.html', {'error_mesg': "No such page."})
+    
+    scheduleIds = set(habit.schedule_id for habit in page.object_list)
+    schedules = IntervalSchedule.objects.in_bulk(scheduleIds)
+    schedules.update(DaysOfWeekSchedule.objects.in_bulk(scheduleIds))
+    schedules.update(GoalSchedule.objects.in_bulk(scheduleIds))
+    intervalIds = [habit.id for habit in page.object_list 
+                   if isinstance(schedules.get(habit.schedule_id), IntervalSchedule)]
+    intervals = currentIntervalStreaks(intervalIds, using=router.db_for_read(Activity))
+    summaries = HabitSummary.objects.filter(habit__in=[habit.id for habit in page.object_list
+                                                       if habit.id not in intervalIds])
+    summaries = dict((summary.habit_id, summary) for summary in summaries)
+    
+    rows = []
+    for habit in page.object_list:
+        if habit.id in intervalIds:
+            # those missing from the query have no activities yet
+            summary = intervals.get(habit.id) or HabitSummary()
+        else:
+            summary = summaries.get(habit.id) or habit.getSummary()
+        summary.habit = habit
+        rows.append({'habit': habit, 'summary': summary, 'status': summary.getStarLevel(),
+                     'schedule': schedules.get(habit.schedule_id, habit.schedule)})
+    dueToday = Habit.objects.dueOn(datetime.date.today()).filter(active=True).count()
+    return render(request, 'habits/dashboard.html', 
+                  {'page': page, 'rows': rows, 'due_today': dueToday})
+
+
 @login_required
 def create(request):
     """
@@ -26,7 +146,7 @@ def create(request):
     """
     context = {}
     if request.method == 'POST':
-        schedule = False
+        spec = None
         if not request.POST['task']:
             context['create_error'] = "You did not enter a description of your Task To Do."
         elif 'schedule' not in request.POST:
@@ -34,44 +154,139 @@ def create(request):
             "the week or on a regular rotating schedule?  Please select the corresponding "
             "radio button.")
         else:
-            # big two are fine, so check finer details while creating schedule
+            # big two are fine, so check finer details of the schedule
             if request.POST['schedule'] == 'days':
                 # convert
                 days = ''
                 for day in DaysOfWeekSchedule.DAYS_OF_WEEK:
                     days += str(1 if day in request.POST else 0)
-                #try
                 if int(days):  # not all 0s
-                    schedule = DaysOfWeekSchedule(days=days)
+                    spec = {'task': request.POST['task'], 'days': days}
                 else:
                     context['create_error'] = ("You said you wanted your habit to fall on "
                         "certain days, but you did not check the boxes for any specific days.")
 
             elif request.POST['schedule'] == 'fixed':
-                schedule = IntervalSchedule(interval=request.POST['interval'])
+                spec = {'task': request.POST['task'], 'interval': request.POST['interval']}
+
+            elif request.POST['schedule'] == 'goal':
+                spec = {'task': request.POST['task'], 'times': request.POST['times'],
+                        'per': request.POST['per']}
             
             else:
                 context['create_error'] = ("Bad form submission: Unrecognized schedule type.")
 
-        if schedule:
+        if spec:
             try:
-                schedule.save()
-                habit = Habit(user=request.user, task=request.POST['task'], schedule=schedule)
-                # XXX: For now... design suggests that we should start with pending
-                habit.active = True
-                habit.save()
+                Habit.objects.createMany(request.user, [spec])
                 return HttpResponseRedirect(reverse('index'))
-            except DatabaseError as e:
+            except (DatabaseError, ValueError) as e:
                 context['create_error'] = "Could not save new habit: " + str(e)                            
         
     # either GET request or an error resulted in POST request
     return render(request, 'habits/create.html', context)
-    
+
+
+def _jsonResponse(data, status=200):
+    return HttpResponse(json.dumps(data, separators=(',', ':')), status=status, 
+                        content_type='application/json')
+
 
 @login_required
-def detail(request, habit_id):
+def create_many(request):
     """
-    Display the detailed view for a single habit.
+    Creates many habits at once, for onboarding and imports.  Takes a POST of JSON: a list
+    of habits (or {"habits": [...]}), each with a "task" and a schedule, given as "days"
+    (like "1111100"), "interval", or "times" "per" "week" or "month", or a "template"
+    name (see HABIT_TEMPLATES) to take them from.  Responds with JSON: the ids of the new
+    habits, in order, or an error.
+    """
+    if request.method != 'POST':
+        return _jsonResponse({'error': "Not a POST request."}, status=405)
+    try:
+        specs = json.loads(request.body)
+        if isinstance(specs, dict):
+            specs = specs.get('habits')
+        if not isinstance(specs, list) or not all(isinstance(spec, dict) for spec in specs):
+            raise ValueError("Expected a list of habits.")
+        ids = Habit.objects.createMany(request.user, specs)
+    except (DatabaseError, ValueError) as e:
+        return _jsonResponse({'error': str(e)}, status=400)
+    return _jsonResponse({'ids': ids}, status=201)
+
+
+def _isoDate(date):
+    return date.isoformat() if date else None
+
+
+def _habitState(habit, today):
+    """ A habit and its summary for sync, as a dict that can be made JSON. """
+    summary = habit.summary
+    return {'id': habit.id, 'task': habit.task, 'schedule': unicode(habit.schedule),
+            'active': habit.active, 'stars': summary.getStarLevel(today), 
+            'next': _isoDate(summary.nextRequiredDay(today)),
+            'first': _isoDate(summary.first_date), 'start': _isoDate(summary.current_start),
+            'last': _isoDate(summary.last_date), 'deadline': _isoDate(summary.deadline),
+            'times': summary.getCurrentStreakTimes(today), 'total': summary.total_times,
+            'longest': summary.longest_times}
+
+
+def _activityState(act):
+    return {'id': act.id, 'habit': act.habit_id, 'date': act.date.isoformat(),
+            'status': act.status, 'note': act.note}
+
+
+@login_required
+def sync(request):
+    """
+    What changed in the user's habits and activities since the client last synced, as 
+    JSON, for clients that keep their own copy (say, to work offline).  The client sends
+    the cursor from its last sync as ?since=, and gets back the current state of every
+    habit and activity changed since then (each habit with its summary, as of today), 
+    the ids of those that were deleted (a deleted habit's activities go with it), and the
+    new cursor.  If "more" is true, there were more than SYNC_PAGE_SIZE changes, and the
+    client should sync again from the new cursor for the rest.
+
+    Without a cursor (or with one this server never gave), everything is sent, with 
+    "full" true: the client should then replace its copy.  Archived activities are not
+    included; those are only in the history page.
+
+    This reads from the primary database, since a replica could be behind its own cursor.
+    """
+    try:
+        since = int(request.GET.get('since') or 0)
+    except ValueError:
+        since = -1
+    if since < 0:
+        return _jsonResponse({'error': "The cursor must be a change number."}, status=400)
+    today = datetime.date.today()
+    user = request.user
+    current = ChangeLog.objects.getCursor(user.id)
+    data = {'full': not since or since > current, 'more': False}
+    if data['full']:
+        data['cursor'] = current
+        habits = Habit.objects.filter(user=user)
+        activities = Activity.objects.filter(habit__user=user)
+    else:
+        (data['cursor'], habitIds, activityIds, data['more']) = \
+            ChangeLog.objects.changesSince(user.id, since, SYNC_PAGE_SIZE)
+        habits = Habit.objects.filter(user=user, id__in=habitIds)
+        activities = Activity.objects.filter(habit__user=user, id__in=activityIds)
+    habits = loadSummaries(habits.order_by('id'))
+    data['habits'] = [_habitState(habit, today) for habit in habits]
+    activities = list(activities.order_by('habit', 'date', 'id'))
+    data['activities'] = [_activityState(act) for act in activities]
+    if not data['full']:
+        data['deleted'] = {
+            'habits': sorted(habitIds - set(habit.id for habit in habits)),
+            'activities': sorted(activityIds - set(act.id for act in activities))}
+    return _jsonResponse(data)
+
+
+def _lookupHabit(request, habit_id):
+    """
+    Returns the habit with the given id and None, or else None and an error page if that
+    habit does not exist or does not belong to the current user.
     """
     context = {}
     try:
@@ -79,29 +294,116 @@ def detail(request, habit_id):
     except:
         context['error_mesg'] = ("Sorry, but habit #" + str(habit_id) + 
             " was not found in the database.")
-        return render(request, 'habits/error.html', context)
+        return (None, render(request, 'habits/error.html', context))
     if habit.user != request.user:
         context['error_mesg'] = ("Sorry, but habit #" + str(habit_id) + "is not your habit, "
             "so you do not have permission to view it.")
-        return render(request, 'habits/error.html', context)
-        
-    context['habit'] = habit
-    context['status'] = habit.getStarLevel()
-    streaks = habit.getStreaks()
-  
-    longest = max(streaks, key=len)    
-    context['longest_times'] = len(longest)
-    if longest == streaks[-1]:
-        context['longest_days'] = daysInStreak(longest, until=datetime.date.today())
-    else:
-        context['longest_days'] = daysInStreak(longest)
-    context['activities'] = habit.getActivities(missed=True)
+        return (None, render(request, 'habits/error.html', context))
+    return (habit, None)
+
+
+@readOnly
+@login_required
+def detail(request, habit_id):
+    """
+    Display the detailed view for a single habit.
     
+    Everything shown comes from the habit's stored summary, so this page costs the same
+    no matter how long the habit's history is.  The history itself is a separate fragment
+    (see detail_history), fetched by the page once it has loaded.
+    """
+    (habit, error) = _lookupHabit(request, habit_id)
+    if error:
+        return error
+    summary = habit.getSummary()
+    context = {'habit': habit, 'summary': summary}
+    context['status'] = summary.getStarLevel()
+    context['status_levels'] = Activity.STATUS_LEVELS
+    context['default_status'] = Activity.COMPLETED
     return render(request, 'habits/detail.html', context)
 
 
+@readOnly
+@login_required
+def detail_history(request, habit_id):
+    """
+    The full activity history of a single habit, as an HTML fragment of the detail page.
+    This is streamed a chunk of activities at a time, starting with any archived ones.
+    """
+    (habit, error) = _lookupHabit(request, habit_id)
+    if error:
+        return error
+    sources = [habit.getActivities(missed=True)]
+    if habit.archived_until:
+        sources.insert(0, habit.getArchivedActivities(missed=True))
+    context = {'habit': habit, 'status_levels': Activity.STATUS_LEVELS}
+    if not any(source.exists() for source in sources):
+        return render(request, 'habits/history.html', context)
+    context['streaming'] = True
+    activities = itertools.chain(*[source.iterator() for source in sources])
+    return _streamPage(request, 'habits/history.html', context, 'habits/activity_row.html', 
+                       'act', _chunks(activities, STREAM_CHUNK_SIZE))
+
+
+def _parseActivity(request, activity=None):
+    """
+    Returns the (date, status, note) given for an activity by a POST request.  Any that
+    are not given keep their values from the given existing activity, or else default to
+    a plain completion today.  Raises ValueError with a message for the user if any of
+    these are invalid.
+    """
+    if activity:
+        (date, status, note) = (activity.date, activity.status, activity.note)
+    else:
+        (date, status, note) = (datetime.date.today(), Activity.COMPLETED, '')
+    if request.POST.get('date'):
+        try:
+            date = datetime.datetime.strptime(request.POST['date'], '%Y-%m-%d').date()
+        except ValueError:
+            raise ValueError("Dates must be given as YYYY-MM-DD.")
+        if date > datetime.date.today():
+            raise ValueError("You cannot record an activity for a day that has not happened yet.")
+    if request.POST.get('status'):
+        try:
+            status = int(request.POST['status'])
+        except ValueError:
+            status = None
+        if status not in dict(Activity.STATUS_LEVELS):
+            raise ValueError("Unrecognized activity status.")
+    return (date, status, request.POST.get('note', note))
+
+
+def _redirectAfter(request, habit):
+    """ Where to go after changing one of a habit's activities. """
+    if request.POST.get('next') == 'habit':
+        return HttpResponseRedirect(reverse('habit', kwargs={'habit_id': habit.id}))
+    return HttpResponseRedirect(reverse('index'))
+
+
+def _lookupActivity(request, activity_id):
+    """ Like _lookupHabit, but for an activity of one of the current user's habits. """
+    context = {}
+    try:
+        act = Activity.objects.select_related('habit').get(id=activity_id)
+    except Activity.DoesNotExist:
+        context['error_mesg'] = ("Sorry, but activity #" + str(activity_id) + 
+            " was not found in the database.")
+        return (None, render(request, 'habits/error.html', context))
+    if act.habit.user != request.user:
+        context['error_mesg'] = ("Sorry, but activity #" + str(activity_id) + " is not for "
+            "one of your habits, so you do not have permission to modify it.")
+        return (None, render(request, 'habits/error.html', context))
+    return (act, None)
+
+
 @login_required
 def activity_create(request):
+    """
+    Records an activity for a habit.  This is for today, unless an earlier date is given.
+
+    Clients can send a key for the request (as the 'key' field or an Idempotency-Key
+    header); retries with the same key then get the same result without recording twice.
+    """
     context = {}
     if request.method == 'POST':
         try:
@@ -111,20 +413,29 @@ def activity_create(request):
                 " was not found in the database.")
             return render(request, 'habits/error.html', context)
         if habit.user != request.user:
-            context['error_mesg'] = ("Sorry, but habit #" + str(habit_id) + "is not your habit, "
+            context['error_mesg'] = ("Sorry, but habit #" + str(habit.id) + "is not your habit, "
                 "so you do not have permission to view or modify it.")
             return render(request, 'habits/error.html', context)
         
-        acts = Activity.objects.filter(habit=habit, date=datetime.date.today())
-        if acts:
-            context['error_mesg'] = "An activity with today's date already exists: " + str(acts[0])
-        else:        
-            try:
-                act = Activity.objects.create(date=datetime.date.today(), habit=habit)
-                act.save()
-                return HttpResponseRedirect(reverse('index'))
-            except DatabaseError as e:
-                context['error_mesg'] = "Could not create new activity: " + str(e)        
+        try:
+            (date, status, note) = _parseActivity(request)
+        except ValueError as e:
+            context['error_mesg'] = str(e)
+            return render(request, 'habits/error.html', context)
+        key = request.POST.get('key') or request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if key and len(key) > IdempotencyKey._meta.get_field('key').max_length:
+            context['error_mesg'] = "The request key is too long."
+            return render(request, 'habits/error.html', context, status=400)
+        try:
+            (act, created) = Activity.objects.recordOnce(habit, date, status, note, 
+                                                         key=key)
+            if created:
+                return _redirectAfter(request, habit)
+            context['error_mesg'] = "An activity with that date already exists"
+            if act:
+                context['error_mesg'] += ": " + str(act)
+        except (DatabaseError, ValueError) as e:
+            context['error_mesg'] = "Could not create new activity: " + str(e)        
     
     else:
         # FIXME: replace with form
@@ -134,3 +445,55 @@ def activity_create(request):
         return render(request, 'habits/error.html', context)
     
     return render(request, 'habits/index.html', context)
+
+
+@login_required
+def activity_edit(request, activity_id):
+    """
+    Changes the date, status, or note of an existing activity.
+    """
+    context = {}
+    if request.method != 'POST':
+        context['error_mesg'] = "Not a POST request."
+        return render(request, 'habits/error.html', context)
+    (act, error) = _lookupActivity(request, activity_id)
+    if error:
+        return error
+    try:
+        (date, status, note) = _parseActivity(request, act)
+    except ValueError as e:
+        context['error_mesg'] = str(e)
+        return render(request, 'habits/error.html', context)
+    acts = Activity.objects.filter(habit=act.habit, date=date).exclude(id=act.id)
+    if acts:
+        context['error_mesg'] = "An activity with that date already exists: " + str(acts[0])
+        return render(request, 'habits/error.html', context)
+    act.date = date
+    act.status = status
+    act.note = note
+    try:
+        act.save()
+    except (DatabaseError, ValueError) as e:
+        context['error_mesg'] = "Could not change activity: " + str(e)
+        return render(request, 'habits/error.html', context)
+    return _redirectAfter(request, act.habit)
+
+
+@login_required
+def activity_delete(request, activity_id):
+    """
+    Removes an activity.
+    """
+    context = {}
+    if request.method != 'POST':
+        context['error_mesg'] = "Not a POST request."
+        return render(request, 'habits/error.html', context)
+    (act, error) = _lookupActivity(request, activity_id)
+    if error:
+        return error
+    try:
+        act.delete()
+    except DatabaseError as e:
+        context['error_mesg'] = "Could not delete activity: " + str(e)
+        return render(request, 'habits/error.html', context)
+    return _redirectAfter(request, act.habit)
@@ -0,0 +1,112 @@
+"""
+Measures cold start: in a fresh Python process, imports the WSGI application and serves
+it one request, timing every module imported along the way.  Reports the slowest imports
+and fails if the whole start took longer than the COLD_START_BUDGET setting.
+
+    manage.py importprofile --limit 20
+    SITE_PROFILE=production manage.py importprofile --url /login/ --budget 1.5
+"""
+
+from optparse import make_option
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Run in the child process.  Times every import that loads a module for the first time;
+# the self time of an import excludes the imports it made in turn.
+PROFILE_SCRIPT = r"""
+import json, sys, time
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+from wsgiref.util import setup_testing_defaults
+
+realImport = builtins.__import__
+imports = {}
+children = []
+
+def timedImport(name, *args, **kwargs):
+    loaded = len(sys.modules)
+    children.append(0.0)
+    start = time.time()
+    try:
+        return realImport(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        inner = children.pop()
+        if children:
+            children[-1] += elapsed
+        if len(sys.modules) > loaded and name not in imports:
+            imports[name] = (elapsed, elapsed - inner)
+
+builtins.__import__ = timedImport
+start = time.time()
+module = __import__(sys.argv[1], fromlist=['application'])
+imported = time.time() - start
+environ = {'PATH_INFO': sys.argv[2], 'REQUEST_METHOD': 'GET'}
+setup_testing_defaults(environ)
+status = []
+body = module.application(environ, lambda s, headers, exc_info=None: status.append(s))
+b''.join(body)
+total = time.time() - start
+builtins.__import__ = realImport
+print(json.dumps({'imported': imported, 'total': total, 'status': status[0],
+                  'imports': imports, 'modules': sorted(sys.modules)}))
+"""
+
+
+def profileColdStart(module, url):
+    """
+    Runs PROFILE_SCRIPT in a new Python process with the current environment and settings.
+    Returns its results: a dict of the seconds taken to import the module ('imported') and
+    to also serve the request ('total'), the response 'status', the (cumulative, self)
+    seconds of each import by name ('imports'), and all the 'modules' loaded by the end.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    env.setdefault('DJANGO_SETTINGS_MODULE', os.environ.get('DJANGO_SETTINGS_MODULE', 
+                                                            'habitmaster.settings'))
+    process = subprocess.Popen([sys.executable, '-c', PROFILE_SCRIPT, module, url], 
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    (out, err) = process.communicate()
+    if process.returncode:
+        raise CommandError("Profiling %s failed:\n%s" % (module, err.decode('utf-8')))
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--module', default='habitmaster.wsgi',
+            help='Module defining the WSGI application. [default: %default]'),
+        make_option('--url', default='/login/',
+            help='Path of the first request to serve. [default: %default]'),
+        make_option('--limit', type='int', default=25,
+            help='Number of slowest imports to list. [default: %default]'),
+        make_option('--budget', type='float', default=None,
+            help='Seconds allowed for the whole cold start. '
+                 '[default: the COLD_START_BUDGET setting]'),
+    )
+    help = ('Reports the import time of each module loaded while starting the site and '
+            'serving its first request, and checks the total against a budget.')
+
+    def handle(self, *args, **options):
+        budget = options['budget']
+        if budget is None:
+            budget = settings.COLD_START_BUDGET
+        result = profileColdStart(options['module'], options['url'])
+
+        self.stdout.write("%-50s %10s %10s" % ('import', 'total ms', 'self ms'))
+        slowest = sorted(result['imports'].items(), key=lambda item: -item[1][1])
+        for (name, (total, own)) in slowest[:options['limit']]:
+            self.stdout.write("%-50s %10.1f %10.1f" % (name, total * 1000, own * 1000))
+        self.stdout.write("%d modules loaded." % len(result['modules']))
+        self.stdout.write("Import of %s: %.0f ms; with first request to %s (%s): %.0f ms." %
+                          (options['module'], result['imported'] * 1000, options['url'], 
+                           result['status'], result['total'] * 1000))
+        if result['total'] > budget:
+            raise CommandError("Cold start took %.2fs, over the budget of %.2fs." % 
+                               (result['total'], budget))
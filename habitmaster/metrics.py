@@ -0,0 +1,168 @@
+"""
+Counters and histograms of what the habit engine does: how many activities each streak
+computation scans, how often schedules are cast, how often stored summaries (the streak
+memo) are found rather than recomputed, time spent walking DaysOfWeekSchedule dates, and
+how long the histories loaded are.  These tell which requests, users, and habits drive
+slow responses, and whether an optimization did what it should.
+
+The engine reports through increment and observe.  MetricsMiddleware also tallies what
+each request did, turns the per-request counts into histograms, and logs them with the
+request as one JSON line to the 'habitmaster.metrics' logger.  The /metrics/ page (see
+habitmaster.views.metrics) shows everything since the process started.
+
+Turned off altogether by METRICS_ENABLED = False.
+"""
+
+import bisect
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger('habitmaster.metrics')
+
+# upper bounds of the histogram buckets (with one more bucket for anything above)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+SECONDS_BUCKETS = (.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 10)
+
+# counts tallied for each request, and the histograms they are reported under
+PER_REQUEST = {
+    'schedule.cast': 'request.schedule_casts',
+    'streaks.calls': 'request.streak_calls',
+    'streaks.activities_scanned': 'request.activities_scanned',
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_request = threading.local()
+
+
+class Histogram(object):
+    """ Counts of observed values by bucket, plus their count and sum. """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def asDict(self):
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        return {'buckets': dict(zip(bounds, self.counts)), 'count': self.count,
+                'sum': self.sum}
+
+
+def increment(name, amount=1):
+    """ Adds to the named counter, and to this request's tally of it. """
+    if not settings.METRICS_ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+    tally = getattr(_request, 'tally', None)
+    if tally is not None:
+        tally[name] = tally.get(name, 0) + amount
+
+
+def observe(name, value, buckets=SIZE_BUCKETS):
+    """ 
+    Records a value in the named histogram, which has the given buckets, and adds it to
+    this request's tally of that name.
+    """
+    if not settings.METRICS_ENABLED:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+    tally = getattr(_request, 'tally', None)
+    if tally is not None:
+        tally[name] = tally.get(name, 0) + value
+
+
+def snapshot():
+    """ Returns all the counters and histograms, as a dict that can be made JSON. """
+    with _lock:
+        data = {'counters': dict(_counters),
+                'histograms': dict((name, histogram.asDict())
+                                   for (name, histogram) in _histograms.items())}
+    hits = data['counters'].get('streaks.memo.hit', 0)
+    misses = data['counters'].get('streaks.memo.miss', 0)
+    data['ratios'] = {'streaks.memo.hit_ratio':
+                      float(hits) / (hits + misses) if hits + misses else None}
+    return data
+
+
+def reset():
+    """ Forgets everything recorded so far. """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _promName(name):
+    return 'habitmaster_' + name.replace('.', '_')
+
+
+def asPrometheus(data):
+    """ Returns the given snapshot in the Prometheus text exposition format. """
+    lines = []
+    for (name, value) in sorted(data['counters'].items()):
+        lines.append('# TYPE %s counter' % _promName(name))
+        lines.append('%s %s' % (_promName(name), value))
+    for (name, value) in sorted(data['ratios'].items()):
+        if value is not None:
+            lines.append('# TYPE %s gauge' % _promName(name))
+            lines.append('%s %s' % (_promName(name), value))
+    for (name, histogram) in sorted(data['histograms'].items()):
+        name = _promName(name)
+        lines.append('# TYPE %s histogram' % name)
+        bounds = sorted((bound for bound in histogram['buckets'] if bound != '+Inf'),
+                        key=float) + ['+Inf']
+        total = 0
+        for bound in bounds:
+            total += histogram['buckets'][bound]
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, total))
+        lines.append('%s_sum %s' % (name, histogram['sum']))
+        lines.append('%s_count %d' % (name, histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware(object):
+    """
+    Tallies what the engine does for each request (see PER_REQUEST), and logs it with the
+    request's path, user, status, and time.  Goes first in MIDDLEWARE_CLASSES, so that it
+    covers everything else.  (The rest of a streamed page is not counted.)
+    """
+
+    def process_request(self, request):
+        if settings.METRICS_ENABLED:
+            _request.tally = {}
+            _request.start = time.time()
+
+    def process_response(self, request, response):
+        tally = getattr(_request, 'tally', None)
+        if tally is None:
+            return response
+        _request.tally = None
+        seconds = time.time() - _request.start
+        observe('request.seconds', seconds, SECONDS_BUCKETS)
+        for (name, histogram) in PER_REQUEST.items():
+            observe(histogram, tally.get(name, 0))
+        if logger.isEnabledFor(logging.INFO):
+            user = getattr(request, 'user', None)
+            logger.info(json.dumps({
+                'path': request.path, 'method': request.method,
+                'status': response.status_code, 'seconds': round(seconds, 6),
+                'user': user.id if user is not None and user.is_authenticated() else None,
+                'counts': tally,
+            }, sort_keys=True))
+        return response
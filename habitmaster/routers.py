@@ -0,0 +1,100 @@
+"""
+Sends the reads of read-only views to the database replicas, and everything else to the
+default (primary) database.
+
+Views opt in with the readOnly decorator; ReplicaMiddleware then routes the reads of a
+GET request to such a view to a replica.  After a user writes anything, their reads stay
+on the primary for REPLICA_STICKY_SECONDS, so they see their own change even if the
+replicas have not caught up with it yet.  Code in a readOnly view that writes anyway
+(like computing a missing stored summary) reads what it writes from within primary().
+
+Replicas are the aliases in the DATABASE_REPLICAS setting.  With none, everything goes
+to the default database.  A replica alias for the same database as the default one (as in
+tests, where replicas mirror the default test database) is read through the default
+connection instead, so that it sees the same transaction.
+"""
+
+import contextlib
+import random
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+STICKY_COOKIE = 'primary'
+
+_state = threading.local()
+
+
+def readOnly(view):
+    """ Marks the given view as safe to serve from a database replica. """
+    view.read_only = True
+    return view
+
+
+def useReplica(value):
+    """ Sets whether this thread's reads should go to a replica. """
+    _state.useReplica = value
+
+
+@contextlib.contextmanager
+def primary():
+    """ 
+    Sends this thread's reads to the primary database within the block, for code that 
+    writes what it reads (like stored summaries), even in a readOnly view.
+    """
+    saved = getattr(_state, 'useReplica', False)
+    useReplica(False)
+    try:
+        yield
+    finally:
+        useReplica(saved)
+
+
+def _sameDatabase(alias, other):
+    keys = ('ENGINE', 'NAME', 'HOST', 'PORT')
+    return ([connections[alias].settings_dict[key] for key in keys] ==
+            [connections[other].settings_dict[key] for key in keys])
+
+
+class ReadReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        if getattr(_state, 'useReplica', False) and settings.DATABASE_REPLICAS:
+            alias = random.choice(settings.DATABASE_REPLICAS)
+            if not _sameDatabase(alias, 'default'):
+                return alias
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_syncdb(self, db, model):
+        return db == 'default'
+
+
+class ReplicaMiddleware(object):
+    """
+    Routes the reads of GET requests to readOnly views to a replica, unless the user
+    has written something within the last REPLICA_STICKY_SECONDS.
+    """
+
+    def process_request(self, request):
+        useReplica(False)
+
+    def process_view(self, request, view, args, kwargs):
+        useReplica(request.method in ('GET', 'HEAD') and getattr(view, 'read_only', False)
+                   and STICKY_COOKIE not in request.COOKIES)
+
+    def process_response(self, request, response):
+        if not getattr(response, 'streaming', False):
+            # (a streamed page does most of its reads after this)
+            useReplica(False)
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and settings.DATABASE_REPLICAS:
+            response.set_cookie(STICKY_COOKIE, '1', max_age=settings.REPLICA_STICKY_SECONDS,
+                                httponly=True)
+        return response
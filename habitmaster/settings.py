@@ -1,4 +1,5 @@
 # Django settings for habitmaster project.
+import os
 
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
@@ -93,10 +94,13 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'habitmaster.metrics.MetricsMiddleware',
+    'habitmaster.routers.ReplicaMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'habitmaster.users.auth.RememberMeMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -147,7 +151,10 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
-        }
+        },
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
     },
     'loggers': {
         'django.request': {
@@ -155,6 +162,12 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        # one JSON line per request when INFO; see habitmaster.metrics
+        'habitmaster.metrics': {
+            'handlers': ['console'],
+            'level': os.environ.get('METRICS_LOG_LEVEL', 'WARNING'),
+            'propagate': False,
+        },
     }
 }
 
@@ -162,9 +175,92 @@ LOGGING = {
 import dj_database_url
 DATABASES['default'] =  dj_database_url.config()
 
+# Read replicas, as space-separated database URLs.  Read-only views read from these; see
+# habitmaster.routers.  (In tests, each replica is the test default database.)
+DATABASE_REPLICAS = []
+for (i, url) in enumerate(os.environ.get('REPLICA_DATABASE_URLS', '').split()):
+    DATABASE_REPLICAS.append('replica%d' % i)
+    DATABASES['replica%d' % i] = dict(dj_database_url.parse(url), TEST_MIRROR='default')
+DATABASE_ROUTERS = ['habitmaster.routers.ReadReplicaRouter']
+# How long, in seconds, a user's reads stay on the primary database after they write
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+
+# How long, in seconds, a database connection is kept for reuse by later requests; 0
+# opens a new connection for every request.  See habitmaster.connections.
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 0))
+
 # Honor the 'X-Forwarded-Proto' header for request.is_secure()
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
 LOGIN_URL='/login/'
 LOGOUT_URL='/logout/'
 
+# Login pipeline (see habitmaster.users.auth).  PASSWORD_ITERATIONS is the hashing work 
+# factor; stored passwords with fewer iterations are rehashed the next time they are used.
+PASSWORD_ITERATIONS = int(os.environ.get('PASSWORD_ITERATIONS', 10000))
+PASSWORD_HASHERS = (
+    'habitmaster.users.auth.TunablePBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.BCryptPasswordHasher',
+    'django.contrib.auth.hashers.SHA1PasswordHasher',
+    'django.contrib.auth.hashers.MD5PasswordHasher',
+    'django.contrib.auth.hashers.CryptPasswordHasher',
+)
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 
+                                  'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+# With a cache shared by all the workers (like memcached), sessions are read from the 
+# cache, falling back to the database on a miss.  A per-process cache would keep serving
+# a session to other workers after it was logged out or flushed in one, so without one
+# sessions are only in the database.
+_localCaches = ('django.core.cache.backends.locmem.LocMemCache', 
+                'django.core.cache.backends.dummy.DummyCache')
+SESSION_ENGINE = os.environ.get('SESSION_ENGINE', 
+    'django.contrib.sessions.backends.db' if CACHES['default']['BACKEND'] in _localCaches
+    else 'django.contrib.sessions.backends.cached_db')
+
+# Counters and histograms of the habit engine (see habitmaster.metrics), shown at /metrics/
+# to requests from these addresses and to staff users.  METRICS_LOG_LEVEL=INFO also logs
+# what each request did.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1 ::1').split()
+
+# Users with more habits than this get their overview page streamed to them.
+INDEX_STREAM_THRESHOLD = int(os.environ.get('INDEX_STREAM_THRESHOLD', 100))
+
+# How long, in seconds, a "remember me" login lasts without entering a password again.
+REMEMBER_ME_AGE = int(os.environ.get('REMEMBER_ME_AGE', 30 * 24 * 60 * 60))
+
+# How many days the idempotency keys sent with requests to record activities are kept, so
+# that retries within that time are not recorded twice.  See manage.py purgekeys.
+IDEMPOTENCY_KEY_DAYS = int(os.environ.get('IDEMPOTENCY_KEY_DAYS', 2))
+
+
+# Where the daily digest (manage.py digest --email) is sent from, and through which SMTP
+# server.  For trying it out locally: python -m smtpd -n -c DebuggingServer localhost:1025
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'reminders@habitmaster.local')
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'localhost')
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 25))
+
+# SITE_PROFILE=production slims the site for faster worker start-up: it leaves out the
+# apps and middleware the site itself does not use, the admin (and the messages it needs)
+# too unless ADMIN_ENABLED, and caches compiled templates.  (The admin URLs are only
+# loaded on first use anyway.)
+# COLD_START_BUDGET is the time, in seconds, that manage.py importprofile allows for
+# importing the WSGI application and serving its first request.
+SITE_PROFILE = os.environ.get('SITE_PROFILE', 'full')
+ADMIN_ENABLED = os.environ.get('ADMIN_ENABLED', '1') != '0'
+COLD_START_BUDGET = float(os.environ.get('COLD_START_BUDGET', 3.0))
+if SITE_PROFILE == 'production':
+    _unused = ['django.contrib.sites']
+    if not ADMIN_ENABLED:
+        _unused += ['django.contrib.admin', 'django.contrib.messages', 
+                    'django.contrib.messages.middleware.MessageMiddleware']
+    INSTALLED_APPS = tuple(app for app in INSTALLED_APPS if app not in _unused)
+    MIDDLEWARE_CLASSES = tuple(m for m in MIDDLEWARE_CLASSES if m not in _unused)
+    TEMPLATE_LOADERS = (('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),)
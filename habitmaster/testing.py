@@ -0,0 +1,41 @@
+"""
+Helpers shared by the tests of several apps, for code that reads the environment: the
+settings module, which picks a profile and backends from environment variables, and
+commands that start a fresh Python process.
+"""
+
+import contextlib
+import os
+import runpy
+
+
+@contextlib.contextmanager
+def environ(**values):
+    """
+    Sets the given environment variables (or removes those given as None) for the
+    duration of the with block, then puts back what was there before.
+    """
+    saved = dict((name, os.environ.get(name)) for name in values)
+    try:
+        for (name, value) in values.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        yield
+    finally:
+        for (name, value) in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def loadSettings(**values):
+    """
+    Returns the names defined by a fresh run of the settings module with the given
+    environment variables (as for environ), leaving the current settings as they are.
+    """
+    from habitmaster import settings
+    with environ(**values):
+        return runpy.run_path(os.path.splitext(settings.__file__)[0] + '.py')
@@ -1,8 +1,6 @@
-from django.conf.urls import patterns, include, url
-
-# Uncomment the next two lines to enable the admin:
-from django.contrib import admin
-admin.autodiscover()
+from django.conf import settings
+from django.conf.urls import patterns, url
+from django.core.urlresolvers import RegexURLResolver
 
 # All habitmaster URLs are current here, rather than divided up into app-specific sets.
 
@@ -12,10 +10,23 @@ urlpatterns = patterns('',
     # url(r'^habitmaster/', include('habitmaster.foo.urls')),
     url(r'^$', 'habitmaster.habits.views.index', name='index'),
 
+    url(r'^dashboard/$', 'habitmaster.habits.views.dashboard', name='dashboard'),
+    url(r'^metrics/$', 'habitmaster.views.metrics', name='metrics'),
+
     url(r'^habit/new/$', 'habitmaster.habits.views.create', name='habits_create'),
+    url(r'^habit/bulk/$', 'habitmaster.habits.views.create_many', 
+        name='habits_create_many'),
     url(r'^habit/(?P<habit_id>\d+)/$', 'habitmaster.habits.views.detail', name='habit'),
+    url(r'^habit/(?P<habit_id>\d+)/history/$', 'habitmaster.habits.views.detail_history', 
+        name='habit_history'),
+
+    url(r'^sync/$', 'habitmaster.habits.views.sync', name='sync'),
 
     url(r'^activity/new/$', 'habitmaster.habits.views.activity_create', name='activity_create'),
+    url(r'^activity/(?P<activity_id>\d+)/edit/$', 'habitmaster.habits.views.activity_edit', 
+        name='activity_edit'),
+    url(r'^activity/(?P<activity_id>\d+)/delete/$', 'habitmaster.habits.views.activity_delete', 
+        name='activity_delete'),
     
     url(r'^create/$', 'habitmaster.users.views.create', name='create'),
     url(r'^login/$', 'habitmaster.users.views.login', name='login'),
@@ -23,7 +34,9 @@ urlpatterns = patterns('',
     
     # Uncomment the admin/doc line below to enable admin documentation:
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
-
-    # Uncomment the next line to enable the admin:
-    url(r'^admin/', include(admin.site.urls)),
 )
+
+if 'django.contrib.admin' in settings.INSTALLED_APPS:
+    # like include('habitmaster.admin_urls'), but only imported when first used
+    urlpatterns.append(RegexURLResolver(r'^admin/', 'habitmaster.admin_urls', 
+                                        app_name='admin', namespace='admin'))
@@ -0,0 +1,111 @@
+"""
+The login pipeline: a password hasher with a configurable work factor, upgrading of
+stored passwords to that work factor on login, and remember-me tokens that let a
+returning user skip logging in (and so password hashing) altogether.
+"""
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, get_hasher
+from django.contrib.auth.models import User
+from django.core import signing
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+REMEMBER_COOKIE = 'remember'
+REMEMBER_SALT = 'habitmaster.users.remember'
+
+
+class TunablePBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    The default PBKDF2 hasher, but with its number of iterations taken from the
+    PASSWORD_ITERATIONS setting.  Hashes made with other iteration counts still verify;
+    see upgradePassword for bringing them in line.
+    """
+
+    def encode(self, password, salt, iterations=None):
+        if not iterations:
+            iterations = settings.PASSWORD_ITERATIONS
+        return super(TunablePBKDF2PasswordHasher, self).encode(password, salt, iterations)
+
+
+def needsRehash(encoded):
+    """
+    Returns whether the given stored password hash is weaker than what the preferred
+    hasher would produce now: made by another algorithm or with fewer iterations.
+    """
+    preferred = get_hasher('default')
+    parts = encoded.split('$')
+    if parts[0] != preferred.algorithm:
+        return True
+    if isinstance(preferred, TunablePBKDF2PasswordHasher):
+        try:
+            return int(parts[1]) < settings.PASSWORD_ITERATIONS
+        except (IndexError, ValueError):
+            return True
+    return False
+
+
+def upgradePassword(user, password):
+    """
+    Given a user and the raw password they just logged in with, rehashes and saves that
+    password if the stored hash is weaker than the current settings call for.  Returns
+    whether the password was rehashed.
+    """
+    if not needsRehash(user.password):
+        return False
+    user.set_password(password)
+    user.save(update_fields=['password'])
+    return True
+
+
+def _passwordCheck(user):
+    # changing the password changes this, which invalidates any outstanding tokens
+    return salted_hmac(REMEMBER_SALT, user.password).hexdigest()[:16]
+
+
+def makeRememberToken(user):
+    """ Returns a signed token that RememberMeMiddleware will accept to log in the user. """
+    return signing.dumps({'id': user.pk, 'check': _passwordCheck(user)}, salt=REMEMBER_SALT)
+
+
+def checkRememberToken(token):
+    """ Returns the active user for the given remember-me token, or None if not valid. """
+    try:
+        data = signing.loads(token, salt=REMEMBER_SALT, max_age=settings.REMEMBER_ME_AGE)
+        user = User.objects.get(pk=data['id'], is_active=True)
+    except (signing.BadSignature, User.DoesNotExist, KeyError, TypeError):
+        return None
+    if not constant_time_compare(data.get('check', ''), _passwordCheck(user)):
+        return None
+    return user
+
+
+class RememberMeMiddleware(object):
+    """
+    Logs in a user who has no session but does have a valid remember-me cookie, without
+    asking for their password again.  Also sets that cookie when a login view sets
+    request.remember_user, and clears it when a view sets request.forget_user (or when
+    the cookie is no longer valid).
+
+    Must come after AuthenticationMiddleware.
+    """
+
+    def process_request(self, request):
+        token = request.COOKIES.get(REMEMBER_COOKIE)
+        if not token or request.user.is_authenticated():
+            return
+        user = checkRememberToken(token)
+        if user is None:
+            request.forget_user = True
+            return
+        user.backend = settings.AUTHENTICATION_BACKENDS[0]
+        auth.login(request, user)
+
+    def process_response(self, request, response):
+        user = getattr(request, 'remember_user', None)
+        if user is not None:
+            response.set_cookie(REMEMBER_COOKIE, makeRememberToken(user),
+                                max_age=settings.REMEMBER_ME_AGE, httponly=True)
+        elif getattr(request, 'forget_user', False):
+            response.delete_cookie(REMEMBER_COOKIE)
+        return response
@@ -0,0 +1,101 @@
+"""
+Microbenchmark of login throughput on one core: password hashing alone at one or more 
+work factors, then full login requests through the site, against a throwaway database.
+
+    manage.py benchlogin --iterations 5000,10000,20000 --logins 50
+"""
+
+from optparse import make_option
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import get_hasher
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+
+PASSWORD = 'benchmark'
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--iterations', default=None,
+            help='Comma-separated hasher work factors to time. '
+                 '[default: the PASSWORD_ITERATIONS setting]'),
+        make_option('--logins', type='int', default=50,
+            help='Number of full logins to time at each work factor. [default: %default]'),
+        make_option('--remembered', action='store_true', default=False,
+            help='Also time requests that log in through a remember-me cookie.'),
+    )
+    help = 'Reports logins per second on a single core for each password hashing work factor.'
+
+    def handle(self, *args, **options):
+        try:
+            if options['iterations']:
+                workFactors = [int(i) for i in options['iterations'].split(',')]
+            else:
+                workFactors = [settings.PASSWORD_ITERATIONS]
+        except ValueError:
+            raise CommandError("--iterations must be a comma-separated list of integers.")
+        if options['logins'] < 1:
+            raise CommandError("--logins must be positive.")
+
+        debug = settings.DEBUG
+        allowedHosts = settings.ALLOWED_HOSTS
+        settings.DEBUG = False
+        settings.ALLOWED_HOSTS = list(allowedHosts) + ['testserver']
+        iterations = settings.PASSWORD_ITERATIONS
+        oldName = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            User.objects.create_user('bench', password=PASSWORD)
+            self.stdout.write("%10s %12s %12s" % ('iterations', 'hashes/s', 'logins/s'))
+            for workFactor in workFactors:
+                settings.PASSWORD_ITERATIONS = workFactor
+                self.stdout.write("%10d %12.1f %12.1f" % 
+                    (workFactor, self.timeHashing(options['logins']), 
+                     self.timeLogins(options['logins'])))
+            if options['remembered']:
+                self.stdout.write("remember-me logins/s: %.1f" % 
+                                  self.timeRemembered(options['logins']))
+        finally:
+            settings.PASSWORD_ITERATIONS = iterations
+            settings.DEBUG = debug
+            settings.ALLOWED_HOSTS = allowedHosts
+            connection.creation.destroy_test_db(oldName, verbosity=0)
+
+    def timeHashing(self, count):
+        hasher = get_hasher('default')
+        encoded = hasher.encode(PASSWORD, hasher.salt())
+        start = time.time()
+        for i in range(count):
+            hasher.verify(PASSWORD, encoded)
+        return count / (time.time() - start)
+
+    def timeLogins(self, count):
+        user = User.objects.get(username='bench')
+        user.set_password(PASSWORD)
+        user.save()
+        start = time.time()
+        for i in range(count):
+            response = Client().post(reverse('login'), 
+                                     {'username': 'bench', 'password': PASSWORD})
+            if response.status_code != 302:
+                raise CommandError("Login failed with status %d." % response.status_code)
+        return count / (time.time() - start)
+
+    def timeRemembered(self, count):
+        client = Client()
+        client.post(reverse('login'), 
+                    {'username': 'bench', 'password': PASSWORD, 'remember': 'on'})
+        cookie = client.cookies['remember'].value
+        start = time.time()
+        for i in range(count):
+            client = Client()
+            client.cookies['remember'] = cookie
+            response = client.get(reverse('index'))
+            if response.status_code != 200:
+                raise CommandError("Remembered login failed with status %d." % 
+                                   response.status_code)
+        return count / (time.time() - start)
@@ -5,7 +5,12 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.client import Client
+from habitmaster.testing import loadSettings
+from habitmaster.users.auth import needsRehash, REMEMBER_COOKIE
 
 
 class SimpleTest(TestCase):
@@ -14,3 +19,57 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class LoginTest(TestCase):
+
+    def setUp(self):
+        with self.settings(PASSWORD_ITERATIONS=1000):
+            self.user = User.objects.create_user('tester', password='secret')
+
+    def test_rehashOnLogin(self):
+        self.assertTrue(self.user.password.startswith('pbkdf2_sha256$1000$'))
+        with self.settings(PASSWORD_ITERATIONS=2000):
+            self.assertTrue(needsRehash(self.user.password))
+            response = self.client.post(reverse('login'), 
+                                        {'username': 'tester', 'password': 'secret'})
+            self.assertRedirects(response, reverse('index'))
+            password = User.objects.get(id=self.user.id).password
+            self.assertTrue(password.startswith('pbkdf2_sha256$2000$'))
+            self.assertFalse(needsRehash(password))
+        # never weakened again
+        with self.settings(PASSWORD_ITERATIONS=1000):
+            self.assertFalse(needsRehash(password))
+
+    def test_rememberMe(self):
+        self.client.post(reverse('login'), 
+                         {'username': 'tester', 'password': 'secret', 'remember': 'on'})
+        token = self.client.cookies[REMEMBER_COOKIE].value
+
+        # a new browser session with only the cookie is logged in
+        client = Client()
+        client.cookies[REMEMBER_COOKIE] = token
+        self.assertEqual(200, client.get(reverse('index')).status_code)
+        
+        # but not once the password changes
+        self.user.set_password('changed')
+        self.user.save()
+        client = Client()
+        client.cookies[REMEMBER_COOKIE] = token
+        response = client.get(reverse('index'))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual('', response.cookies[REMEMBER_COOKIE].value)
+
+    def test_logoutForgets(self):
+        self.client.post(reverse('login'), 
+                         {'username': 'tester', 'password': 'secret', 'remember': 'on'})
+        response = self.client.get(reverse('logout'))
+        self.assertEqual('', response.cookies[REMEMBER_COOKIE].value)
+
+    def test_sessionEngine(self):
+        def engine(cache):
+            return loadSettings(SESSION_ENGINE=None, CACHE_BACKEND=cache)['SESSION_ENGINE']
+        # a per-process cache cannot hold sessions shared by several workers
+        self.assertEqual('django.contrib.sessions.backends.db', engine(None))
+        self.assertEqual('django.contrib.sessions.backends.cached_db', 
+                         engine('django.core.cache.backends.memcached.MemcachedCache'))
@@ -7,6 +7,7 @@ from django.http import HttpResponseRedirect
 from django.core.urlresolvers import reverse
 import django.contrib.auth
 from django.contrib.auth.models import User
+from habitmaster.users.auth import upgradePassword
 
 def create(request):
     context = {}
@@ -40,6 +41,9 @@ def login(request):
             if user.is_active:
                 # login and then send back to main page (if didn't request other page)
                 django.contrib.auth.login(request, user)                
+                upgradePassword(user, request.POST['password'])
+                if request.POST.get('remember'):
+                    request.remember_user = user
                 if 'next' in request.GET:
                     return HttpResponseRedirect(request.GET['next'])
                 else:
@@ -55,6 +59,7 @@ def login(request):
 
 def logout(request):
     django.contrib.auth.logout(request)
+    request.forget_user = True
     return HttpResponseRedirect(reverse('login'))
     
     
\ No newline at end of file
@@ -1,8 +1,26 @@
 """
-Top-level pages, such as main page.
+Top-level pages that belong to no one app: currently just the /metrics/ page.  (The main
+page is habits.views.index.)
 """
 
-# currently unused: urls send directly to habits.views.index instead.
+import json
 
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from habitmaster.metrics import snapshot, asPrometheus
 
-    
\ No newline at end of file
+
+def metrics(request):
+    """
+    The engine metrics since this process started (see habitmaster.metrics), in the 
+    Prometheus text format, or as JSON given ?format=json.  Only for requests from the 
+    METRICS_ALLOWED_IPS, or from staff users.
+    """
+    if (request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS and
+            not request.user.is_staff):
+        return HttpResponseForbidden("Metrics are only available locally.")
+    data = snapshot()
+    if request.GET.get('format') == 'json':
+        return HttpResponse(json.dumps(data, sort_keys=True), 
+                            content_type='application/json')
+    return HttpResponse(asPrometheus(data), content_type='text/plain; version=0.0.4')
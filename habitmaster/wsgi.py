@@ -27,6 +27,9 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "habitmaster.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+from habitmaster.connections import enablePersistentConnections
+enablePersistentConnections()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)